@@ -0,0 +1,94 @@
+'''
+統計快照與分組報表的時間
+以 N 位合成使用者 (隨機的目標、性別、活動量、頻道與前幾天的飲食記錄) 量測：
+建立並寫入快照、讀取快照、各種分組的百分位數查詢 (結果的正確性見 tests/test_analytics.py)
+需要安裝 numpy
+例如：python benchmarks/bench_analytics.py --users 1000000
+'''
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import date
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+QUERIES = [
+    ((), 'avg_intake'),
+    (('goal',), 'intake_ratio'),
+    (('goal', 'gender'), 'weight'),
+    (('goal', 'gender', 'activity_level'), 'intake_ratio'),
+    (('tenant', 'goal', 'gender', 'activity_level'), 'avg_intake')
+]
+PERCENTILES = (50, 90, 99)
+
+
+def build_users(meal_mate, users, days, tenants, seed):
+    rng = random.Random(seed)
+    today = date.today().toordinal()
+    now = int(time.time())
+    goals = list(meal_mate.GOAL_OPTIONS.values())
+    activity_levels = list(meal_mate.ACTIVITY_OPTIONS.values())
+    meal_mate.user_profiles.clear()
+    for user in range(users):
+        tenant = user % tenants
+        user_id = f'U{user:032x}' if tenant == 0 else f'tenant{tenant}:U{user:032x}'
+        target = 1400.0 + rng.randrange(1200)
+        profile = meal_mate.UserProfile(
+            goal=rng.choice(goals), gender=rng.choice(['男', '女']), age=rng.randrange(18, 80),
+            height=rng.uniform(150, 195), weight=rng.uniform(45, 110), activity_level=rng.choice(activity_levels)
+        )
+        # 前幾天各一筆彙總，今天一到兩筆記錄
+        for day in range(today - days, today + 1):
+            profile.daily_tracker = meal_mate.DailyTracker(total_calories=target, day=day)
+            for _ in range(1 if day < today else rng.randrange(1, 3)):
+                meal_mate.apply_food_entry(profile, '便當', target * rng.uniform(0.3, 1.2), now - rng.randrange(86400))
+        meal_mate.user_profiles[user_id] = profile
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=1_000_000)
+    parser.add_argument('--days', type=int, default=3, help='每位使用者前幾天的飲食記錄')
+    parser.add_argument('--tenants', type=int, default=3)
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    import meal_mate
+
+    started_at = time.perf_counter()
+    build_users(meal_mate, args.users, args.days, args.tenants, args.seed)
+    print(f"users: {args.users} (generated in {time.perf_counter() - started_at:.1f} s)")
+
+    path = os.path.join(tempfile.mkdtemp(prefix='mealmate-analytics-'), 'analytics.npz')
+    started_at = time.perf_counter()
+    meal_mate.write_analytics_snapshot(path)
+    instance_path = meal_mate.analytics_instance_path(path)
+    print(f"build + write snapshot: {time.perf_counter() - started_at:.2f} s, {os.path.getsize(instance_path) / 1e6:.1f} MB")
+
+    meal_mate.analytics_cache.clear()
+    started_at = time.perf_counter()
+    snapshot = meal_mate.load_analytics_snapshot(path)
+    print(f"load snapshot: {(time.perf_counter() - started_at) * 1000:.1f} ms")
+
+    for group_by, metric in QUERIES:
+        timings = []
+        for _ in range(args.runs):
+            started_at = time.perf_counter()
+            report = meal_mate.group_report(snapshot, group_by, metric, PERCENTILES)
+            timings.append(time.perf_counter() - started_at)
+        print(f"group by {','.join(group_by) or '(all)':<36} {metric:<13} {len(report['groups']):>4} groups "
+              f"min {min(timings) * 1000:7.1f} ms  max {max(timings) * 1000:7.1f} ms")
+
+    started_at = time.perf_counter()
+    meal_mate.hourly_report(snapshot)
+    print(f"hourly report: {(time.perf_counter() - started_at) * 1000:.1f} ms")
+    os.remove(instance_path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,242 @@
+'''
+同步 (Flask + 背景執行緒) 與 ASGI 模式在大量慢速上游呼叫下的記憶體與吞吐量比較
+每個模式在獨立的子程序中執行：送出 N 個圖片訊息 webhook (每位使用者一則)，
+AI 使用固定延遲的 StubBackend，LINE 用戶端換成不連網的替身，量測全部結果送出所需時間、
+最多同時存在的執行緒數與 RSS 增加量
+例如：python benchmarks/bench_asgi_concurrency.py --jobs 500 --latency 2
+加上 --sync-workers 4,500 可比較預設的 4 個 AI 執行緒 (約需 jobs * latency / 4 秒)
+'''
+import argparse
+import asyncio
+import base64
+import hashlib
+import hmac
+import json
+import os
+import resource
+import subprocess
+import sys
+import threading
+import time
+from io import BytesIO
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+SECRET = 'secret'
+
+
+def max_rss_mb():
+    # Linux 的 ru_maxrss 單位為 KB
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def sample_jpeg():
+    from PIL import Image
+
+    data = BytesIO()
+    Image.new('RGB', (64, 64), (200, 120, 40)).save(data, 'JPEG')
+    return data.getvalue()
+
+
+def webhook_body(index):
+    event = {
+        'type': 'message',
+        'mode': 'active',
+        'timestamp': int(time.time() * 1000),
+        'source': {'type': 'user', 'userId': f'U{index:05d}'},
+        'replyToken': f'reply-{index}',
+        'webhookEventId': f'event-{index}',
+        'deliveryContext': {'isRedelivery': False},
+        'message': {'type': 'image', 'id': f'message-{index}', 'contentProvider': {'type': 'line'}}
+    }
+    body = json.dumps({'destination': 'bench', 'events': [event]})
+    signature = base64.b64encode(hmac.new(SECRET.encode(), body.encode(), hashlib.sha256).digest()).decode()
+    return body, signature
+
+
+class Deliveries:
+    '''
+    記錄送出的結果數，全部送出後通知
+    '''
+    def __init__(self, expected):
+        self.expected = expected
+        self.count = 0
+        self.lock = threading.Lock()
+        self.done = threading.Event()
+        self.peak_threads = threading.active_count()
+
+    def add(self):
+        with self.lock:
+            self.count += 1
+            self.peak_threads = max(self.peak_threads, threading.active_count())
+            if self.count >= self.expected:
+                self.done.set()
+
+
+class StubLineBotApi:
+    def __init__(self, deliveries, image):
+        self.deliveries = deliveries
+        self.image = image
+
+    def get_message_content(self, message_id):
+        return type('Content', (), {'content': self.image})()
+
+    def reply_message(self, reply_token, message):
+        # 等待中的提示不算結果
+        if '請稍後' not in getattr(message, 'text', ''):
+            self.deliveries.add()
+
+    def push_message(self, user_id, message):
+        self.deliveries.add()
+
+    def _post(self, *args, **kwargs):
+        pass
+
+
+class AsyncContent:
+    def __init__(self, data):
+        self.data = data
+
+    @property
+    async def content(self):
+        return self.data
+
+
+class AsyncStubLineBotApi(StubLineBotApi):
+    async def get_message_content(self, message_id):
+        return AsyncContent(self.image)
+
+    async def reply_message(self, reply_token, message):
+        StubLineBotApi.reply_message(self, reply_token, message)
+
+    async def push_message(self, user_id, message):
+        self.deliveries.add()
+
+    async def _post(self, *args, **kwargs):
+        pass
+
+
+def run_sync(meal_mate, jobs, deliveries, image):
+    app = meal_mate.create_app()
+    meal_mate.tenants[meal_mate.DEFAULT_TENANT_ID].line_bot_api = StubLineBotApi(deliveries, image)
+    client = app.test_client()
+
+    started_at = time.perf_counter()
+    for index in range(jobs):
+        body, signature = webhook_body(index)
+        client.post('/', data=body, headers={'X-Line-Signature': signature})
+    accepted_at = time.perf_counter()
+    deliveries.done.wait()
+    return started_at, accepted_at
+
+
+def run_asgi(meal_mate, jobs, deliveries, image):
+    app = meal_mate.create_asgi_app()
+    tenant = meal_mate.tenants[meal_mate.DEFAULT_TENANT_ID]
+
+    async def main():
+        lifespan = asyncio.Queue()
+        started = asyncio.Event()
+
+        async def lifespan_send(message):
+            if message['type'] == 'lifespan.startup.complete':
+                started.set()
+
+        await lifespan.put({'type': 'lifespan.startup'})
+        lifespan_task = asyncio.create_task(app({'type': 'lifespan'}, lifespan.get, lifespan_send))
+        await started.wait()
+        tenant.line_bot_api = StubLineBotApi(deliveries, image)
+        tenant.async_line_bot_api = AsyncStubLineBotApi(deliveries, image)
+
+        async def post(index):
+            body, signature = webhook_body(index)
+
+            async def receive():
+                return {'type': 'http.request', 'body': body.encode(), 'more_body': False}
+
+            async def send(message):
+                pass
+
+            scope = {
+                'type': 'http', 'method': 'POST', 'path': '/',
+                'headers': [(b'x-line-signature', signature.encode())]
+            }
+            await app(scope, receive, send)
+
+        started_at = time.perf_counter()
+        await asyncio.gather(*(post(index) for index in range(jobs)))
+        accepted_at = time.perf_counter()
+        await asyncio.to_thread(deliveries.done.wait)
+
+        await lifespan.put({'type': 'lifespan.shutdown'})
+        await lifespan_task
+        return started_at, accepted_at
+
+    return asyncio.run(main())
+
+
+def child(mode, jobs):
+    import meal_mate
+
+    image = sample_jpeg()
+    deliveries = Deliveries(jobs)
+    baseline_rss = max_rss_mb()
+    runner = run_sync if mode == 'sync' else run_asgi
+    started_at, accepted_at = runner(meal_mate, jobs, deliveries, image)
+    finished_at = time.perf_counter()
+
+    print(json.dumps({
+        'mode': mode,
+        'ai_workers': meal_mate.AI_WORKERS if mode == 'sync' else meal_mate.ASGI_AI_CONCURRENCY,
+        'jobs': jobs,
+        'delivered': deliveries.count,
+        'webhooks_seconds': round(accepted_at - started_at, 3),
+        'total_seconds': round(finished_at - started_at, 3),
+        'jobs_per_second': round(jobs / (finished_at - started_at), 1),
+        'peak_threads': deliveries.peak_threads,
+        'rss_growth_mb': round(max_rss_mb() - baseline_rss, 1)
+    }))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--jobs', type=int, default=500)
+    parser.add_argument('--latency', type=float, default=2.0, help='模擬的 OpenAI 回應時間 (秒)')
+    parser.add_argument('--sync-workers', help='同步模式的 AI_WORKERS，以逗號分隔，預設與 --jobs 相同')
+    parser.add_argument('--child', choices=['sync', 'asgi'], help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args.child, args.jobs)
+        return
+
+    base_env = {
+        **os.environ,
+        'LINE_TOKEN': 'token',
+        'LINE_SECRET': SECRET,
+        'AI_BACKEND': 'stub',
+        'AI_STUB_LATENCY': str(args.latency),
+        'IMAGE_FILTER_ENABLED': '0',
+        'USER_AI_BURST': '10',
+        'GLOBAL_AI_RATE_PER_MIN': '1000000',
+        'GLOBAL_AI_BURST': str(args.jobs * 2),
+        'AI_QUEUE_SIZE': str(args.jobs * 2),
+        'ASGI_AI_CONCURRENCY': str(args.jobs)
+    }
+    # 同步模式需要每個同時進行的呼叫各佔一個執行緒，ASGI 模式則是同樣數量的協程
+    sync_workers = (args.sync_workers or str(args.jobs)).split(',')
+    runs = [('sync', {'AI_WORKERS': workers}) for workers in sync_workers] + [('asgi', {})]
+    for mode, env in runs:
+        result = subprocess.run(
+            [sys.executable, __file__, '--child', mode, '--jobs', str(args.jobs)],
+            cwd=ROOT, env={**base_env, **env}, capture_output=True, text=True
+        )
+        if result.returncode != 0:
+            print(result.stderr[-2000:], file=sys.stderr)
+            continue
+        print(result.stdout.strip().splitlines()[-1])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,156 @@
+'''
+事件記錄的寫入放大與重啟時間
+- 寫入：經由 commit_event 寫入 N 筆事件 (新增使用者、設定資料、每日重設、新增食物、體重)，
+  比較磁碟上的位元組數與事件內容本身 (user_id、字串 UTF-8、數值 8 bytes) 的位元組數
+- 快照：在背景建立快照 (上一個快照加上已關閉的記錄段)，同時繼續經由 commit_event 寫入事件，
+  量測快照時間與期間每筆 commit_event 的延遲；之後再量測只需重播新記錄段的第二次快照
+- 重啟：在新的子程序中呼叫 open_event_log，分別量測只有記錄段 (重播全部事件)
+  與快照加上其後少量事件的還原時間
+例如：python benchmarks/bench_event_log.py --events 10000000 --users 100000
+'''
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+FOOD_NAMES = ['白飯', '雞腿便當', '燙青菜', '茶葉蛋', '珍珠奶茶', '牛肉麵', '鮭魚沙拉', '燕麥牛奶']
+
+
+def payload_size(user_id, args):
+    size = len(user_id.encode('utf-8'))
+    for value in args:
+        if isinstance(value, str):
+            size += len(value.encode('utf-8'))
+        elif value is not None:
+            size += 8
+    return size
+
+
+def generate_events(meal_mate, count, users, seed, new_users=True):
+    '''
+    先建立所有使用者 (每位 4 筆)，其餘為各使用者的日常操作：約每 8 筆食物換一天，偶爾記錄體重
+    '''
+    rng = random.Random(seed)
+    today = int(time.time())
+    day = 738000
+    if new_users:
+        for user in range(users):
+            user_id = f'U{user:032x}'
+            yield meal_mate.EVENT_PROFILE_NEW, user_id, ()
+            yield meal_mate.EVENT_PROFILE_SET, user_id, ('goal', '減重')
+            yield meal_mate.EVENT_PROFILE_SET, user_id, ('weight', 60.0 + user % 30)
+            yield meal_mate.EVENT_TRACKER_RESET, user_id, (1800.0 + user % 500, day)
+        count -= users * 4
+
+    for index in range(count):
+        user = rng.randrange(users)
+        user_id = f'U{user:032x}'
+        roll = rng.random()
+        if roll < 0.1:
+            yield meal_mate.EVENT_TRACKER_RESET, user_id, (1800.0 + user % 500, day + index // users)
+        elif roll < 0.12:
+            yield meal_mate.EVENT_WEIGHT, user_id, (60.0 + rng.random() * 30, today + index)
+        else:
+            yield meal_mate.EVENT_FOOD_ADD, user_id, (
+                rng.choice(FOOD_NAMES), float(rng.randrange(50, 900)), today + index
+            )
+
+
+def directory_size(directory):
+    return sum(os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory))
+
+
+def time_restart(directory):
+    '''
+    在新的子程序中還原，不計入匯入 meal_mate 的時間
+    '''
+    code = (
+        'import json, sys, time\n'
+        'import meal_mate\n'
+        'started_at = time.perf_counter()\n'
+        'meal_mate.open_event_log(sys.argv[1])\n'
+        'print(json.dumps({"seconds": time.perf_counter() - started_at, "users": len(meal_mate.user_profiles)}))\n'
+    )
+    result = subprocess.run(
+        [sys.executable, '-c', code, directory], cwd=ROOT, capture_output=True, text=True, check=True
+    )
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--events', type=int, default=10_000_000)
+    parser.add_argument('--users', type=int, default=100_000)
+    parser.add_argument('--tail', type=int, default=100_000, help='快照之後再寫入的事件數')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--dir', help='事件記錄目錄，預設使用暫存目錄')
+    args = parser.parse_args()
+
+    import meal_mate
+
+    directory = args.dir or tempfile.mkdtemp(prefix='mealmate-events-')
+    # 由這裡決定快照時機，不讓寫入過程自動建立快照
+    log = meal_mate.EventLog(directory, meal_mate.EVENT_LOG_FSYNC_INTERVAL, sys.maxsize)
+    log.start(0)
+    meal_mate.event_log = log
+
+    payload = 0
+    started_at = time.perf_counter()
+    for op, user_id, event_args in generate_events(meal_mate, args.events, args.users, args.seed):
+        meal_mate.commit_event(op, user_id, *event_args)
+        payload += payload_size(user_id, event_args)
+    log.flush()
+    write_seconds = time.perf_counter() - started_at
+
+    on_disk = directory_size(directory)
+    print(f"events: {args.events}, users: {args.users}, directory: {directory}")
+    print(f"write: {write_seconds:.1f} s ({args.events / write_seconds:,.0f} events/s)")
+    print(f"payload: {payload / 1e6:,.1f} MB, on disk: {on_disk / 1e6:,.1f} MB, "
+          f"amplification: {on_disk / payload:.2f}x, {on_disk / args.events:.1f} bytes/event")
+
+    restart = time_restart(directory)
+    print(f"restart without snapshot: {restart['seconds']:.2f} s ({restart['users']} users, replay {args.events} events)")
+
+    # 第一次快照需要重播全部記錄段；期間持續寫入，記錄每筆 commit_event 的延遲
+    log.snapshotting = True
+    snapshot_thread = threading.Thread(target=meal_mate.write_snapshot)
+    started_at = time.perf_counter()
+    snapshot_thread.start()
+    latencies = []
+    snapshot_seconds = None
+    tail = generate_events(meal_mate, sys.maxsize, args.users, args.seed + 1, new_users=False)
+    while snapshot_thread.is_alive() or len(latencies) < args.tail:
+        op, user_id, event_args = next(tail)
+        commit_started_at = time.perf_counter()
+        meal_mate.commit_event(op, user_id, *event_args)
+        latencies.append(time.perf_counter() - commit_started_at)
+        if snapshot_seconds is None and not snapshot_thread.is_alive():
+            snapshot_seconds = time.perf_counter() - started_at
+    log.flush()
+    snapshot_size = os.path.getsize(log.snapshot_path())
+    latencies.sort()
+
+    print(f"first snapshot (background, replays {args.events} events): {snapshot_seconds:.2f} s, "
+          f"{snapshot_size / 1e6:,.1f} MB ({snapshot_size / args.users:,.0f} bytes/user)")
+    print(f"commit_event during snapshot: {len(latencies)} events, "
+          f"p99 {latencies[int(len(latencies) * 0.99)] * 1000:.2f} ms, max {latencies[-1] * 1000:.1f} ms")
+
+    restart = time_restart(directory)
+    print(f"restart with snapshot: {restart['seconds']:.2f} s (replay {len(latencies)} events)")
+
+    log.snapshotting = True
+    started_at = time.perf_counter()
+    meal_mate.write_snapshot()
+    print(f"next snapshot (previous snapshot + {len(latencies)} events): {time.perf_counter() - started_at:.2f} s")
+
+
+if __name__ == '__main__':
+    main()
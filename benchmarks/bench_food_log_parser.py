@@ -0,0 +1,42 @@
+'''
+新增記錄解析器的吞吐量
+例如：python benchmarks/bench_food_log_parser.py --messages 200000
+'''
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from meal_mate import parse_food_log
+
+MESSAGES = [
+    '雞胸肉 200',
+    '白飯 280 雞腿 350 青菜 60',
+    '雞蛋 2顆 140大卡, 豆漿 120kcal',
+    '茶葉蛋 75 x2 7-11飯糰 300',
+    '麥當勞1號餐 800 可樂 150 卡',
+    '雞蛋 2 顆 140 牛奶 250 毫升 150',
+]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--messages', type=int, default=200000)
+    args = parser.parse_args()
+
+    items = 0
+    started_at = time.perf_counter()
+    for index in range(args.messages):
+        items += len(parse_food_log(MESSAGES[index % len(MESSAGES)]))
+    elapsed = time.perf_counter() - started_at
+
+    print(f"messages: {args.messages}")
+    print(f"items: {items}")
+    print(f"elapsed: {elapsed:.3f} s")
+    print(f"throughput: {args.messages / elapsed:,.0f} messages/s ({elapsed / args.messages * 1e6:.2f} us/message)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+'''
+批次匯入與匯出的每秒筆數 (rows/s)
+- 匯入：以 import_rows 讀入 JSONL/CSV 的個人資料與當日飲食記錄 (每 IMPORT_BATCH_SIZE 筆取一次 state_lock)
+- 匯出：以 /admin/export 相同的產生器逐筆輸出 JSONL/CSV，只計算位元組數不保留內容
+預設不寫入事件記錄，加上 --event-log 時一併量測寫入事件記錄的成本
+例如：python benchmarks/bench_import_export.py --users 1000000 --food-rows 3000000
+'''
+import argparse
+import io
+import os
+import sys
+import tempfile
+import time
+from datetime import date
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+FOOD_NAMES = ['白飯', '雞腿便當', '燙青菜', '茶葉蛋', '珍珠奶茶', '牛肉麵', '鮭魚沙拉', '燕麥牛奶']
+
+
+def profile_rows(users):
+    for user in range(users):
+        yield {
+            'user_id': f'U{user:032x}', 'goal': '減重', 'gender': '男' if user % 2 else '女',
+            'age': 20 + user % 50, 'height': 150.0 + user % 40, 'weight': 45.0 + user % 50,
+            'activity_level': '輕度活動'
+        }
+
+
+def food_log_rows(count, users):
+    today = date.today().isoformat()
+    now = int(time.time())
+    for index in range(count):
+        yield {
+            'user_id': f'U{index % users:032x}', 'date': today, 'timestamp': now + index,
+            'name': FOOD_NAMES[index % len(FOOD_NAMES)], 'calories': 50.0 + index % 400
+        }
+
+
+def encode(meal_mate, rows, fields, data_format):
+    '''
+    先把輸入檔內容準備在記憶體中，不計入匯入時間
+    '''
+    stream = meal_mate.stream_csv(rows, fields) if data_format == 'csv' else meal_mate.stream_jsonl(rows)
+    return ''.join(stream)
+
+
+def run_import(meal_mate, kind, text, data_format, count):
+    lines = io.StringIO(text, newline='')
+    started_at = time.perf_counter()
+    result = meal_mate.import_rows(kind, meal_mate.read_rows(lines, data_format))
+    seconds = time.perf_counter() - started_at
+    print(f"import {kind:<10}{data_format:<7}{count:>10} rows {seconds:>8.2f} s {count / seconds:>12,.0f} rows/s"
+          f"  (imported {result['imported']}, skipped {result['skipped']})")
+
+
+def run_export(meal_mate, kind, data_format):
+    rows, fields = meal_mate.export_rows(kind)
+    stream = meal_mate.stream_csv(rows, fields) if data_format == 'csv' else meal_mate.stream_jsonl(rows)
+    count = -1 if data_format == 'csv' else 0
+    size = 0
+    started_at = time.perf_counter()
+    for chunk in stream:
+        size += len(chunk)
+        count += chunk.count('\n')
+    seconds = time.perf_counter() - started_at
+    print(f"export {kind:<10}{data_format:<7}{count:>10} rows {seconds:>8.2f} s {count / seconds:>12,.0f} rows/s"
+          f"  ({size / 1e6:,.1f} MB)")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=1_000_000)
+    parser.add_argument('--food-rows', type=int, default=3_000_000)
+    parser.add_argument('--formats', default='jsonl,csv')
+    parser.add_argument('--event-log', action='store_true', help='匯入時寫入事件記錄 (暫存目錄)')
+    args = parser.parse_args()
+
+    import meal_mate
+
+    if args.event_log:
+        meal_mate.event_log = meal_mate.EventLog(
+            tempfile.mkdtemp(prefix='mealmate-import-'), meal_mate.EVENT_LOG_FSYNC_INTERVAL, sys.maxsize
+        )
+        meal_mate.event_log.start(0)
+
+    for data_format in args.formats.split(','):
+        meal_mate.user_profiles.clear()
+        text = encode(meal_mate, profile_rows(args.users), meal_mate.PROFILE_FIELDS, data_format)
+        run_import(meal_mate, 'profiles', text, data_format, args.users)
+        text = encode(meal_mate, food_log_rows(args.food_rows, args.users), meal_mate.FOOD_LOG_FIELDS, data_format)
+        run_import(meal_mate, 'food_logs', text, data_format, args.food_rows)
+        del text
+
+        run_export(meal_mate, 'profiles', data_format)
+        run_export(meal_mate, 'food_logs', data_format)
+
+
+if __name__ == '__main__':
+    main()
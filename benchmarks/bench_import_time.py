@@ -0,0 +1,81 @@
+'''
+啟動時間：以 python -X importtime 量測匯入 meal_mate 的時間，以及 create_app() 的時間
+例如：python benchmarks/bench_import_time.py --runs 10
+'''
+import argparse
+import os
+import re
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+IMPORT_LINE = re.compile(r'import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)')
+
+CREATE_APP = '''
+import time
+started_at = time.perf_counter()
+import meal_mate
+imported_at = time.perf_counter()
+meal_mate.create_app()
+print(imported_at - started_at, time.perf_counter() - imported_at)
+'''
+
+
+def run_python(args, env=None):
+    return subprocess.run(
+        [sys.executable, *args], cwd=ROOT, env={**os.environ, **(env or {})},
+        capture_output=True, text=True, check=True
+    )
+
+
+def import_times():
+    '''
+    回傳 meal_mate 本身與累計的匯入時間 (微秒)，以及 meal_mate 直接匯入的模組
+    '''
+    result = run_python(['-X', 'importtime', '-c', 'import meal_mate'])
+    children = []
+    for line in result.stderr.splitlines():
+        match = IMPORT_LINE.match(line)
+        if match is None:
+            continue
+        self_us, cumulative_us, indent, name = match.groups()
+        if name == 'meal_mate':
+            return int(self_us), int(cumulative_us), children
+        # 縮排一格的是直譯器啟動時匯入的其他模組，縮排三格的是其下一層 (meal_mate 直接匯入的模組)
+        if len(indent) == 1:
+            children = []
+        elif len(indent) == 3:
+            children.append((int(cumulative_us), name))
+    raise RuntimeError(result.stderr[-2000:])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--top', type=int, default=10)
+    args = parser.parse_args()
+
+    # 先產生 .pyc，量測時不包含編譯時間 (設定 PYTHONDONTWRITEBYTECODE 時匯入不會寫入 .pyc)
+    run_python(['-m', 'py_compile', 'meal_mate.py'])
+
+    self_times, cumulative_times, startup_times = [], [], []
+    children = []
+    for _ in range(args.runs):
+        self_us, cumulative_us, children = import_times()
+        self_times.append(self_us / 1000)
+        cumulative_times.append(cumulative_us / 1000)
+        result = run_python(['-c', CREATE_APP], {'LINE_TOKEN': 'token', 'LINE_SECRET': 'secret'})
+        startup_times.append(sum(map(float, result.stdout.split())) * 1000)
+
+    print(f"runs: {args.runs}")
+    print(f"meal_mate self: median {statistics.median(self_times):.1f} ms")
+    print(f"meal_mate cumulative: median {statistics.median(cumulative_times):.1f} ms")
+    print(f"import + create_app(): median {statistics.median(startup_times):.1f} ms")
+    print("heaviest direct imports (last run):")
+    for cumulative_us, name in sorted(children, reverse=True)[:args.top]:
+        print(f"  {cumulative_us / 1000:8.1f} ms  {name}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+'''
+使用者資料的記憶體用量 (tracemalloc)：每位使用者與每筆食物記錄的位元組數
+- dict：原本的巢狀 dict，食物記錄帶有 strftime 產生的時間字串
+- slots：UserProfile / DailyTracker / FoodEntry (slots dataclass)，時間為 int
+- slots + history：經由 apply_food_entry 新增記錄，包含飲食建議用的每日彙總 (DietHistory)
+例如：python benchmarks/bench_profile_memory.py --users 20000 --entries 5
+'''
+import argparse
+import gc
+import os
+import sys
+import time
+import tracemalloc
+from datetime import date, datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from meal_mate import DailyTracker, FoodEntry, UserProfile, apply_food_entry
+
+FOOD_NAMES = ['白飯', '雞腿便當', '燙青菜', '茶葉蛋', '珍珠奶茶', '牛肉麵', '鮭魚沙拉', '燕麥牛奶']
+
+
+def food_name(index):
+    # 每筆記錄都是新的字串物件，與實際從訊息解析出來的名稱相同
+    return FOOD_NAMES[index % len(FOOD_NAMES)].encode().decode()
+
+
+def build_dicts(users, entries):
+    profiles = {}
+    for user in range(users):
+        daily_tracker = {
+            'total_calories': 1800.0 + user % 500,
+            'consumed_calories': 0,
+            'food_log': [],
+            'date': date.today()
+        }
+        for entry in range(entries):
+            calories = 100.0 + entry
+            daily_tracker['consumed_calories'] += calories
+            daily_tracker['food_log'].append({
+                'name': food_name(entry),
+                'calories': calories,
+                'time': datetime.now().strftime("%H:%M")
+            })
+        profiles[f'U{user:032d}'] = {
+            'setup_stage': 'ready',
+            'goal': '減重',
+            'gender': '男',
+            'age': 20 + user % 50,
+            'height': 160.0 + user % 30,
+            'weight': 50.0 + user % 40,
+            'activity_level': '輕度活動',
+            'daily_tracker': daily_tracker
+        }
+    return profiles
+
+
+def build_slots(users, entries):
+    profiles = {}
+    now = int(time.time())
+    for user in range(users):
+        daily_tracker = DailyTracker(total_calories=1800.0 + user % 500)
+        for entry in range(entries):
+            calories = 100.0 + entry
+            daily_tracker.consumed_calories += calories
+            daily_tracker.food_log.append(FoodEntry(food_name(entry), calories, now + user + entry))
+        profiles[f'U{user:032d}'] = UserProfile(
+            goal='減重', gender='男', age=20 + user % 50, height=160.0 + user % 30,
+            weight=50.0 + user % 40, activity_level='輕度活動', daily_tracker=daily_tracker
+        )
+    return profiles
+
+
+def build_slots_with_history(users, entries):
+    profiles = {}
+    now = int(time.time())
+    for user in range(users):
+        profile = UserProfile(
+            goal='減重', gender='男', age=20 + user % 50, height=160.0 + user % 30,
+            weight=50.0 + user % 40, activity_level='輕度活動',
+            daily_tracker=DailyTracker(total_calories=1800.0 + user % 500)
+        )
+        for entry in range(entries):
+            apply_food_entry(profile, food_name(entry), 100.0 + entry, now + user + entry)
+        profiles[f'U{user:032d}'] = profile
+    return profiles
+
+
+def measure(build, users, entries):
+    gc.collect()
+    tracemalloc.start()
+    profiles = build(users, entries)
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del profiles
+    return size
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=20000)
+    parser.add_argument('--entries', type=int, default=5)
+    args = parser.parse_args()
+
+    print(f"users: {args.users}, entries per user: {args.entries}")
+    print(f"{'representation':<18}{'bytes/user (0 entries)':>24}{'bytes/entry':>14}{'bytes/user (total)':>20}")
+    for name, build in [('dict', build_dicts), ('slots', build_slots), ('slots + history', build_slots_with_history)]:
+        empty = measure(build, args.users, 0)
+        full = measure(build, args.users, args.entries)
+        per_entry = (full - empty) / (args.users * args.entries) if args.entries else 0
+        print(f"{name:<18}{empty / args.users:>24.0f}{per_entry:>14.0f}{full / args.users:>20.0f}")
+
+
+if __name__ == '__main__':
+    main()
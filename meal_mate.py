@@ -1,6 +1,7 @@
-from flask import Flask, request, abort
+from flask import Flask, Response, request, abort, current_app, send_file
 from linebot import LineBotApi, WebhookHandler
 from linebot.exceptions import InvalidSignatureError
+from linebot.http_client import RequestsHttpClient, RequestsHttpResponse
 from linebot.models import (
     MessageEvent, TextMessage, TextSendMessage, 
     FollowEvent, PostbackEvent, TemplateSendMessage,
@@ -8,367 +9,2645 @@ from linebot.models import (
     ConfirmTemplate, MessageAction, URIAction, ImageSendMessage,
     CarouselColumn, CarouselTemplate, ImageMessage, FlexSendMessage
 )
-from datetime import datetime, date
+from datetime import datetime, date, timedelta
+from collections import Counter, OrderedDict, deque
+from functools import wraps
+from dataclasses import dataclass, field, fields
 import os
+import argparse
+import atexit
 import base64
-import openai
+import contextvars
+import gc
+import hashlib
+import heapq
+import hmac
+import inspect
+import io
+import sys
+import tempfile
+import json
+import itertools
+import marshal
+import queue
+import random
+import threading
+import math
+import mmap
+import re
+import struct
+import time
+import zlib
 from io import BytesIO
-from PIL import Image
 from dotenv import load_dotenv
 
 # 載入環境變數
 load_dotenv()
 
-# Line Bot 初始化
-app = Flask(__name__)
-line_bot_api = LineBotApi(os.getenv('LINE_TOKEN'))
-handler = WebhookHandler(os.getenv('LINE_SECRET'))
+# 多頻道設定：TENANTS_FILE 為 JSON 陣列，每個頻道一筆
+# {"id": "clinic", "token": "...", "secret": "...", "ai_rate_per_min": 30, "ai_burst": 10,
+#  "user_ai_rate_per_min": 3, "user_ai_burst": 5}
+# 有設定 LINE_TOKEN 時另外建立預設頻道 (id 為空字串)，以 / 接收 webhook，其他頻道為 /webhook/<id>
+TENANTS_FILE = os.getenv('TENANTS_FILE')
+DEFAULT_TENANT_ID = ''
+tenants = {}
+current_tenant = contextvars.ContextVar('current_tenant', default=DEFAULT_TENANT_ID)
+
+class TenantProxy:
+    '''
+    依目前處理中的頻道轉送到該頻道的 LINE 用戶端，事件處理函數不需要知道有幾個頻道
+    '''
+    def __init__(self, attribute):
+        self.attribute = attribute
+
+    def __getattr__(self, name):
+        value = getattr(getattr(tenants[current_tenant.get()], self.attribute), name)
+        # 抽樣記錄中的請求需要量測每次呼叫 LINE API 的時間
+        if traffic_trace.get() is None or not callable(value):
+            return value
+        return timed_upstream_call(f"line:{name}", value)
+
+# Line Bot 用戶端，各頻道的用戶端由 create_app() 建立
+# openai 與 Pillow 只在第一次呼叫 AI 或處理圖片時才載入，以加快啟動
+line_bot_api = TenantProxy('line_bot_api')
+_app = None
+
+# ASGI 模式的非同步 LINE 用戶端與 OpenAI 工作佇列，由 create_asgi_app() 啟動時建立
+ASGI_AI_CONCURRENCY = int(os.getenv('ASGI_AI_CONCURRENCY', '500'))
+async_line_bot_api = TenantProxy('async_line_bot_api')
+ai_event_loop = None
+async_ai_job_queue = None
+
+# 食物記錄，時間以 Unix 秒數儲存，顯示時才格式化
+@dataclass(slots=True)
+class FoodEntry:
+    name: str
+    calories: float
+    timestamp: int
+
+    @property
+    def time(self):
+        return datetime.fromtimestamp(self.timestamp).strftime("%H:%M")
+
+# 每日熱量追蹤，日期以 date.toordinal() 儲存
+@dataclass(slots=True)
+class DailyTracker:
+    total_calories: float
+    consumed_calories: float = 0
+    food_log: list = field(default_factory=list)
+    day: int = field(default_factory=lambda: date.today().toordinal())
+
+# 單日飲食彙總，只保留最近幾天，供飲食建議的提示詞使用
+@dataclass(slots=True)
+class DaySummary:
+    calories: float = 0
+    foods: Counter = field(default_factory=Counter)
+
+# 依日期 (date.toordinal()) 累計的飲食彙總，新增或刪除食物記錄時增量更新
+@dataclass(slots=True)
+class DietHistory:
+    days: dict = field(default_factory=dict)
+
+    def add(self, day, food_name, calories):
+        summary = self.days.get(day)
+        if summary is None:
+            summary = self.days[day] = DaySummary()
+            # 新的一天才需要淘汰過舊的彙總
+            for old_day in [d for d in self.days if d <= day - DIET_HISTORY_DAYS]:
+                del self.days[old_day]
+        summary.calories += calories
+        summary.foods[food_name] += 1
+
+    def remove(self, day, food_name, calories):
+        summary = self.days.get(day)
+        if summary is None:
+            return
+        summary.calories -= calories
+        summary.foods[food_name] -= 1
+        if summary.foods[food_name] <= 0:
+            del summary.foods[food_name]
+
+# 體重記錄與趨勢，時間以 Unix 秒數儲存
+@dataclass(slots=True)
+class WeightEntry:
+    weight: float
+    timestamp: int
+
+# 依不等間隔時間調整的 Holt 雙指數平滑，每次記錄只更新 level 與 slope (O(1))
+# level 為平滑後的體重，slope 為每日變化 (公斤/天)
+@dataclass(slots=True)
+class WeightTrend:
+    level: float = None
+    slope: float = 0.0
+    last_timestamp: int = None
+    history: list = field(default_factory=list)
+
+    def update(self, weight, timestamp):
+        self.history.append(WeightEntry(weight, timestamp))
+        if self.level is None:
+            self.level = weight
+            self.last_timestamp = timestamp
+            return
+
+        # 同一天多次記錄時以一小時計算，避免除以接近 0 的間隔
+        days = max((timestamp - self.last_timestamp) / 86400, 1 / 24)
+        forecast = self.level + self.slope * days
+        level_alpha = 1 - (1 - WEIGHT_LEVEL_ALPHA) ** days
+        trend_beta = 1 - (1 - WEIGHT_TREND_BETA) ** days
+        level = forecast + level_alpha * (weight - forecast)
+        self.slope += trend_beta * ((level - self.level) / days - self.slope)
+        self.level = level
+        self.last_timestamp = timestamp
+
+    @property
+    def weekly_change(self):
+        return self.slope * 7
+
+# 使用者個人資料，設定流程中尚未填寫的欄位為 None
+@dataclass(slots=True)
+class UserProfile:
+    goal: str = None
+    gender: str = None
+    age: int = None
+    height: float = None
+    weight: float = None
+    activity_level: str = None
+    daily_tracker: DailyTracker = None
+    reminders_enabled: bool = True
+    weight_trend: WeightTrend = None
+    diet_history: DietHistory = None
 
 # 使用者資料儲存 (實際應用中建議使用資料庫)
 user_profiles = {}
 
-# 儲存用戶的飲食建議流程選擇
-user_diet_suggestion_flow = {}
+# 體重平滑係數 (以一天為單位)，WEIGHT_SMOOTHED_CALORIES=1 時以平滑後的體重計算每日熱量
+WEIGHT_LEVEL_ALPHA = float(os.getenv('WEIGHT_LEVEL_ALPHA', '0.25'))
+WEIGHT_TREND_BETA = float(os.getenv('WEIGHT_TREND_BETA', '0.1'))
+WEIGHT_SMOOTHED_CALORIES = os.getenv('WEIGHT_SMOOTHED_CALORIES') == '1'
 
-# 跳過系統產生的提示訊息
-skip_text_message = set()
+# 共享狀態的鍵值儲存，多個實例部署時需設定 REDIS_URL
+# 儲存內容：使用者設定階段、飲食建議流程選擇、跳過系統產生的提示訊息
+# 使用者資料 (user_profiles) 仍在各實例的記憶體中，負載平衡需依使用者固定轉送到同一個實例；
+# 實例沒有該使用者的資料時會從選擇目標重新設定
+REDIS_URL = os.getenv('REDIS_URL')
+SESSION_KEY_PREFIX = os.getenv('SESSION_KEY_PREFIX', 'mealmate')
 
-# 初始化函數
-def initialize_daily_tracker(daily_calories):
+class InMemoryKV:
+    '''
+    單一實例使用的鍵值儲存，所有值皆為字串
+    '''
+    def __init__(self):
+        self.data = {}
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            return self.data.get(key)
+
+    def set(self, key, value):
+        with self.lock:
+            self.data[key] = value
+
+    def delete(self, key):
+        with self.lock:
+            self.data.pop(key, None)
+
+    def compare_and_set(self, key, expected, value):
+        '''
+        當目前的值等於 expected (None 代表不存在) 時才寫入 value，成功回傳 True
+        '''
+        with self.lock:
+            if self.data.get(key) != expected:
+                return False
+            if value is None:
+                self.data.pop(key, None)
+            else:
+                self.data[key] = value
+            return True
+
+    def sadd(self, key, member):
+        with self.lock:
+            self.data.setdefault(key, set()).add(member)
+
+    def srem(self, key, member):
+        with self.lock:
+            members = self.data.get(key)
+            if not members or member not in members:
+                return 0
+            members.remove(member)
+            return 1
+
+    def execute_batch(self, commands):
+        '''
+        依序執行多個指令，例如 [('get', key), ('srem', key, member)]
+        '''
+        return [getattr(self, name)(*args) for name, *args in commands]
+
+class RedisKV:
+    '''
+    使用 Redis 協定的鍵值儲存，可傳入 fakeredis 等相容的 client 進行測試
+    '''
+    def __init__(self, url=None, client=None):
+        if client is None:
+            import redis
+            client = redis.Redis.from_url(url, decode_responses=True)
+        from redis.exceptions import WatchError
+
+        self.client = client
+        self.WatchError = WatchError
+
+    def get(self, key):
+        return self.client.get(key)
+
+    def set(self, key, value):
+        self.client.set(key, value)
+
+    def delete(self, key):
+        self.client.delete(key)
+
+    def compare_and_set(self, key, expected, value):
+        '''
+        以 WATCH/MULTI 實作的樂觀鎖，其他實例同時修改時回傳 False
+        '''
+        with self.client.pipeline() as pipe:
+            try:
+                pipe.watch(key)
+                if pipe.get(key) != expected:
+                    pipe.unwatch()
+                    return False
+                pipe.multi()
+                if value is None:
+                    pipe.delete(key)
+                else:
+                    pipe.set(key, value)
+                pipe.execute()
+                return True
+            except self.WatchError:
+                return False
+
+    def set_if_absent(self, key, value, ttl_seconds):
+        '''
+        key 不存在時寫入並在 ttl_seconds 秒後過期 (SET NX EX)，寫入成功回傳 True
+        '''
+        return bool(self.client.set(key, value, nx=True, ex=max(1, math.ceil(ttl_seconds))))
+
+    def sadd(self, key, member):
+        self.client.sadd(key, member)
+
+    def srem(self, key, member):
+        return self.client.srem(key, member)
+
+    def execute_batch(self, commands):
+        '''
+        以 pipeline 一次送出多個指令，只需一次網路往返
+        '''
+        pipe = self.client.pipeline(transaction=False)
+        for name, *args in commands:
+            getattr(pipe, name)(*args)
+        return pipe.execute()
+
+def create_session_store():
+    if REDIS_URL:
+        return RedisKV(REDIS_URL)
+    return InMemoryKV()
+
+session_store = create_session_store()
+
+# 狀態變更事件記錄 (append-only)，設定 EVENT_LOG_DIR 後啟用
+EVENT_LOG_DIR = os.getenv('EVENT_LOG_DIR')
+EVENT_LOG_FSYNC_INTERVAL = float(os.getenv('EVENT_LOG_FSYNC_INTERVAL', '0.05'))
+EVENT_LOG_SNAPSHOT_EVERY = int(os.getenv('EVENT_LOG_SNAPSHOT_EVERY', '100000'))
+
+# 事件種類
+EVENT_PROFILE_NEW = 1
+EVENT_PROFILE_SET = 2
+EVENT_TRACKER_RESET = 3
+EVENT_TRACKER_TOTAL = 4
+EVENT_FOOD_ADD = 5
+EVENT_FOOD_REMOVE = 6
+EVENT_SETUP_STAGE = 7
+EVENT_DIET_FLOW = 8
+EVENT_WEIGHT = 9
+EVENT_FOOD_BATCH = 10
+EVENT_HISTORY_ADD = 11
+
+# 一筆事件最多 255 個值 (user_id、時間與每項的名稱、熱量)
+EVENT_FOOD_BATCH_MAX_ITEMS = 126
+
+# 每筆記錄的標頭：內容長度、CRC32
+EVENT_HEADER = struct.Struct('<II')
+# 快照以 marshal 儲存只含基本型別的 tuple；MMSNAP01 為舊版的 pickle 快照，仍可讀取
+SNAPSHOT_MAGIC = b'MMSNAP02'
+SNAPSHOT_MAGIC_PICKLE = b'MMSNAP01'
+SNAPSHOT_HEADER = struct.Struct('<8sQ')
+
+def pack_event(op, user_id, args):
+    '''
+    將事件編碼為精簡的二進位記錄，值以 1 byte 標記型別
+    '''
+    parts = [struct.pack('<BB', op, len(args) + 1)]
+    for value in (user_id, *args):
+        if value is None:
+            parts.append(b'\x00')
+        elif isinstance(value, int):
+            parts.append(struct.pack('<Bq', 1, value))
+        elif isinstance(value, float):
+            parts.append(struct.pack('<Bd', 2, value))
+        else:
+            data = str(value).encode('utf-8')
+            parts.append(struct.pack('<BI', 3, len(data)))
+            parts.append(data)
+
+    body = b''.join(parts)
+    return EVENT_HEADER.pack(len(body), zlib.crc32(body)) + body
+
+def unpack_event(body):
+    op, count = struct.unpack_from('<BB', body, 0)
+    offset = 2
+    values = []
+    for _ in range(count):
+        tag = body[offset]
+        offset += 1
+        if tag == 0:
+            values.append(None)
+        elif tag == 1:
+            values.append(struct.unpack_from('<q', body, offset)[0])
+            offset += 8
+        elif tag == 2:
+            values.append(struct.unpack_from('<d', body, offset)[0])
+            offset += 8
+        else:
+            length = struct.unpack_from('<I', body, offset)[0]
+            offset += 4
+            values.append(bytes(body[offset:offset + length]).decode('utf-8'))
+            offset += length
+    return op, values[0], values[1:]
+
+def read_event_segment(path):
+    '''
+    依序讀出記錄檔中的事件，遇到寫到一半或損毀的記錄即停止
+    '''
+    with open(path, 'rb') as f:
+        data = f.read()
+
+    offset = 0
+    while offset + EVENT_HEADER.size <= len(data):
+        length, checksum = EVENT_HEADER.unpack_from(data, offset)
+        body = data[offset + EVENT_HEADER.size:offset + EVENT_HEADER.size + length]
+        if len(body) < length or zlib.crc32(body) != checksum:
+            print(f"事件記錄 {path} 於位置 {offset} 損毀，忽略其後的內容")
+            return
+        yield unpack_event(body)
+        offset += EVENT_HEADER.size + length
+
+class EventLog:
+    '''
+    分段的 append-only 事件記錄檔，由背景執行緒批次 fsync
+    快照完成後只需重播快照之後的記錄段，重啟時間與歷史長度無關
+    '''
+    def __init__(self, directory, fsync_interval, snapshot_every):
+        self.directory = directory
+        self.fsync_interval = fsync_interval
+        self.snapshot_every = snapshot_every
+        self.lock = threading.Lock()
+        self.file = None
+        self.segment = 0
+        self.dirty = False
+        self.events_since_snapshot = 0
+        self.snapshotting = False
+        os.makedirs(directory, exist_ok=True)
+
+    def segment_path(self, segment):
+        return os.path.join(self.directory, f"events-{segment:08d}.log")
+
+    def snapshot_path(self):
+        return os.path.join(self.directory, 'snapshot.bin')
+
+    def segments(self):
+        segments = []
+        for name in os.listdir(self.directory):
+            if name.startswith('events-') and name.endswith('.log'):
+                segments.append(int(name[len('events-'):-len('.log')]))
+        return sorted(segments)
+
+    def open_segment(self, segment):
+        if self.file is not None:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.file.close()
+        self.segment = segment
+        self.file = open(self.segment_path(segment), 'ab')
+
+    def start(self, segment):
+        self.open_segment(segment)
+        threading.Thread(target=self.flush_loop, daemon=True).start()
+        # 正常結束時寫出尚未 fsync 的記錄
+        atexit.register(self.flush)
+
+    def append(self, op, user_id, args):
+        with self.lock:
+            self.file.write(pack_event(op, user_id, args))
+            self.dirty = True
+            self.events_since_snapshot += 1
+            need_snapshot = (
+                self.events_since_snapshot >= self.snapshot_every and not self.snapshotting
+            )
+            if need_snapshot:
+                self.snapshotting = True
+
+        if need_snapshot:
+            threading.Thread(target=write_snapshot, daemon=True).start()
+
+    def flush(self):
+        with self.lock:
+            if not self.dirty:
+                return
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.dirty = False
+
+    def flush_loop(self):
+        while True:
+            time.sleep(self.fsync_interval)
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"Event Log Error: {e}")
+
+    def rotate(self):
+        '''
+        切換到新的記錄段，回傳新記錄段的編號
+        '''
+        with self.lock:
+            self.open_segment(self.segment + 1)
+            self.dirty = False
+            self.events_since_snapshot = 0
+            return self.segment
+
+event_log = None
+
+# 狀態變更需與寫入事件記錄、建立快照互斥，避免快照與記錄重複或遺漏
+state_lock = threading.RLock()
+
+# 今日狀態的 Flex 訊息，以 (日期, 訊息) 快取，追蹤器或個人資料變更時於 apply_event 中清除
+status_cache = {}
+STATUS_RECENT_ENTRIES = int(os.getenv('STATUS_RECENT_ENTRIES', '5'))
+# 飲食建議提示詞中的飲食摘要，以 (日期, 摘要) 快取，於 apply_event 中清除
+diet_summary_cache = {}
+DIET_HISTORY_DAYS = int(os.getenv('DIET_HISTORY_DAYS', '7'))
+DIET_SUMMARY_TOP_FOODS = int(os.getenv('DIET_SUMMARY_TOP_FOODS', '7'))
+DIET_SUMMARY_NAME_CHARS = int(os.getenv('DIET_SUMMARY_NAME_CHARS', '12'))
+# (開始小時, 餐別)，依食物記錄時間分組
+MEAL_PERIODS = [(0, '宵夜'), (5, '早餐'), (11, '午餐'), (14, '點心'), (17, '晚餐'), (21, '宵夜')]
+
+# OpenAI 請求限流設定 (每分鐘可用次數與可累積的突發次數)
+USER_AI_RATE_PER_MIN = float(os.getenv('USER_AI_RATE_PER_MIN', '3'))
+USER_AI_BURST = float(os.getenv('USER_AI_BURST', '5'))
+GLOBAL_AI_RATE_PER_MIN = float(os.getenv('GLOBAL_AI_RATE_PER_MIN', '60'))
+GLOBAL_AI_BURST = float(os.getenv('GLOBAL_AI_BURST', '20'))
+
+# OpenAI 工作佇列設定，數字越小越優先 (文字菜單優先於圖片分析)
+AI_WORKERS = int(os.getenv('AI_WORKERS', '4'))
+AI_QUEUE_SIZE = int(os.getenv('AI_QUEUE_SIZE', '100'))
+AI_JOB_PRIORITY = {
+    'diet_plan': 0,
+    'image': 1
+}
+
+class TokenBucket:
+    '''
+    令牌桶限流器，rate 為每秒補充的令牌數，capacity 為最多可累積的令牌數
+    '''
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, amount=1):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+
+            if self.tokens < amount:
+                return False
+
+            self.tokens -= amount
+            return True
+
+    def refund(self, amount=1):
+        with self.lock:
+            self.tokens = min(self.capacity, self.tokens + amount)
+
+    def is_full(self, now):
+        '''
+        到 now 為止是否已補滿，補滿的令牌桶與新建立的相同
+        '''
+        with self.lock:
+            return self.tokens + (now - self.updated_at) * self.rate >= self.capacity
+
+# 每位使用者各自的令牌桶 (依最近使用的順序，最久未使用的在最前面) 與全域令牌桶
+user_ai_buckets = OrderedDict()
+user_ai_buckets_lock = threading.Lock()
+global_ai_bucket = TokenBucket(GLOBAL_AI_RATE_PER_MIN / 60, GLOBAL_AI_BURST)
+
+class PooledHttpClient(RequestsHttpClient):
+    '''
+    以 requests.Session 重複使用連線，每個頻道各自一個連線池
+    '''
+    def __init__(self, timeout=RequestsHttpClient.DEFAULT_TIMEOUT):
+        import requests
+
+        super().__init__(timeout)
+        self.session = requests.Session()
+
+    def request(self, method, url, timeout=None, **kwargs):
+        if timeout is None:
+            timeout = self.timeout
+        return RequestsHttpResponse(self.session.request(method, url, timeout=timeout, **kwargs))
+
+    def get(self, url, headers=None, params=None, stream=False, timeout=None):
+        return self.request('GET', url, headers=headers, params=params, stream=stream, timeout=timeout)
+
+    def post(self, url, headers=None, data=None, timeout=None):
+        return self.request('POST', url, headers=headers, data=data, timeout=timeout)
+
+    def delete(self, url, headers=None, data=None, timeout=None):
+        return self.request('DELETE', url, headers=headers, data=data, timeout=timeout)
+
+    def put(self, url, headers=None, data=None, timeout=None):
+        return self.request('PUT', url, headers=headers, data=data, timeout=timeout)
+
+class Tenant:
+    '''
+    一個 LINE 頻道：各自的用戶端、簽章驗證與 OpenAI 額度，工作佇列與快取則由所有頻道共用
+    ai_rate_per_min 為此頻道全部使用者合計的 OpenAI 額度，未設定時只受全域額度限制
+    '''
+    def __init__(self, tenant_id, token, secret, ai_rate_per_min=None, ai_burst=None,
+                 user_ai_rate_per_min=USER_AI_RATE_PER_MIN, user_ai_burst=USER_AI_BURST):
+        if ':' in tenant_id:
+            raise ValueError(f"頻道 id 不可包含冒號: {tenant_id}")
+        self.id = tenant_id
+        self.token = token
+        self.line_bot_api = LineBotApi(token, http_client=PooledHttpClient)
+        self.async_line_bot_api = None
+        self.handler = WebhookHandler(secret)
+        self.user_ai_rate = user_ai_rate_per_min / 60
+        self.user_ai_burst = user_ai_burst
+        self.ai_bucket = None
+        if ai_rate_per_min:
+            self.ai_bucket = TokenBucket(ai_rate_per_min / 60, ai_burst or ai_rate_per_min)
+
+def load_tenants():
+    '''
+    讀取頻道設定並建立各頻道的 Tenant
+    '''
+    tenants.clear()
+    if TENANTS_FILE:
+        with open(TENANTS_FILE, encoding='utf-8') as f:
+            for config in json.load(f):
+                tenant = Tenant(config.pop('id'), config.pop('token'), config.pop('secret'), **config)
+                tenants[tenant.id] = tenant
+
+    if os.getenv('LINE_TOKEN') or not tenants:
+        tenants[DEFAULT_TENANT_ID] = Tenant(DEFAULT_TENANT_ID, os.getenv('LINE_TOKEN'), os.getenv('LINE_SECRET'))
+
+def tenant_user_key(user_id, tenant_id=None):
+    '''
+    使用者狀態的鍵值：預設頻道維持原本的 user_id，其他頻道加上 "<頻道>:" 前綴
+    '''
+    if tenant_id is None:
+        tenant_id = current_tenant.get()
+    return user_id if tenant_id == DEFAULT_TENANT_ID else f"{tenant_id}:{user_id}"
+
+def split_user_key(user_key):
+    '''
+    拆回 (頻道 id, LINE user_id)
+    '''
+    tenant_id, _, user_id = user_key.rpartition(':')
+    return tenant_id, user_id
+
+# OpenAI 工作佇列 (priority, 序號, job)，序號確保同優先權時先進先出
+ai_job_queue = queue.PriorityQueue(maxsize=AI_QUEUE_SIZE)
+ai_job_sequence = itertools.count()
+ai_workers = []
+ai_workers_lock = threading.Lock()
+
+# 持久化的 AI 工作佇列 (SQLite)：設定 JOB_QUEUE_PATH 後 webhook 只把工作寫入佇列，
+# 由另外啟動的 worker 程序 (python meal_mate.py worker) 處理，失敗時延遲重試，重新啟動也不會遺失
+JOB_QUEUE_PATH = os.getenv('JOB_QUEUE_PATH')
+JOB_MAX_ATTEMPTS = int(os.getenv('JOB_MAX_ATTEMPTS', '5'))
+JOB_RETRY_BASE_SECONDS = float(os.getenv('JOB_RETRY_BASE_SECONDS', '10'))
+JOB_RETRY_MAX_SECONDS = float(os.getenv('JOB_RETRY_MAX_SECONDS', '600'))
+# worker 中斷時，處理中的工作在租約到期後重新排入
+JOB_LEASE_SECONDS = float(os.getenv('JOB_LEASE_SECONDS', '300'))
+JOB_RETENTION_SECONDS = float(os.getenv('JOB_RETENTION_SECONDS', '86400'))
+JOB_POLL_SECONDS = float(os.getenv('JOB_POLL_SECONDS', '1'))
+# webhook 程序預估等待時間所需的排隊數與實測耗時，最多每 JOB_ESTIMATE_REFRESH_SECONDS 秒查詢一次
+JOB_ESTIMATE_REFRESH_SECONDS = float(os.getenv('JOB_ESTIMATE_REFRESH_SECONDS', '1'))
+
+class DurableJobQueue:
+    '''
+    以 SQLite 儲存的工作佇列，webhook 程序與 worker 程序共用同一個檔案
+    每個執行緒使用各自的連線，認領工作時以 BEGIN IMMEDIATE 避免兩個 worker 拿到同一筆
+    worker 實測的 OpenAI 耗時也存在同一個檔案 (ai_latency)，webhook 程序由此預估等待時間
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        self.estimates_lock = threading.Lock()
+        self.cached_estimates = None
+        self.cached_at = 0.0
+        with self.connection() as conn:
+            conn.executescript('''
+                CREATE TABLE IF NOT EXISTS ai_jobs (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    user_id TEXT NOT NULL,
+                    kind TEXT NOT NULL,
+                    priority INTEGER NOT NULL,
+                    payload TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    next_run_at REAL NOT NULL,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL,
+                    last_error TEXT
+                );
+                CREATE INDEX IF NOT EXISTS ai_jobs_ready ON ai_jobs (status, priority, next_run_at);
+                CREATE INDEX IF NOT EXISTS ai_jobs_user ON ai_jobs (user_id, id);
+                CREATE TABLE IF NOT EXISTS ai_latency (
+                    kind TEXT PRIMARY KEY,
+                    seconds REAL NOT NULL,
+                    updated_at REAL NOT NULL
+                );
+            ''')
+
+    def connection(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            import sqlite3
+
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self.local.conn = conn
+        return conn
+
+    def put(self, job, priority):
+        now = time.time()
+        self.connection().execute(
+            'INSERT INTO ai_jobs (user_id, kind, priority, payload, status, next_run_at, created_at, updated_at) '
+            "VALUES (?, ?, ?, ?, 'pending', ?, ?, ?)",
+            (job['user_id'], job['kind'], priority, json.dumps(job, ensure_ascii=False), now, now, now)
+        )
+
+    def claim(self):
+        '''
+        認領一筆可執行的工作，回傳 (id, 第幾次執行, job)，沒有工作時回傳 None
+        '''
+        now = time.time()
+        conn = self.connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute(
+                "SELECT id, attempts, payload FROM ai_jobs "
+                "WHERE status IN ('pending', 'running') AND next_run_at <= ? "
+                "ORDER BY priority, next_run_at LIMIT 1",
+                (now,)
+            ).fetchone()
+            if row is not None:
+                conn.execute(
+                    "UPDATE ai_jobs SET status = 'running', attempts = attempts + 1, "
+                    "next_run_at = ?, updated_at = ? WHERE id = ?",
+                    (now + JOB_LEASE_SECONDS, now, row[0])
+                )
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        if row is None:
+            return None
+        return row[0], row[1] + 1, json.loads(row[2])
+
+    def complete(self, job_id):
+        self.connection().execute(
+            "UPDATE ai_jobs SET status = 'done', updated_at = ? WHERE id = ?", (time.time(), job_id)
+        )
+
+    def retry(self, job_id, attempts, error, job):
+        now = time.time()
+        delay = min(JOB_RETRY_MAX_SECONDS, JOB_RETRY_BASE_SECONDS * 2 ** (attempts - 1))
+        self.connection().execute(
+            "UPDATE ai_jobs SET status = 'pending', next_run_at = ?, updated_at = ?, last_error = ?, payload = ? "
+            "WHERE id = ?",
+            (now + delay, now, error, json.dumps(job, ensure_ascii=False), job_id)
+        )
+
+    def fail(self, job_id, error):
+        self.connection().execute(
+            "UPDATE ai_jobs SET status = 'failed', updated_at = ?, last_error = ? WHERE id = ?",
+            (time.time(), error, job_id)
+        )
+
+    def pending_count(self):
+        return self.connection().execute(
+            "SELECT COUNT(*) FROM ai_jobs WHERE status IN ('pending', 'running')"
+        ).fetchone()[0]
+
+    def record_latency(self, kind, seconds):
+        '''
+        以指數移動平均更新這類工作的耗時，第一次記錄時直接使用實測值
+        '''
+        self.connection().execute(
+            'INSERT INTO ai_latency (kind, seconds, updated_at) VALUES (?, ?, ?) '
+            'ON CONFLICT (kind) DO UPDATE SET seconds = seconds + ? * (excluded.seconds - seconds), '
+            'updated_at = excluded.updated_at',
+            (kind, seconds, time.time(), AI_LATENCY_SMOOTHING)
+        )
+
+    def estimates(self):
+        '''
+        回傳 (排隊中與處理中的工作數, {工作種類: 耗時})，快取 JOB_ESTIMATE_REFRESH_SECONDS 秒，
+        每個 AI 請求不需要各自查詢一次
+        '''
+        now = time.monotonic()
+        with self.estimates_lock:
+            if self.cached_estimates is None or now - self.cached_at >= JOB_ESTIMATE_REFRESH_SECONDS:
+                self.cached_estimates = (
+                    self.pending_count(),
+                    dict(self.connection().execute('SELECT kind, seconds FROM ai_latency').fetchall())
+                )
+                self.cached_at = now
+            return self.cached_estimates
+
+    def user_jobs(self, user_id, limit=5):
+        return self.connection().execute(
+            'SELECT kind, status, attempts, created_at FROM ai_jobs WHERE user_id = ? ORDER BY id DESC LIMIT ?',
+            (user_id, limit)
+        ).fetchall()
+
+    def stats(self):
+        return dict(self.connection().execute(
+            'SELECT status, COUNT(*) FROM ai_jobs GROUP BY status'
+        ).fetchall())
+
+    def purge(self, before):
+        self.connection().execute(
+            "DELETE FROM ai_jobs WHERE status IN ('done', 'failed') AND updated_at < ?", (before,)
+        )
+
+durable_job_queue = None
+
+# 重送事件去重設定 (保留時間與最多保留的事件數)
+SEEN_EVENT_WINDOW_SECONDS = float(os.getenv('SEEN_EVENT_WINDOW_SECONDS', '600'))
+SEEN_EVENT_CAPACITY = int(os.getenv('SEEN_EVENT_CAPACITY', '100000'))
+
+class SeenEvents:
+    '''
+    有時間窗口與容量上限的已處理事件集合
+    以環狀佇列記錄到達順序、雜湊集合做查詢，檢查成本 O(1) 且記憶體固定
+    傳入共享的 store (RedisKV) 時，本地沒有記錄的事件再以 SET NX EX 向共享儲存確認，
+    重送到其他實例的事件也只處理一次；本地記錄仍是重複事件的快速路徑
+    '''
+    def __init__(self, window_seconds, capacity, store=None):
+        self.window_seconds = window_seconds
+        self.capacity = capacity
+        self.store = store
+        self.order = deque()
+        self.keys = set()
+        self.lock = threading.Lock()
+
+    def check_and_add(self, key):
+        '''
+        key 已處理過時回傳 True，否則記錄下來並回傳 False
+        '''
+        now = time.monotonic()
+        with self.lock:
+            # 移除過期或超出容量的舊事件
+            while self.order and (
+                len(self.order) >= self.capacity or
+                now - self.order[0][0] > self.window_seconds
+            ):
+                _, old_key = self.order.popleft()
+                self.keys.discard(old_key)
+
+            if key in self.keys:
+                return True
+            if self.store is None:
+                self.order.append((now, key))
+                self.keys.add(key)
+                return False
+
+        # 網路往返不佔用本地的鎖；同一實例同時收到相同事件時由共享儲存決定誰先處理
+        seen = False
+        try:
+            seen = not self.store.set_if_absent(session_key('seen_event', key), '1', self.window_seconds)
+        except Exception as e:
+            print(f"Seen Event Store Error: {e}")
+
+        with self.lock:
+            if key in self.keys:
+                return True
+            self.order.append((now, key))
+            self.keys.add(key)
+        return seen
+
+seen_events = SeenEvents(
+    SEEN_EVENT_WINDOW_SECONDS, SEEN_EVENT_CAPACITY,
+    session_store if isinstance(session_store, RedisKV) else None
+)
+
+# 主動提醒設定：使用者資料與每日追蹤只在使用者固定轉送到的實例中，
+# 所以每個實例都為自己的使用者排定提醒，REMINDER_SCHEDULER=0 時停用
+REMINDER_SCHEDULER = os.getenv('REMINDER_SCHEDULER', '1') == '1'
+REMINDER_TIMES = {
+    'breakfast': os.getenv('REMINDER_BREAKFAST_TIME', '08:00'),
+    'lunch': os.getenv('REMINDER_LUNCH_TIME', '12:00'),
+    'dinner': os.getenv('REMINDER_DINNER_TIME', '18:00'),
+    'summary': os.getenv('REMINDER_SUMMARY_TIME', '21:30')
+}
+REMINDER_MEAL_NAMES = {'breakfast': '早餐', 'lunch': '午餐', 'dinner': '晚餐'}
+# 每日總結的剩餘熱量取整單位，數值相同的使用者可以合併成一次 multicast
+REMINDER_SUMMARY_ROUNDING = int(os.getenv('REMINDER_SUMMARY_ROUNDING', '50'))
+MULTICAST_MAX_RECIPIENTS = 500
+# 排程中斷後超過此秒數才處理的提醒直接略過，只排定下一次
+REMINDER_GRACE_SECONDS = int(os.getenv('REMINDER_GRACE_SECONDS', '900'))
+
+class ReminderScheduler:
+    '''
+    以分鐘分組的計時器：heap 只存放有計時器的分鐘，同一分鐘到期的使用者放在同一個集合，
+    數百萬個使用者計時器集中在少數幾個時間點時，heap 仍然很小
+    clock 可替換為假的時鐘以便測試
+    '''
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self.heap = []
+        self.buckets = {}
+        self.user_timers = {}
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+
+    def schedule(self, user_id, kind, due):
+        minute = int(due // 60)
+        with self.lock:
+            self._cancel(user_id, kind)
+            bucket = self.buckets.get(minute)
+            if bucket is None:
+                bucket = self.buckets[minute] = set()
+                heapq.heappush(self.heap, minute)
+                # 新的計時器比目前等待的更早時喚醒排程執行緒
+                if self.heap[0] == minute:
+                    self.wakeup.set()
+            bucket.add((user_id, kind))
+            self.user_timers.setdefault(user_id, {})[kind] = minute
+
+    def _cancel(self, user_id, kind):
+        timers = self.user_timers.get(user_id)
+        if not timers or kind not in timers:
+            return
+        bucket = self.buckets.get(timers.pop(kind))
+        if bucket is not None:
+            bucket.discard((user_id, kind))
+        if not timers:
+            del self.user_timers[user_id]
+
+    def cancel_user(self, user_id):
+        with self.lock:
+            for kind in list(self.user_timers.get(user_id, {})):
+                self._cancel(user_id, kind)
+
+    def pop_due(self, now=None):
+        '''
+        取出所有已到期的 (user_id, kind, 到期分鐘)
+        '''
+        current_minute = int((self.clock() if now is None else now) // 60)
+        due = []
+        with self.lock:
+            while self.heap and self.heap[0] <= current_minute:
+                minute = heapq.heappop(self.heap)
+                for user_id, kind in self.buckets.pop(minute, ()):
+                    timers = self.user_timers.get(user_id)
+                    if timers and timers.get(kind) == minute:
+                        del timers[kind]
+                        if not timers:
+                            del self.user_timers[user_id]
+                    due.append((user_id, kind, minute))
+        return due
+
+    def seconds_until_next(self):
+        with self.lock:
+            if not self.heap:
+                return None
+            return max(0, self.heap[0] * 60 - self.clock())
+
+reminder_scheduler = ReminderScheduler()
+
+# reply token 的有效時間 (秒)，保守估計以免送出時已失效
+REPLY_TOKEN_TTL_SECONDS = float(os.getenv('REPLY_TOKEN_TTL_SECONDS', '50'))
+
+# 各類 OpenAI 工作的預估耗時 (秒)，以指數移動平均持續更新
+ai_latency_estimates = {
+    'diet_plan': 15.0,
+    'image': 20.0
+}
+AI_LATENCY_SMOOTHING = 0.2
+
+# 執行統計
+metrics = Counter()
+metrics_lock = threading.Lock()
+
+def session_key(kind, user_id=None):
+    if user_id is None:
+        return f"{SESSION_KEY_PREFIX}:{kind}"
+    return f"{SESSION_KEY_PREFIX}:{kind}:{user_id}"
+
+def dump_session_value(value):
+    # 固定排序，讓相同內容序列化後的字串一致，才能做 compare-and-set
+    return json.dumps(value, ensure_ascii=False, sort_keys=True)
+
+def load_session(user_id, message_text=None):
+    '''
+    一次讀取 webhook 所需的共享狀態 (設定階段、飲食建議流程、是否跳過訊息)
+    '''
+    commands = [
+        ('get', session_key('setup_stage', user_id)),
+        ('get', session_key('diet_flow', user_id))
+    ]
+    if message_text is not None:
+        commands.append(('srem', session_key('skip_text'), message_text))
+
+    results = session_store.execute_batch(commands)
     return {
-        'total_calories': daily_calories,
-        'consumed_calories': 0,
-        'food_log': [],
-        'date': date.today()
+        'setup_stage': results[0],
+        'diet_flow': json.loads(results[1]) if results[1] else None,
+        'skip': message_text is not None and bool(results[2])
     }
 
-# 新增食物記錄
-def add_food_log(user_id, food_name, calories):
-    today = date.today()
-    daily_tracker = user_profiles[user_id]['daily_tracker']
-    
-    # 如果是新的一天，重新初始化
-    if daily_tracker['date'] != today:
-        daily_tracker = initialize_daily_tracker(user_profiles[user_id]['daily_calories'])
-    
-    # 檢查是否超過每日熱量
-    if daily_tracker['consumed_calories'] + calories > daily_tracker['total_calories']:
-        return False
-    
-    daily_tracker['consumed_calories'] += calories
-    daily_tracker['food_log'].append({
-        'name': food_name,
-        'calories': calories,
-        'time': datetime.now().strftime("%H:%M")
-    })
-    
+def set_setup_stage(user_id, stage):
+    commit_event(EVENT_SETUP_STAGE, user_id, stage)
+
+def add_skip_text(text):
+    '''
+    跳過系統產生的提示訊息
+    '''
+    session_store.sadd(session_key('skip_text'), text)
+
+def get_diet_flow(user_id):
+    value = session_store.get(session_key('diet_flow', user_id))
+    return json.loads(value) if value else None
+
+def save_diet_flow(user_id, flow_state, expected_flow_state):
+    '''
+    只有在流程狀態未被其他請求修改時才寫入，成功回傳 True
+    '''
+    expected = None if expected_flow_state is None else dump_session_value(expected_flow_state)
+    value = dump_session_value(flow_state)
+    with state_lock:
+        if not session_store.compare_and_set(session_key('diet_flow', user_id), expected, value):
+            return False
+        record_event(EVENT_DIET_FLOW, user_id, value)
     return True
 
-def remove_food_log(user_id, food_name):
-    daily_tracker = user_profiles[user_id]['daily_tracker']
-    
-    # 移除食物記錄
-    for food in daily_tracker['food_log']:
-        if food['name'] == food_name:
-            daily_tracker['consumed_calories'] -= food['calories']
-            daily_tracker['food_log'].remove(food)
+def event_dedup_key(event):
+    '''
+    以 webhookEventId 辨識事件，舊版事件沒有時改用訊息 ID
+    '''
+    webhook_event_id = getattr(event, 'webhook_event_id', None)
+    if webhook_event_id:
+        return webhook_event_id
+
+    message = getattr(event, 'message', None)
+    if message is not None and getattr(message, 'id', None):
+        return f"message:{message.id}"
+    return None
+
+def skip_redelivered(func):
+    '''
+    LINE 因回應過慢而重送的事件只處理一次，避免重複記錄熱量或重複呼叫 OpenAI
+    同步與非同步 (ASGI 模式) 的事件處理函數都可以使用
+    '''
+    def redelivered(event):
+        key = event_dedup_key(event)
+        if key is not None and seen_events.check_and_add(key):
+            print(f"略過重複的事件: {key}")
             return True
-    
-    return False
+        return False
 
-def generate_diet_plan(selection_prompt):
-    openai.api_key = os.getenv('OPENAI_API_KEY')
+    if inspect.iscoroutinefunction(func):
+        @wraps(func)
+        async def async_wrapper(event):
+            if redelivered(event):
+                return
+            return await func(event)
+        return async_wrapper
 
-    try:
-        response = openai.ChatCompletion.create(
-            model="gpt-4o",
-            messages = [
-                {"role": "system", 
-                  "content": """你是一位營養師，為客戶設計繁體中文飲食菜單，
-                    菜單的總熱量需滿足客戶所述的需求熱量，熱量範圍可以在需求熱量正負10%以內。
-                    根據客戶的需求嚴格按照以下格式提供飲食建議：
-                    <早餐/午餐/晚餐/點心/宵夜>:
-                    -<食物名稱><數量/單位>:<食物熱量>大卡
-                    -<食物名稱><數量/單位>:<食物熱量>大卡
-                    ... 
-                    總熱量:<總熱量>大卡
-                    ...
-                    菜單總熱量:<總熱量>大卡
-                    針對菜單的營養價值做簡短描述。"""},
-                {"role": "user", "content": selection_prompt}
-                ], 
-            temperature = 0.7,
-            top_p = 0.2,
-            stream = False,
-        )
+    @wraps(func)
+    def wrapper(event):
+        if redelivered(event):
+            return
+        return func(event)
+    return wrapper
 
-    except Exception as e:
-        print(f"OpenAI API Error: {e}")
-        return f"目前無法生成飲食建議，請稍後再試。"
+def apply_food_entry(profile, food_name, calories, timestamp):
+    daily_tracker = profile.daily_tracker
+    daily_tracker.consumed_calories += calories
+    daily_tracker.food_log.append(FoodEntry(food_name, calories, timestamp))
+    if profile.diet_history is None:
+        profile.diet_history = DietHistory()
+    profile.diet_history.add(daily_tracker.day, food_name, calories)
+
+def apply_event(op, user_id, args, profiles=None, session=None):
+    '''
+    套用一筆狀態變更，線上請求與重播事件記錄共用
+    建立快照時傳入快照自己的 profiles 與 session，不影響線上狀態
+    '''
+    if profiles is None:
+        profiles, session = user_profiles, session_store
+        if op not in (EVENT_SETUP_STAGE, EVENT_DIET_FLOW):
+            status_cache.pop(user_id, None)
+            diet_summary_cache.pop(user_id, None)
 
-    return response.choices[0].message.content
+    if op == EVENT_PROFILE_NEW:
+        profiles[user_id] = UserProfile()
+    elif op == EVENT_PROFILE_SET:
+        field_name, value = args
+        setattr(profiles[user_id], field_name, value)
+    elif op == EVENT_TRACKER_RESET:
+        total_calories, day = args
+        profiles[user_id].daily_tracker = DailyTracker(total_calories=total_calories, day=day)
+    elif op == EVENT_TRACKER_TOTAL:
+        profiles[user_id].daily_tracker.total_calories = args[0]
+    elif op == EVENT_FOOD_ADD:
+        food_name, calories, timestamp = args
+        apply_food_entry(profiles[user_id], food_name, calories, timestamp)
+    elif op == EVENT_FOOD_BATCH:
+        timestamp, *foods = args
+        profile = profiles[user_id]
+        for index in range(0, len(foods), 2):
+            apply_food_entry(profile, foods[index], foods[index + 1], timestamp)
+    elif op == EVENT_HISTORY_ADD:
+        # 匯入的過去日期記錄只加入每日彙總，不影響今日追蹤
+        day, food_name, calories = args
+        profile = profiles[user_id]
+        if profile.diet_history is None:
+            profile.diet_history = DietHistory()
+        profile.diet_history.add(day, food_name, calories)
+    elif op == EVENT_FOOD_REMOVE:
+        profile = profiles[user_id]
+        daily_tracker = profile.daily_tracker
+        for food in daily_tracker.food_log:
+            if food.name == args[0]:
+                daily_tracker.consumed_calories -= food.calories
+                daily_tracker.food_log.remove(food)
+                if profile.diet_history is not None:
+                    profile.diet_history.remove(daily_tracker.day, food.name, food.calories)
+                break
+    elif op == EVENT_SETUP_STAGE:
+        session.set(session_key('setup_stage', user_id), args[0])
+    elif op == EVENT_DIET_FLOW:
+        session.set(session_key('diet_flow', user_id), args[0])
+    elif op == EVENT_WEIGHT:
+        weight, timestamp = args
+        profile = profiles[user_id]
+        if profile.weight_trend is None:
+            profile.weight_trend = WeightTrend()
+        profile.weight = weight
+        profile.weight_trend.update(weight, timestamp)
 
-def start_diet_suggestion_flow(user_id):
+def record_event(op, user_id, *args):
+    if event_log is None:
+        return
+    # 共享儲存 (Redis) 的流程狀態由 Redis 自行保存，不寫入本地記錄
+    if op in (EVENT_SETUP_STAGE, EVENT_DIET_FLOW) and not isinstance(session_store, InMemoryKV):
+        return
+    event_log.append(op, user_id, args)
+
+def commit_event(op, user_id, *args):
     '''
-    初始化飲食建議流程
+    套用狀態變更並寫入事件記錄
     '''
-    user_diet_suggestion_flow[user_id] = {
-        'stage': 'meal_type',
-        'selections': {}
-    }
+    with state_lock:
+        apply_event(op, user_id, args)
+        record_event(op, user_id, *args)
 
-    # 用餐方式
-    meal_type_template = CarouselTemplate(
-        columns = [
-            CarouselColumn(
-                title='用餐方式',
-                text='選擇用餐方式',
-                actions=[
-                    PostbackTemplateAction(label='外食', text='外食', data='meal_type_外食'),
-                    PostbackTemplateAction(label='自行烹調', text='自行烹調', data='meal_type_自行烹調')
-                ]
-            )
-        ]
-    )
+def create_profile(user_id):
+    commit_event(EVENT_PROFILE_NEW, user_id)
 
-    template_message = TemplateSendMessage(
-        alt_text='選擇用餐方式',
-        template=meal_type_template
-    )
-    
-    return template_message
+def ensure_profile(user_id):
+    if user_id not in user_profiles:
+        create_profile(user_id)
 
+def update_profile(user_id, field_name, value):
+    commit_event(EVENT_PROFILE_SET, user_id, field_name, value)
 
-def handle_diet_suggestion_flow(event, user_id, postback_data):
-    """
-    處理飲食建議流程的各個階段
-    """
-    if user_id not in user_diet_suggestion_flow:
-        user_diet_suggestion_flow[user_id] = {
-            'stage': 'meal_type',
-            'selections': {}
-        }
+def record_weight(user_id, weight):
+    '''
+    記錄一次體重，同時更新個人資料的體重與趨勢
+    '''
+    commit_event(EVENT_WEIGHT, user_id, weight, int(time.time()))
 
-    flow_state = user_diet_suggestion_flow.get(user_id, {})
-    
-    if flow_state.get('stage') == 'meal_type':
-        # 用餐方式選擇
-        flow_state['selections']['meal_type'] = postback_data.split('_')[-1]
-        flow_state['stage'] = 'cuisine_style'
-        
-        # 餐點風格選擇
-        cuisine_template = CarouselTemplate(columns=[
-            CarouselColumn(
-                thumbnail_image_url='https://i.pinimg.com/736x/d3/42/1f/d3421fedf1f7648ca7c7f1879c397c4b.jpg',
-                title='美式料理',
-                text='如:漢堡、薯條、炸雞等',
-                actions=[PostbackTemplateAction(label='選擇', text='美式', data='cuisine_美式')]
-            ),
-            CarouselColumn(
-                thumbnail_image_url='https://i.pinimg.com/736x/ac/a8/f8/aca8f8463de190748b4505cdacce48eb.jpg',
-                title='日式料理',
-                text='如:壽司、拉麵、刺身等',
-                actions=[PostbackTemplateAction(label='選擇', text='日式', data='cuisine_日式')]
-            ),
-            CarouselColumn(
-                thumbnail_image_url='https://i.pinimg.com/736x/b4/62/b2/b462b28ecef0582be9f82ccb73371eaa.jpg',
-                title='中式料理',
-                text='如:炒飯、麵食、蛤蠣絲瓜等',
-                actions=[PostbackTemplateAction(label='選擇', text='中式', data='cuisine_中式')]
-            ),
-            CarouselColumn(
-                thumbnail_image_url='https://i.pinimg.com/736x/6b/8a/6e/6b8a6e33f4d5923047a04a09e29b8289.jpg',
-                title='義式料理',
-                text='如:義大利麵、披薩、焗烤等',
-                actions=[PostbackTemplateAction(label='選擇', text='義式', data='cuisine_義式')]
-            ),
-            CarouselColumn(
-                thumbnail_image_url='https://i.pinimg.com/736x/fd/ed/ea/fdedea6e3c56c7ec485b09b30fa8f816.jpg',
-                title='韓式料理',
-                text='如:泡菜、烤肉、石鍋拌飯等',
-                actions=[PostbackTemplateAction(label='選擇', text='韓式', data='cuisine_韓式')]
-            ),
-            CarouselColumn(
-                thumbnail_image_url='https://i.pinimg.com/736x/67/28/2f/67282ff1cecfd27c047e090813f221b4.jpg',
-                title='泰式料理',
-                text='如:打拋豬、綠咖哩、椒麻雞等',
-                actions=[PostbackTemplateAction(label='選擇', text='泰式', data='cuisine_泰式')]
-            )
-        ])
-        
-        template_message = TemplateSendMessage(
-            alt_text='選擇餐點風格',
-            template=cuisine_template
-        )
-        
-        return template_message
-    
-    elif flow_state.get('stage') == 'cuisine_style':
-        # 餐點風格選擇
-        flow_state['selections']['cuisine_style'] = postback_data.split('_')[-1]
-        flow_state['stage'] = 'diet_requirement'
-        
-        # 飲食需求選擇
-        requirement_template = CarouselTemplate(columns=[
-            CarouselColumn(
-                thumbnail_image_url='https://i.pinimg.com/736x/d4/0f/a4/d40fa452569e889d0b80502560212bfd.jpg',
-                title='減重飲食',
-                text='例如少油少鹽的清淡飲食',
-                actions=[PostbackTemplateAction(label='選擇', text='減重', data='requirement_減重')]
-            ),
-            CarouselColumn(
-                thumbnail_image_url='https://i.pinimg.com/736x/86/52/5c/86525c07fd58a8cc170ef4079a3a9bc9.jpg',
-                title='高蛋白飲食',
-                text='富含豐富蛋白質，適合增肌時期或運動後的人',
-                actions=[PostbackTemplateAction(label='選擇', text='高蛋白', data='requirement_高蛋白')]
-            ),
-            CarouselColumn(
-                thumbnail_image_url='https://i.pinimg.com/736x/c0/56/b7/c056b77c2c472ca12aee47211ea10ab4.jpg',
-                title='均衡飲食',
-                text='各類食物均衡攝取',
-                actions=[PostbackTemplateAction(label='選擇', text='均衡', data='requirement_均衡')]
-            ),
-            CarouselColumn(
-                thumbnail_image_url='https://i.pinimg.com/736x/1c/3c/1b/1c3c1b4b3604b307a99474e52d8a201e.jpg',
-                title='素食飲食',
-                text='適合素食者，不含葷食',
-                actions=[PostbackTemplateAction(label='選擇', text='素食', data='requirement_素食')]
-            ),
-            CarouselColumn(
-                thumbnail_image_url='https://img.shoplineapp.com/media/image_clips/668b7145948b3100167dac7a/original.jpg?1720414532',
-                title='無麩質飲食',
-                text='適合麩質過敏者，不含小麥、大麥、麥麩等',
-                actions=[PostbackTemplateAction(label='選擇', text='無麩質', data='requirement_無麩質')]
-            )
-        ])
-        
-        template_message = TemplateSendMessage(
-            alt_text='選擇飲食需求',
-            template=requirement_template
+def calories_weight(profile):
+    '''
+    計算每日熱量使用的體重
+    '''
+    if WEIGHT_SMOOTHED_CALORIES and profile.weight_trend is not None:
+        return round(profile.weight_trend.level, 1)
+    return profile.weight
+
+def format_weight_trend(profile):
+    '''
+    體重趨勢指令的回覆，直接使用已計算好的平滑值與斜率
+    '''
+    trend = profile.weight_trend
+    if trend is None or not trend.history:
+        return "目前沒有體重記錄，請使用「編輯 體重 <重量>」記錄體重"
+
+    last_time = datetime.fromtimestamp(trend.last_timestamp).strftime('%m/%d %H:%M')
+    lines = [
+        "⚖️ 體重趨勢:",
+        f"最近一次記錄: {profile.weight} 公斤 ({last_time})",
+        f"平滑後體重: {round(trend.level, 1)} 公斤",
+        f"記錄次數: {len(trend.history)} 次"
+    ]
+    if len(trend.history) > 1:
+        weekly_change = trend.weekly_change
+        direction = "上升" if weekly_change > 0.05 else "下降" if weekly_change < -0.05 else "持平"
+        lines.append(f"每週變化: {weekly_change:+.2f} 公斤 ({direction})")
+        lines.append(f"四週後預估: {round(trend.level + weekly_change * 4, 1)} 公斤")
+    return "\n".join(lines)
+
+def update_total_calories(user_id, total_calories):
+    commit_event(EVENT_TRACKER_TOTAL, user_id, total_calories)
+
+def encode_profile(profile):
+    '''
+    將使用者資料轉成只含基本型別的 tuple，marshal 序列化與還原都比逐物件 pickle 快
+    '''
+    tracker = profile.daily_tracker
+    trend = profile.weight_trend
+    history = profile.diet_history
+    return (
+        profile.goal, profile.gender, profile.age, profile.height, profile.weight,
+        profile.activity_level, profile.reminders_enabled,
+        None if tracker is None else (
+            tracker.total_calories, tracker.consumed_calories, tracker.day,
+            [(food.name, food.calories, food.timestamp) for food in tracker.food_log]
+        ),
+        None if trend is None else (
+            trend.level, trend.slope, trend.last_timestamp,
+            [(entry.weight, entry.timestamp) for entry in trend.history]
+        ),
+        None if history is None else [
+            (day, summary.calories, dict(summary.foods)) for day, summary in history.days.items()
+        ]
+    )
+
+def decode_profile(record):
+    goal, gender, age, height, weight, activity_level, reminders_enabled, tracker, trend, history = record
+    profile = UserProfile(
+        goal=goal, gender=gender, age=age, height=height, weight=weight,
+        activity_level=activity_level, reminders_enabled=reminders_enabled
+    )
+    if tracker is not None:
+        total_calories, consumed_calories, day, foods = tracker
+        profile.daily_tracker = DailyTracker(
+            total_calories, consumed_calories, [FoodEntry(*food) for food in foods], day
         )
+    if trend is not None:
+        level, slope, last_timestamp, entries = trend
+        profile.weight_trend = WeightTrend(level, slope, last_timestamp, [WeightEntry(*entry) for entry in entries])
+    if history is not None:
+        profile.diet_history = DietHistory({
+            day: DaySummary(calories, Counter(foods)) for day, calories, foods in history
+        })
+    return profile
+
+class SnapshotProfiles(dict):
+    '''
+    建立快照時使用的使用者資料：第一次存取時才還原成 UserProfile，
+    沒有新事件的使用者直接沿用上一個快照的編碼
+    '''
+    def __init__(self, records):
+        super().__init__()
+        self.records = records
+
+    def __missing__(self, user_id):
+        profile = self[user_id] = decode_profile(self.records[user_id])
+        return profile
+
+    def encoded(self):
+        records = dict(self.records)
+        for user_id, profile in self.items():
+            records[user_id] = encode_profile(profile)
+        return records
+
+def read_snapshot(path):
+    '''
+    讀取快照 (memory-map)，回傳 (第一個未涵蓋的記錄段, 編碼後的使用者資料, 鍵值儲存內容)
+    沒有快照時回傳 (0, {}, None)
+    '''
+    if not os.path.exists(path):
+        return 0, {}, None
+
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        magic, first_segment = SNAPSHOT_HEADER.unpack_from(mm, 0)
+        with memoryview(mm) as view:
+            if magic == SNAPSHOT_MAGIC:
+                snapshot = marshal.loads(view[SNAPSHOT_HEADER.size:])
+                return first_segment, snapshot['user_profiles'], snapshot['session']
+            if magic != SNAPSHOT_MAGIC_PICKLE:
+                raise ValueError(f"無法辨識的快照檔案: {path}")
+            import pickle
+            snapshot = pickle.loads(view[SNAPSHOT_HEADER.size:])
+
+    # 舊版快照沒有的欄位補上預設值
+    for profile in snapshot['user_profiles'].values():
+        for profile_field in fields(UserProfile):
+            if not hasattr(profile, profile_field.name):
+                setattr(profile, profile_field.name, profile_field.default)
+    records = {user_id: encode_profile(profile) for user_id, profile in snapshot['user_profiles'].items()}
+    return first_segment, records, snapshot['session']
+
+def pause_gc():
+    '''
+    大量建立物件 (還原或建立快照) 時暫停循環垃圾回收，否則每建立數百個物件就會觸發一次，
+    越到後面掃描的物件越多；回傳原本是否啟用，供 resume_gc 還原
+    '''
+    enabled = gc.isenabled()
+    gc.disable()
+    return enabled
+
+def resume_gc(enabled):
+    if enabled:
+        gc.enable()
+
+def write_snapshot():
+    '''
+    建立快照：只在切換記錄段時短暫持有 state_lock，之後在背景以上一個快照加上已關閉的記錄段重建狀態，
+    不讀取線上的 user_profiles，處理 webhook 的執行緒不需要等待序列化
+    完成後刪除已涵蓋的舊記錄段
+    '''
+    try:
+        with state_lock:
+            segment = event_log.rotate()
+
+        gc_enabled = pause_gc()
+        try:
+            first_segment, records, session_data = read_snapshot(event_log.snapshot_path())
+            profiles = SnapshotProfiles(records)
+            session = InMemoryKV()
+            session.data = session_data or {}
+            for old_segment in event_log.segments():
+                if first_segment <= old_segment < segment:
+                    for op, user_id, args in read_event_segment(event_log.segment_path(old_segment)):
+                        apply_event(op, user_id, args, profiles, session)
+
+            # 共享儲存 (Redis) 的流程狀態不在記錄中；跳過提示訊息的文字只保留幾秒，不寫入快照
+            session_data = None
+            if isinstance(session_store, InMemoryKV):
+                session_data = {key: value for key, value in session.data.items() if not isinstance(value, set)}
+            data = marshal.dumps({'user_profiles': profiles.encoded(), 'session': session_data})
+            del profiles, records
+        finally:
+            resume_gc(gc_enabled)
+
+        path = event_log.snapshot_path()
+        with open(path + '.tmp', 'wb') as f:
+            f.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, segment))
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + '.tmp', path)
+
+        for old_segment in event_log.segments():
+            if old_segment < segment:
+                os.remove(event_log.segment_path(old_segment))
+    except Exception as e:
+        print(f"Snapshot Error: {e}")
+    finally:
+        event_log.snapshotting = False
+
+def open_event_log(directory):
+    '''
+    從快照與其後的記錄段還原狀態，並開始寫入新的記錄段
+    '''
+    global event_log, user_profiles
+
+    log = EventLog(directory, EVENT_LOG_FSYNC_INTERVAL, EVENT_LOG_SNAPSHOT_EVERY)
+    gc_enabled = pause_gc()
+    try:
+        first_segment, records, session_data = read_snapshot(log.snapshot_path())
+        if records:
+            user_profiles = {user_id: decode_profile(record) for user_id, record in records.items()}
+            del records
+        if session_data is not None and isinstance(session_store, InMemoryKV):
+            session_store.data = session_data
+
+        replayed = 0
+        segments = [segment for segment in log.segments() if segment >= first_segment]
+        for segment in segments:
+            for op, user_id, args in read_event_segment(log.segment_path(segment)):
+                apply_event(op, user_id, args)
+                replayed += 1
+    finally:
+        resume_gc(gc_enabled)
+    # 還原的使用者資料沒有循環參照，移出垃圾回收的追蹤範圍，之後的完整回收不需要再掃描
+    gc.freeze()
+
+    # 從新的記錄段開始寫入，避免接在損毀的記錄之後
+    log.events_since_snapshot = replayed
+    log.start(max(segments, default=first_segment) + 1)
+    event_log = log
+    print(f"已從事件記錄還原 {len(user_profiles)} 位使用者 (重播 {replayed} 筆事件)", file=sys.stderr)
+
+# 初始化函數
+def initialize_daily_tracker(daily_calories):
+    return DailyTracker(total_calories=daily_calories)
+
+def reset_daily_tracker(user_id, daily_calories):
+    commit_event(EVENT_TRACKER_RESET, user_id, daily_calories, date.today().toordinal())
+
+# 新增食物記錄
+def add_food_log(user_id, food_name, calories):
+    return add_food_logs(user_id, [(food_name, calories)])
+
+def add_food_logs(user_id, items):
+    '''
+    一次新增多筆食物記錄，合計超過每日熱量時全部不記錄
+    items 為 (食物名稱, 熱量) 的 list
+    '''
+    with state_lock:
+        daily_tracker = user_profiles[user_id].daily_tracker
         
-        return template_message
-    
-    elif flow_state.get('stage') == 'diet_requirement':
-        # 飲食需求選擇
-        flow_state['selections']['diet_requirement'] = postback_data.split('_')[-1]
-        flow_state['stage'] = 'meal_time'
-        
-        # 用餐時間選擇
-        meal_time_template = CarouselTemplate(columns=[
-            CarouselColumn(
-                thumbnail_image_url='https://i.pinimg.com/736x/c3/8c/4c/c38c4c218cbf7dacf09d6aacd9a6c3ef.jpg',
-                title='早餐',
-                text='選擇早餐菜單',
-                actions=[PostbackTemplateAction(label='選擇', text='早餐', data='meal_time_早餐')]
-            ),
-            CarouselColumn(
-                thumbnail_image_url='https://i.pinimg.com/736x/57/58/6f/57586f877369922c24ccf770e5a1e665.jpg',
-                title='午餐',
-                text='選擇午餐菜單',
-                actions=[PostbackTemplateAction(label='選擇', text='午餐', data='meal_time_午餐')]
-            ),
-            CarouselColumn(
-                thumbnail_image_url='https://i.pinimg.com/736x/f3/4a/2c/f34a2c2aef5c82f1549bb6ae52579aaf.jpg',
-                title='晚餐',
-                text='選擇晚餐菜單',
-                actions=[PostbackTemplateAction(label='選擇', text='晚餐', data='meal_time_晚餐')]
-            ),
-            CarouselColumn(
-                thumbnail_image_url='https://i.pinimg.com/736x/3e/70/1a/3e701a24d91eeee687e4a7798a6dc702.jpg',
-                title='點心',
-                text='選擇點心菜單',
-                actions=[PostbackTemplateAction(label='選擇', text='點心', data='meal_time_點心')]
-            ),
-            CarouselColumn(
-                thumbnail_image_url='https://i.pinimg.com/736x/66/5f/c5/665fc5e4e0f24744369a445215e3fb7c.jpg',
-                title='宵夜',
-                text='選擇宵夜菜單',
-                actions=[PostbackTemplateAction(label='選擇', text='宵夜', data='meal_time_宵夜')]
-            ),
-            CarouselColumn(
-                thumbnail_image_url='https://i.pinimg.com/736x/50/48/7f/50487fadf6c16916442f8e3846c22e0f.jpg',
-                title='一日菜單',
-                text='選擇一日菜單',
-                actions=[PostbackTemplateAction(label='選擇', text='一日菜單', data='meal_time_一日菜單')]
-            )
-        ])
-        
-        template_message = TemplateSendMessage(
-            alt_text='選擇用餐時間',
-            template=meal_time_template
-        )
+        # 如果是新的一天，重新初始化
+        if daily_tracker.day != date.today().toordinal():
+            reset_daily_tracker(user_id, daily_tracker.total_calories)
+            daily_tracker = user_profiles[user_id].daily_tracker
         
-        return template_message
-    
-    elif flow_state.get('stage') == 'meal_time':
-        # 用餐時間選擇
-        flow_state['selections']['meal_time'] = postback_data.split('_')[-1]
+        # 檢查是否超過每日熱量
+        if daily_tracker.consumed_calories + sum(calories for _, calories in items) > daily_tracker.total_calories:
+            return False
         
-        # 如果不是一日菜單，要求輸入熱量
-        if flow_state['selections']['meal_time'] != '一日菜單':
-            flow_state['stage'] = 'calories'
-            return TextSendMessage(text="請輸入您預計攝取的熱量(大卡)")
+        timestamp = int(time.time())
+        if len(items) == 1:
+            food_name, calories = items[0]
+            commit_event(EVENT_FOOD_ADD, user_id, food_name, calories, timestamp)
         else:
-            flow_state['stage'] = 'additional_requirements'
-            return TextSendMessage(text="請輸入其他特殊飲食需求(無特殊需求請輸入「無」)")
-    
-    elif flow_state.get('stage') == 'calories':
-        # 熱量輸入
-        try:
-            calories = float(event.message.text)
-            flow_state['selections']['calories'] = calories
-            flow_state['stage'] = 'additional_requirements'
-            return TextSendMessage(text="請輸入其他特殊飲食需求(無特殊需求請輸入「無」)")
-        except ValueError:
-            return TextSendMessage(text="請輸入有效的數字！")
+            # 多筆記錄寫成同一筆事件，記錄檔結尾損毀時重播全部或全部不重播
+            commit_event(EVENT_FOOD_BATCH, user_id, timestamp, *itertools.chain.from_iterable(items))
     
-    elif flow_state.get('stage') == 'additional_requirements':
-        # 其他特殊需求
-        flow_state['selections']['additional_requirements'] = event.message.text
-        flow_state['stage'] = 'complete'
-        
-        # 準備OpenAI API調用的提示詞
-        selections = flow_state['selections']
-        prompt = (
-            f"請為一位想要{selections['diet_requirement']}的客戶"
-            f"提供一份{selections['meal_time']}的{selections['cuisine_style']}風格菜單。"
-            f"飲食方式為{selections['meal_type']}，"
-        )
-        
-        if selections['meal_time'] != '一日菜單':
-            prompt += f"客戶需求攝取熱量為{selections['calories']}大卡"
-        else:
-            prompt += f"客戶需求攝取熱量為{user_profiles[user_id]['daily_tracker']['total_calories']}大卡"
-        
-        prompt += f"其他特殊需求：{selections['additional_requirements']}。"
-        prompt += f"需要付上每一項餐點的熱量，並於最後告知這份菜單的總熱量。"
+    return True
 
-        
-        
-        # 呼叫OpenAI API生成飲食建議
-        try:
-            line_bot_api.push_message(
-                user_id,
-                TextSendMessage(text="🔄正在生成飲食建議，請稍後...")
-            )
-            diet_plan = generate_diet_plan(prompt)
-            return TextSendMessage(text=diet_plan)
-        except Exception as e:
-            return TextSendMessage(text="❌無法生成飲食建議，請稍後再試。")
+# 新增記錄的解析規則，例如「白飯 280 雞腿 350kcal」「雞蛋 2顆 140大卡」「茶葉蛋 75 x2」
+# 先以空白與分隔符號切成詞，數字只有單獨一個詞或帶有熱量單位 (kcal/千卡/大卡/卡) 時才是熱量，
+# 與名稱相連的數字屬於名稱，例如「7-11飯糰 300」「麥當勞1號餐 800」「雞蛋 2顆 140」
+# 與數字之間有空白的熱量單位需單獨一個詞，避免「350 卡拉雞腿堡」被當成單位；x2 則將熱量乘上倍數
+# 單獨的數字後面接著量詞時是數量，例如「雞蛋 2 顆 140」「牛奶 250 毫升 150」；
+# 後面接著其他名稱的小整數 (FOOD_LOG_MAX_COUNT 以下) 分不出是數量還是熱量，例如「蘋果 2 香蕉 200」，要求加上單位
+FOOD_LOG_TOKEN = re.compile(r'[,，、;；+＋]|[^\s,，、;；+＋]+')
+FOOD_LOG_SEPARATORS = ',，、;；+＋'
+FOOD_LOG_UNITS = ('kcal', '千卡', '大卡', '卡')
+FOOD_LOG_NUMBER = re.compile(r'\d+(?:\.\d+)?')
+FOOD_LOG_ENERGY = re.compile(
+    r'(?P<calories>\d+(?:\.\d+)?)(?:kcal|千卡|大卡|卡)?(?:[x×*](?P<count>\d+(?:\.\d+)?))?',
+    re.IGNORECASE
+)
+FOOD_LOG_NAMED_ENERGY = re.compile(
+    r'(?P<name>.*\D)(?P<calories>\d+(?:\.\d+)?)(?:kcal|千卡|大卡|卡)(?:[x×*](?P<count>\d+(?:\.\d+)?))?',
+    re.IGNORECASE
+)
+FOOD_LOG_MULTIPLIER = re.compile(r'[x×*](?P<count>\d+(?:\.\d+)?)', re.IGNORECASE)
+FOOD_LOG_QUANTITY_UNITS = frozenset((
+    '個', '顆', '粒', '片', '條', '根', '塊', '碗', '杯', '盤', '份', '包', '瓶', '罐', '盒',
+    '串', '支', '隻', '張', '球', '捲', '匙', '湯匙', '茶匙', '克', '公克', 'g', '毫升', 'ml', 'cc'
+))
+FOOD_LOG_MAX_COUNT = 10
+FOOD_LOG_MAX_ITEMS = min(int(os.getenv('FOOD_LOG_MAX_ITEMS', '20')), EVENT_FOOD_BATCH_MAX_ITEMS)
 
+def parse_food_log(text):
+    '''
+    將新增記錄後面的文字解析為 [(食物名稱, 熱量), ...]，格式錯誤時拋出 ValueError
+    名稱可以包含空白，遇到熱量時結束一項
+    '''
+    items = []
+    name_parts = []
+    tokens = FOOD_LOG_TOKEN.findall(text)
+    previous = None
+    index = 0
+    while index < len(tokens):
+        token = tokens[index]
+        index += 1
 
-# 驗證編輯的輸入是否合法
-def validate_edit_input(user_id, item, new_value):
-    """
-    驗證編輯的輸入是否合法
-    """    
-    try:
-        if item == '目標':
-            goal_map = {'1': '增肌', '2': '減重', '3': '維持體重'}
-            if new_value in goal_map:
-                return goal_map[new_value]
-            return None
+        if token in FOOD_LOG_SEPARATORS:
+            if name_parts:
+                raise ValueError(f"{' '.join(name_parts)} 缺少熱量")
+            previous = 'separator'
+            continue
+
+        # 負號不併入名稱，例如「白飯 -280」
+        if token[0] == '-' and (len(token) == 1 or token[1].isdigit()):
+            raise ValueError(f"{token} 不是合理的熱量")
+
+        # 「350 大卡」中單獨的單位
+        if previous == 'energy' and token.lower() in FOOD_LOG_UNITS:
+            continue
+
+        # 「x 2」與「x2」相同
+        if token.lower() in ('x', '×', '*') and index < len(tokens) and FOOD_LOG_NUMBER.fullmatch(tokens[index]):
+            token += tokens[index]
+            index += 1
+
+        multiplier = FOOD_LOG_MULTIPLIER.fullmatch(token)
+        if multiplier:
+            if name_parts or not items:
+                raise ValueError(f"{token} 需要放在熱量後面")
+            items[-1][0] += f" x{multiplier.group('count')}"
+            items[-1][1] *= float(multiplier.group('count'))
+            previous = 'multiplier'
+            continue
+
+        if FOOD_LOG_NUMBER.fullmatch(token) and index < len(tokens):
+            following = tokens[index].lower()
+            if following in FOOD_LOG_QUANTITY_UNITS:
+                name_parts += [token, tokens[index]]
+                index += 1
+                previous = 'word'
+                continue
+            if (float(token).is_integer() and float(token) <= FOOD_LOG_MAX_COUNT
+                    and following not in FOOD_LOG_SEPARATORS and following not in FOOD_LOG_UNITS
+                    and following not in ('x', '×', '*') and not FOOD_LOG_MULTIPLIER.fullmatch(following)):
+                raise ValueError(f"無法判斷 {token} 是數量還是熱量，請加上單位，例如「{token}個」或「{token}大卡」")
+
+        energy = FOOD_LOG_ENERGY.fullmatch(token) or FOOD_LOG_NAMED_ENERGY.fullmatch(token)
+        if energy is None:
+            name_parts.append(token)
+            previous = 'word'
+            continue
+
+        if energy.groupdict().get('name'):
+            name_parts.append(energy.group('name'))
+        if not name_parts:
+            raise ValueError(f"找不到 {token} 對應的食物名稱")
+        items.append([' '.join(name_parts), float(energy.group('calories'))])
+        name_parts = []
+        if energy.group('count'):
+            items[-1][0] += f" x{energy.group('count')}"
+            items[-1][1] *= float(energy.group('count'))
+        previous = 'energy'
+
+    if name_parts:
+        raise ValueError(f"{' '.join(name_parts)} 缺少熱量")
+    if not items:
+        raise ValueError("沒有可記錄的食物")
+    if len(items) > FOOD_LOG_MAX_ITEMS:
+        raise ValueError(f"一次最多記錄 {FOOD_LOG_MAX_ITEMS} 項")
+    for food_name, calories in items:
+        if not 0 < calories <= 10000:
+            raise ValueError(f"{food_name} 的熱量不合理")
+    return [(food_name, calories) for food_name, calories in items]
+
+def remove_food_log(user_id, food_name):
+    with state_lock:
+        daily_tracker = user_profiles[user_id].daily_tracker
+        
+        # 移除食物記錄
+        if not any(food.name == food_name for food in daily_tracker.food_log):
+            return False
+
+        commit_event(EVENT_FOOD_REMOVE, user_id, food_name)
+    
+    return True
+
+def meal_period(timestamp):
+    hour = datetime.fromtimestamp(timestamp).hour
+    name = MEAL_PERIODS[0][1]
+    for start_hour, period_name in MEAL_PERIODS:
+        if hour < start_hour:
+            break
+        name = period_name
+    return name
+
+def status_row(label, value, color='#555555', bold=False):
+    return {
+        'type': 'box',
+        'layout': 'horizontal',
+        'contents': [
+            {'type': 'text', 'text': label, 'size': 'sm', 'color': '#888888', 'flex': 0},
+            {'type': 'text', 'text': value, 'size': 'sm', 'color': color, 'align': 'end',
+             'weight': 'bold' if bold else 'regular'}
+        ]
+    }
+
+def build_status_message(profile, today=None):
+    """
+    產生今日狀態的 Flex 訊息：熱量進度條、各餐別小計與最近幾筆記錄
+    追蹤日期不是今天時 (跨日後尚未新增記錄) 顯示為今天還沒有記錄
+    """
+    today = date.today().toordinal() if today is None else today
+    daily_tracker = profile.daily_tracker
+    total_calories = daily_tracker.total_calories
+    consumed_calories = daily_tracker.consumed_calories
+    food_log = daily_tracker.food_log
+    if daily_tracker.day != today:
+        consumed_calories, food_log = 0, []
+    remaining_calories = total_calories - consumed_calories
+    percent = min(100, round(consumed_calories / total_calories * 100)) if total_calories else 0
+    bar_color = '#E74C3C' if percent >= 100 else '#F39C12' if percent >= 80 else '#27AE60'
+
+    meal_totals = {}
+    for food in food_log:
+        period = meal_period(food.timestamp)
+        meal_totals[period] = meal_totals.get(period, 0) + food.calories
+
+    body = [
+        {'type': 'text', 'text': '📊 今日熱量狀態', 'weight': 'bold', 'size': 'lg'},
+        {'type': 'text',
+         'text': f"{profile.goal}｜{profile.gender} {profile.age} 歲｜{profile.height} 公分 {profile.weight} 公斤",
+         'size': 'xs', 'color': '#888888', 'margin': 'sm', 'wrap': True},
+        {
+            'type': 'box',
+            'layout': 'vertical',
+            'margin': 'lg',
+            'height': '8px',
+            'backgroundColor': '#EEEEEE',
+            'cornerRadius': '4px',
+            'contents': [
+                {'type': 'box', 'layout': 'vertical', 'contents': [], 'height': '8px',
+                 'width': f"{percent}%", 'backgroundColor': bar_color, 'cornerRadius': '4px'}
+            ]
+        },
+        {'type': 'text', 'text': f"{percent}%", 'size': 'xs', 'color': '#888888', 'align': 'end'},
+        status_row('總建議熱量', f"{round(total_calories, 2)} 大卡"),
+        status_row('已攝取熱量', f"{round(consumed_calories, 2)} 大卡"),
+        status_row('剩餘可攝取熱量', f"{round(remaining_calories, 2)} 大卡", bar_color, True)
+    ]
+
+    if meal_totals:
+        body.append({'type': 'separator', 'margin': 'lg'})
+        body.append({'type': 'text', 'text': '🍽️ 各餐別', 'weight': 'bold', 'size': 'sm', 'margin': 'lg'})
+        for _, period_name in MEAL_PERIODS:
+            if period_name in meal_totals:
+                body.append(status_row(period_name, f"{round(meal_totals.pop(period_name), 2)} 大卡"))
+
+        body.append({'type': 'separator', 'margin': 'lg'})
+        body.append({'type': 'text', 'text': '🕒 最近記錄', 'weight': 'bold', 'size': 'sm', 'margin': 'lg'})
+        for food in reversed(food_log[-STATUS_RECENT_ENTRIES:]):
+            body.append(status_row(f"{food.time} {food.name}", f"{round(food.calories, 2)} 大卡"))
+    else:
+        body.append({'type': 'text', 'text': '今天還沒有飲食記錄', 'size': 'sm',
+                     'color': '#888888', 'margin': 'lg'})
+
+    return FlexSendMessage(
+        alt_text=f"今日熱量狀態: 已攝取 {round(consumed_calories, 2)} / {round(total_calories, 2)} 大卡",
+        contents={'type': 'bubble', 'body': {'type': 'box', 'layout': 'vertical', 'contents': body}}
+    )
+
+def get_status_message(user_id):
+    """
+    取得今日狀態訊息，同一天內未變更時直接使用快取
+    """
+    today = date.today().toordinal()
+    cached = status_cache.get(user_id)
+    if cached is not None and cached[0] == today:
+        return cached[1]
+    with state_lock:
+        message = build_status_message(user_profiles[user_id], today)
+        status_cache[user_id] = (today, message)
+    return message
+
+def record_metric(name, value=1):
+    with metrics_lock:
+        metrics[name] += value
+
+def update_ai_latency(kind, elapsed):
+    estimate = ai_latency_estimates[kind]
+    ai_latency_estimates[kind] = estimate + AI_LATENCY_SMOOTHING * (elapsed - estimate)
+
+def estimate_ai_wait(kind):
+    '''
+    預估工作從排隊到完成所需的時間
+    '''
+    if durable_job_queue is not None:
+        # 工作在 worker 程序中執行，耗時以 worker 記錄在佇列檔案中的值為準
+        pending, latencies = durable_job_queue.estimates()
+        return latencies.get(kind, ai_latency_estimates[kind]) * (1 + pending / max(AI_WORKERS, 1))
+    if ai_event_loop is not None:
+        queued_rounds = async_ai_job_queue.qsize() / max(ASGI_AI_CONCURRENCY, 1)
+    else:
+        queued_rounds = ai_job_queue.qsize() / max(AI_WORKERS, 1)
+    return ai_latency_estimates[kind] * (1 + queued_rounds)
+
+def post_line_api(path, body):
+    '''
+    呼叫 SDK 沒有包裝的 Messaging API 端點 (目前頻道的用戶端)
+    line-bot-sdk 2.4.3 沒有公開的方法可用，借用 LineBotApi 內部的 _post，
+    沿用頻道的認證標頭、連線池與錯誤處理；升級 SDK 時只需修改這裡
+    '''
+    return line_bot_api._post(path, data=json.dumps(body))
+
+async def post_line_api_async(path, body):
+    '''
+    post_line_api 的非同步版本，使用目前頻道的 AsyncLineBotApi
+    '''
+    return await async_line_bot_api._post(path, data=json.dumps(body))
+
+def loading_animation_body(user_id, seconds):
+    # 秒數需為 5 到 60 之間 5 的倍數
+    seconds = min(60, max(5, math.ceil(seconds / 5) * 5))
+    return {'chatId': split_user_key(user_id)[1], 'loadingSeconds': seconds}
+
+def show_loading_animation(user_id, seconds):
+    '''
+    顯示 LINE 的載入動畫
+    '''
+    post_line_api('/v2/bot/chat/loading/start', loading_animation_body(user_id, seconds))
+
+async def show_loading_animation_async(user_id, seconds):
+    await post_line_api_async('/v2/bot/chat/loading/start', loading_animation_body(user_id, seconds))
+
+def allow_ai_request(user_id):
+    '''
+    檢查使用者、所屬頻道與全域的 OpenAI 請求額度，額度不足時回傳 False
+    '''
+    tenant = tenants[split_user_key(user_id)[0]]
+    now = time.monotonic()
+    with user_ai_buckets_lock:
+        bucket = user_ai_buckets.get(user_id)
+        if bucket is None:
+            bucket = TokenBucket(tenant.user_ai_rate, tenant.user_ai_burst)
+            user_ai_buckets[user_id] = bucket
+        else:
+            user_ai_buckets.move_to_end(user_id)
+
+        # 移除已閒置到補滿的令牌桶，之後再使用時重新建立，額度不變；
+        # 每次請求攤銷 O(1)，令牌桶數量只與最近仍在使用額度的使用者數有關
+        while len(user_ai_buckets) > 1:
+            oldest_user_id, oldest = next(iter(user_ai_buckets.items()))
+            if not oldest.is_full(now):
+                break
+            del user_ai_buckets[oldest_user_id]
+
+    if not bucket.consume():
+        return False
+
+    # 頻道或全域額度不足時退還已扣的令牌，避免使用者被重複扣額度
+    if tenant.ai_bucket is not None and not tenant.ai_bucket.consume():
+        bucket.refund()
+        return False
+
+    if not global_ai_bucket.consume():
+        bucket.refund()
+        if tenant.ai_bucket is not None:
+            tenant.ai_bucket.refund()
+        return False
+
+    return True
+
+def start_ai_workers():
+    '''
+    啟動處理 OpenAI 工作的背景執行緒 (只會啟動一次)
+    '''
+    with ai_workers_lock:
+        if ai_workers:
+            return
+        for _ in range(AI_WORKERS):
+            worker = threading.Thread(target=ai_worker_loop, daemon=True)
+            worker.start()
+            ai_workers.append(worker)
+
+def submit_ai_job(job):
+    '''
+    將 OpenAI 工作放入優先佇列，佇列已滿時回傳 False
+    job 為 dict，至少包含 kind 與 user_id
+    '''
+    # 持久化佇列由 worker 程序處理
+    if durable_job_queue is not None:
+        durable_job_queue.put(job, AI_JOB_PRIORITY[job['kind']])
+        return True
+
+    item = (AI_JOB_PRIORITY[job['kind']], next(ai_job_sequence), job)
+
+    # ASGI 模式下交給事件迴圈中的協程處理，不佔用執行緒
+    if ai_event_loop is not None:
+        if async_ai_job_queue.qsize() >= AI_QUEUE_SIZE:
+            return False
+        ai_event_loop.call_soon_threadsafe(async_ai_job_queue.put_nowait, item)
+        return True
+
+    start_ai_workers()
+    try:
+        ai_job_queue.put_nowait(item)
+    except queue.Full:
+        return False
+    return True
+
+def ai_worker_loop():
+    while True:
+        _, _, job = ai_job_queue.get()
+        current_tenant.set(split_user_key(job['user_id'])[0])
+        trace = start_job_trace(job)
+        started_at = time.monotonic()
+        try:
+            AI_JOB_HANDLERS[job['kind']](job)
+        except Exception as e:
+            print(f"AI Job Error: {e}")
+        finally:
+            update_ai_latency(job['kind'], time.monotonic() - started_at)
+            finish_job_trace(trace)
+            ai_job_queue.task_done()
+
+async def async_ai_worker_loop():
+    while True:
+        _, _, job = await async_ai_job_queue.get()
+        current_tenant.set(split_user_key(job['user_id'])[0])
+        trace = start_job_trace(job)
+        started_at = time.monotonic()
+        try:
+            await ASYNC_AI_JOB_HANDLERS[job['kind']](job)
+        except Exception as e:
+            print(f"AI Job Error: {e}")
+        finally:
+            update_ai_latency(job['kind'], time.monotonic() - started_at)
+            finish_job_trace(trace)
+            async_ai_job_queue.task_done()
+
+def durable_worker_loop(stop):
+    '''
+    worker 程序的工作執行緒：執行失敗時依次數延遲重試，超過上限才通知使用者
+    結果已產生但送出失敗時保留結果重試送出，不會重複呼叫 OpenAI
+    '''
+    import sqlite3
+
+    while not stop.is_set():
+        try:
+            claimed = durable_job_queue.claim()
+        except sqlite3.Error as e:
+            print(f"Job Queue Error: {e}")
+            claimed = None
+        if claimed is None:
+            stop.wait(JOB_POLL_SECONDS)
+            continue
+
+        job_id, attempts, job = claimed
+        current_tenant.set(split_user_key(job['user_id'])[0])
+        try:
+            if 'result' not in job:
+                started_at = time.monotonic()
+                job['result'] = JOB_RESULT_HANDLERS[job['kind']](job)
+                elapsed = time.monotonic() - started_at
+                update_ai_latency(job['kind'], elapsed)
+                try:
+                    durable_job_queue.record_latency(job['kind'], elapsed)
+                except sqlite3.Error as e:
+                    print(f"Job Queue Error: {e}")
+            deliver_ai_result(job, TextSendMessage(text=job['result']))
+            durable_job_queue.complete(job_id)
+        except Exception as e:
+            print(f"AI Job Error: {e}")
+            if attempts < JOB_MAX_ATTEMPTS:
+                durable_job_queue.retry(job_id, attempts, str(e), job)
+                record_metric('ai_job_retried')
+                continue
+            durable_job_queue.fail(job_id, str(e))
+            record_metric('ai_job_failed')
+            try:
+                deliver_ai_result(job, TextSendMessage(text=JOB_FAILURE_TEXTS[job['kind']]))
+            except Exception as e:
+                print(f"Push Message Error: {e}")
+
+def run_worker():
+    '''
+    持久化佇列的 worker 程序，與 webhook 伺服器分開執行，可同時啟動多個
+    '''
+    global durable_job_queue
+
+    durable_job_queue = DurableJobQueue(JOB_QUEUE_PATH)
+    load_tenants()
+
+    stop = threading.Event()
+    workers = [threading.Thread(target=durable_worker_loop, args=(stop,), daemon=True) for _ in range(AI_WORKERS)]
+    for worker in workers:
+        worker.start()
+    print(f"worker 已啟動 ({AI_WORKERS} 個執行緒)，佇列: {JOB_QUEUE_PATH}", file=sys.stderr)
+
+    try:
+        while True:
+            durable_job_queue.purge(time.time() - JOB_RETENTION_SECONDS)
+            time.sleep(60)
+    except KeyboardInterrupt:
+        stop.set()
+        for worker in workers:
+            worker.join()
+
+JOB_KIND_NAMES = {'diet_plan': '飲食建議', 'image': '圖片熱量分析'}
+JOB_STATUS_NAMES = {'pending': '排隊中', 'running': '處理中', 'done': '已完成', 'failed': '失敗'}
+
+def format_job_status(user_id):
+    '''
+    查詢任務指令的回覆：使用者最近的 AI 工作與狀態
+    '''
+    if durable_job_queue is None:
+        return "目前沒有排隊中的任務，結果完成後會直接回覆"
+
+    jobs = durable_job_queue.user_jobs(user_id)
+    if not jobs:
+        return "目前沒有任務記錄"
+
+    lines = ["📋 最近的任務:"]
+    for kind, status, attempts, created_at in jobs:
+        status_name = JOB_STATUS_NAMES.get(status, status)
+        if status == 'pending' and attempts > 0:
+            status_name = f"等待重試 (已嘗試 {attempts} 次)"
+        created_time = datetime.fromtimestamp(created_at).strftime('%m/%d %H:%M')
+        lines.append(f"{created_time} {JOB_KIND_NAMES.get(kind, kind)}: {status_name}")
+    return "\n".join(lines)
+
+def queue_ai_job(job, waiting_text, failure_text):
+    '''
+    排入 OpenAI 工作並決定回應方式，回傳需要立即回覆的訊息
+    結果預計能在 reply token 失效前完成時回傳 None，由呼叫端顯示載入動畫並於完成後 reply
+    否則先以 reply 告知等待，完成後再以 push 送出結果
+    '''
+    if not allow_ai_request(job['user_id']):
+        record_metric('ai_rate_limited')
+        return TextSendMessage(text=failure_text)
+
+    # 抽樣記錄的請求，背景工作的上游呼叫時間也一併記錄
+    trace = traffic_trace.get()
+    if trace is not None:
+        job['trace_id'] = trace['id']
+        job['queued_at'] = time.time()
+
+    token_age = time.time() - job['event_time']
+    if estimate_ai_wait(job['kind']) < REPLY_TOKEN_TTL_SECONDS - token_age:
+        job['delivery'] = 'reply'
+    else:
+        job['delivery'] = 'push'
+
+    if not submit_ai_job(job):
+        record_metric('ai_queue_full')
+        return TextSendMessage(text=failure_text)
+
+    if job['delivery'] == 'push':
+        return TextSendMessage(text=waiting_text)
+    return None
+
+def enqueue_ai_job(job, waiting_text, failure_text):
+    '''
+    排入 OpenAI 工作，需要等待 reply 時顯示載入動畫，回傳需要立即回覆的訊息
+    '''
+    message = queue_ai_job(job, waiting_text, failure_text)
+    if message is None:
+        try:
+            show_loading_animation(job['user_id'], estimate_ai_wait(job['kind']))
+            record_metric('loading_animation_shown')
+        except Exception as e:
+            print(f"Loading Animation Error: {e}")
+    return message
+
+async def enqueue_ai_job_async(job, waiting_text, failure_text):
+    '''
+    enqueue_ai_job 的非同步版本，以 AsyncLineBotApi 顯示載入動畫
+    '''
+    message = queue_ai_job(job, waiting_text, failure_text)
+    if message is None:
+        try:
+            await show_loading_animation_async(job['user_id'], estimate_ai_wait(job['kind']))
+            record_metric('loading_animation_shown')
+        except Exception as e:
+            print(f"Loading Animation Error: {e}")
+    return message
+
+def deliver_ai_result(job, message):
+    '''
+    reply token 仍有效時以 reply 送出結果，否則改用 push
+    '''
+    token_age = time.time() - job['event_time']
+    if job.get('delivery') == 'reply' and token_age < REPLY_TOKEN_TTL_SECONDS:
+        try:
+            line_bot_api.reply_message(job['reply_token'], message)
+            record_metric('push_avoided')
+            return
+        except Exception as e:
+            print(f"Reply Message Error: {e}")
+
+    line_bot_api.push_message(split_user_key(job['user_id'])[1], message)
+    record_metric('push_sent')
+
+async def deliver_ai_result_async(job, message):
+    '''
+    deliver_ai_result 的非同步版本，供 ASGI 模式使用
+    '''
+    token_age = time.time() - job['event_time']
+    if job.get('delivery') == 'reply' and token_age < REPLY_TOKEN_TTL_SECONDS:
+        try:
+            await async_line_bot_api.reply_message(job['reply_token'], message)
+            record_metric('push_avoided')
+            return
+        except Exception as e:
+            print(f"Reply Message Error: {e}")
+
+    await async_line_bot_api.push_message(split_user_key(job['user_id'])[1], message)
+    record_metric('push_sent')
+
+# OpenAI 各類請求的參數，模型可依請求種類分別設定 (例如文字菜單用較便宜的模型)
+AI_REQUEST_SETTINGS = {
+    'diet_plan': {
+        'model': os.getenv('AI_DIET_PLAN_MODEL', "gpt-4o"),
+        'temperature': 0.7,
+        'top_p': 0.2,
+        'stream': False
+    },
+    'image': {
+        'model': os.getenv('AI_IMAGE_MODEL', "gpt-4o"),
+        'temperature': 0.3,
+        'top_p': 0.2
+    }
+}
+
+# AI 後端設定：openai (原本的 openai 套件)、http (OpenAI 相容的 API，例如本機推論伺服器)、stub (離線固定回應)
+# AI_<種類>_BACKEND 可讓不同請求種類使用不同後端
+# 設定 AI_HEDGE_BACKEND 時，主要後端超過 AI_HEDGE_AFTER_SECONDS 未回應就同時送給備用後端，取先回來的結果
+AI_BACKEND = os.getenv('AI_BACKEND', 'openai')
+AI_ROUTES = {
+    'diet_plan': os.getenv('AI_DIET_PLAN_BACKEND', AI_BACKEND),
+    'image': os.getenv('AI_IMAGE_BACKEND', AI_BACKEND)
+}
+AI_HTTP_BASE_URL = os.getenv('AI_HTTP_BASE_URL', 'http://localhost:8000/v1')
+AI_HTTP_API_KEY = os.getenv('AI_HTTP_API_KEY', '')
+AI_HTTP_MODEL = os.getenv('AI_HTTP_MODEL')
+AI_HTTP_TIMEOUT = float(os.getenv('AI_HTTP_TIMEOUT', '60'))
+AI_STUB_LATENCY = float(os.getenv('AI_STUB_LATENCY', '0'))
+AI_HEDGE_BACKEND = os.getenv('AI_HEDGE_BACKEND')
+AI_HEDGE_AFTER_SECONDS = float(os.getenv('AI_HEDGE_AFTER_SECONDS', '5'))
+# 對沖請求的執行緒數，每個進行中的請求最多用兩個，其餘留給無法中斷、仍在背景等待回應的落後請求
+AI_HEDGE_THREADS = int(os.getenv('AI_HEDGE_THREADS', str(AI_WORKERS * 4)))
+
+DIET_PLAN_SYSTEM_PROMPT = """你是一位營養師，為客戶設計繁體中文飲食菜單，
+                    菜單的總熱量需滿足客戶所述的需求熱量，熱量範圍可以在需求熱量正負10%以內。
+                    根據客戶的需求嚴格按照以下格式提供飲食建議：
+                    <早餐/午餐/晚餐/點心/宵夜>:
+                    -<食物名稱><數量/單位>:<食物熱量>大卡
+                    -<食物名稱><數量/單位>:<食物熱量>大卡
+                    ... 
+                    總熱量:<總熱量>大卡
+                    ...
+                    菜單總熱量:<總熱量>大卡
+                    針對菜單的營養價值做簡短描述。"""
+
+IMAGE_SYSTEM_PROMPT = """你是一位專業的營養師，專門分析食物照片並估算熱量。
+                請依照以下格式回覆：
+                1. 食物名稱：[辨識出的食物名稱]
+                2. 份量估計：[估計的份量，例如：一碗、100克等]
+                3. 熱量估計：[照片中每種食物估計熱量] 大卡 (ex: -白飯: 約320大卡\n -炒青菜: 約50大卡... -總熱量: 約370大卡)
+                4. 營養建議：[簡短的營養建議]
+
+                請盡可能準確估計，如果照片無法清楚判斷，請說明原因。"""
+
+def build_diet_plan_messages(selection_prompt):
+    return [
+        {"role": "system", "content": DIET_PLAN_SYSTEM_PROMPT},
+        {"role": "user", "content": selection_prompt}
+    ]
+
+def build_image_messages(image_base64):
+    return [
+        {"role": "system", "content": IMAGE_SYSTEM_PROMPT},
+        {"role": "user", "content": [
+            {"type": "text", "text": "請幫我估計這張圖片食物的熱量。"},
+            {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{image_base64}"}}
+        ]}
+    ]
+
+class OpenAIBackend:
+    '''
+    使用 openai 套件 (0.x 版的 ChatCompletion 介面)
+    '''
+    def complete(self, messages, settings):
+        import openai
+
+        openai.api_key = os.getenv('OPENAI_API_KEY')
+        response = openai.ChatCompletion.create(messages=messages, **settings)
+        return response.choices[0].message.content
+
+    async def acomplete(self, messages, settings):
+        import openai
+
+        openai.api_key = os.getenv('OPENAI_API_KEY')
+        response = await openai.ChatCompletion.acreate(messages=messages, **settings)
+        return response.choices[0].message.content
+
+    async def aclose(self):
+        pass
+
+class HttpChatBackend:
+    '''
+    OpenAI 相容的 /chat/completions API，可指向本機的推論伺服器
+    model 有設定時取代請求參數中的模型名稱
+    '''
+    def __init__(self, base_url, api_key='', model=None, timeout=60):
+        self.url = base_url.rstrip('/') + '/chat/completions'
+        self.headers = {'Content-Type': 'application/json'}
+        if api_key:
+            self.headers['Authorization'] = f"Bearer {api_key}"
+        self.model = model
+        self.timeout = timeout
+        import requests
+        self.session = requests.Session()
+        self.async_session = None
+
+    def payload(self, messages, settings):
+        payload = {key: value for key, value in settings.items() if key != 'stream'}
+        if self.model:
+            payload['model'] = self.model
+        payload['messages'] = messages
+        return payload
+
+    def complete(self, messages, settings):
+        response = self.session.post(
+            self.url, headers=self.headers, json=self.payload(messages, settings), timeout=self.timeout
+        )
+        response.raise_for_status()
+        return response.json()['choices'][0]['message']['content']
+
+    async def acomplete(self, messages, settings):
+        import aiohttp
+
+        if self.async_session is None:
+            self.async_session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=self.timeout))
+        async with self.async_session.post(
+            self.url, headers=self.headers, json=self.payload(messages, settings)
+        ) as response:
+            response.raise_for_status()
+            data = await response.json()
+        return data['choices'][0]['message']['content']
+
+    async def aclose(self):
+        if self.async_session is not None:
+            await self.async_session.close()
+            self.async_session = None
+
+class StubBackend:
+    '''
+    不連網的固定回應，相同輸入一定得到相同輸出，供測試與壓力測試使用
+    latency 為模擬的回應時間 (秒)
+    '''
+    DIET_PLAN_ITEMS = [
+        ('早餐', '燕麥牛奶', '1碗', 0.25),
+        ('午餐', '雞胸肉便當', '1份', 0.4),
+        ('晚餐', '鮭魚沙拉', '1份', 0.35)
+    ]
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+
+    def respond(self, messages, settings):
+        if isinstance(messages[-1]['content'], list):
+            return (
+                "1. 食物名稱：白飯、炒青菜\n"
+                "2. 份量估計：一碗、半盤\n"
+                "3. 熱量估計：\n -白飯: 約280大卡\n -炒青菜: 約70大卡\n -總熱量: 約350大卡\n"
+                "4. 營養建議：(測試用固定回應)"
+            )
+
+        match = re.search(r'熱量為(\d+(?:\.\d+)?)大卡', messages[-1]['content'])
+        target_calories = float(match.group(1)) if match else 1500
+        lines = []
+        for meal, food, amount, ratio in self.DIET_PLAN_ITEMS:
+            lines.append(f"{meal}:\n-{food}{amount}:{round(target_calories * ratio)}大卡")
+        lines.append(f"菜單總熱量:{round(target_calories)}大卡")
+        lines.append("(測試用固定回應)")
+        return "\n".join(lines)
+
+    def complete(self, messages, settings):
+        if self.latency:
+            time.sleep(self.latency)
+        return self.respond(messages, settings)
+
+    async def acomplete(self, messages, settings):
+        import asyncio
+
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return self.respond(messages, settings)
+
+    async def aclose(self):
+        pass
+
+# 對沖請求用的執行緒，原本的工作執行緒在等待時不會被佔用兩次，第一次對沖時才建立
+hedge_executor = None
+hedge_executor_lock = threading.Lock()
+
+def get_hedge_executor():
+    global hedge_executor
+    import concurrent.futures
+
+    with hedge_executor_lock:
+        if hedge_executor is None:
+            hedge_executor = concurrent.futures.ThreadPoolExecutor(max_workers=AI_HEDGE_THREADS)
+    return hedge_executor
+
+class HedgedBackend:
+    '''
+    主要後端超過 after 秒仍未回應 (或已失敗) 時，同時送給備用後端，採用先成功的結果
+    同步模式下無法中斷已送出的 HTTP 請求，落後的請求會在背景完成後捨棄
+    落後的請求仍佔用執行緒池，主要請求可能需要排隊，因此從主要請求實際開始執行時才計時
+    '''
+    def __init__(self, primary, secondary, after):
+        self.primary = primary
+        self.secondary = secondary
+        self.after = after
+
+    def complete(self, messages, settings):
+        import concurrent.futures
+
+        started = threading.Event()
+
+        def run_primary():
+            started.set()
+            return self.primary.complete(messages, settings)
+
+        executor = get_hedge_executor()
+        futures = [executor.submit(run_primary)]
+        started.wait()
+        done, _ = concurrent.futures.wait(futures, timeout=self.after)
+        if not done or futures[0].exception() is not None:
+            record_metric('ai_hedged')
+            futures.append(executor.submit(self.secondary.complete, messages, settings))
+
+        error = None
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                result = future.result()
+            except Exception as e:
+                error = e
+                continue
+            if future is not futures[0]:
+                record_metric('ai_hedge_won')
+            return result
+        raise error
+
+    async def acomplete(self, messages, settings):
+        import asyncio
+
+        tasks = [asyncio.ensure_future(self.primary.acomplete(messages, settings))]
+        done, _ = await asyncio.wait(tasks, timeout=self.after)
+        if not done or tasks[0].exception() is not None:
+            record_metric('ai_hedged')
+            tasks.append(asyncio.ensure_future(self.secondary.acomplete(messages, settings)))
+
+        error = None
+        pending = set(tasks)
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is not tasks[0]:
+                            record_metric('ai_hedge_won')
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def aclose(self):
+        pass
+
+# 已建立的後端，依名稱共用 (連線池、非同步 session)
+ai_backends = {}
+
+def create_ai_backend(name):
+    if name == 'openai':
+        return OpenAIBackend()
+    if name == 'http':
+        return HttpChatBackend(AI_HTTP_BASE_URL, AI_HTTP_API_KEY, AI_HTTP_MODEL, AI_HTTP_TIMEOUT)
+    if name == 'stub':
+        return StubBackend(AI_STUB_LATENCY)
+    raise ValueError(f"未知的 AI 後端: {name}")
+
+def named_ai_backend(name):
+    backend = ai_backends.get(name)
+    if backend is None:
+        backend = ai_backends.setdefault(name, create_ai_backend(name))
+    return backend
+
+def get_ai_backend(kind):
+    '''
+    依請求種類取得後端，有設定 AI_HEDGE_BACKEND 時包裝成對沖請求
+    '''
+    name = AI_ROUTES[kind]
+    if not AI_HEDGE_BACKEND or AI_HEDGE_BACKEND == name:
+        return named_ai_backend(name)
+
+    hedged_name = f"{name}+{AI_HEDGE_BACKEND}"
+    backend = ai_backends.get(hedged_name)
+    if backend is None:
+        backend = ai_backends.setdefault(hedged_name, HedgedBackend(
+            named_ai_backend(name), named_ai_backend(AI_HEDGE_BACKEND), AI_HEDGE_AFTER_SECONDS
+        ))
+    return backend
+
+def create_chat_completion(kind, messages):
+    backend = get_ai_backend(kind)
+    if traffic_trace.get() is not None:
+        return timed_upstream_call(f"ai:{kind}", backend.complete)(messages, AI_REQUEST_SETTINGS[kind])
+    return backend.complete(messages, AI_REQUEST_SETTINGS[kind])
+
+async def create_chat_completion_async(kind, messages):
+    backend = get_ai_backend(kind)
+    if traffic_trace.get() is not None:
+        return await timed_upstream_call(f"ai:{kind}", backend.acomplete)(messages, AI_REQUEST_SETTINGS[kind])
+    return await backend.acomplete(messages, AI_REQUEST_SETTINGS[kind])
+
+def generate_diet_plan(selection_prompt):
+    try:
+        return create_chat_completion('diet_plan', build_diet_plan_messages(selection_prompt))
+    except Exception as e:
+        print(f"OpenAI API Error: {e}")
+        return f"目前無法生成飲食建議，請稍後再試。"
+
+async def generate_diet_plan_async(selection_prompt):
+    try:
+        return await create_chat_completion_async('diet_plan', build_diet_plan_messages(selection_prompt))
+    except Exception as e:
+        print(f"OpenAI API Error: {e}")
+        return f"目前無法生成飲食建議，請稍後再試。"
+
+def start_diet_suggestion_flow(user_id):
+    '''
+    初始化飲食建議流程
+    '''
+    commit_event(EVENT_DIET_FLOW, user_id, dump_session_value({
+        'stage': 'meal_type',
+        'selections': {}
+    }))
+
+    # 用餐方式
+    meal_type_template = CarouselTemplate(
+        columns = [
+            CarouselColumn(
+                title='用餐方式',
+                text='選擇用餐方式',
+                actions=[
+                    PostbackTemplateAction(label='外食', text='外食', data='meal_type_外食'),
+                    PostbackTemplateAction(label='自行烹調', text='自行烹調', data='meal_type_自行烹調')
+                ]
+            )
+        ]
+    )
+
+    template_message = TemplateSendMessage(
+        alt_text='選擇用餐方式',
+        template=meal_type_template
+    )
+    
+    return template_message
+
+
+def handle_diet_suggestion_flow(event, user_id, postback_data, flow_state=None):
+    """
+    處理飲食建議流程的各個階段
+    flow_state 為已讀取的流程狀態，未提供時從共享儲存讀取
+    """
+    if flow_state is None:
+        flow_state = get_diet_flow(user_id)
+
+    if flow_state is None:
+        expected_flow_state = None
+        flow_state = {
+            'stage': 'meal_type',
+            'selections': {}
+        }
+    else:
+        expected_flow_state = json.loads(dump_session_value(flow_state))
+
+    previous_stage = flow_state.get('stage')
+    message = advance_diet_suggestion_flow(event, flow_state, postback_data)
+
+    # 同一階段被重複觸發 (例如連點或重送) 時，只有第一個請求能完成轉換
+    if not save_diet_flow(user_id, flow_state, expected_flow_state):
+        return TextSendMessage(text="此步驟已處理，請依照最新的選項繼續")
+
+    if previous_stage == 'additional_requirements' and flow_state['stage'] == 'complete':
+        return request_diet_plan(event, user_id, build_diet_prompt(user_id, flow_state['selections']))
+
+    return message
+
+def advance_diet_suggestion_flow(event, flow_state, postback_data):
+    """
+    依目前階段記錄選擇並推進到下一階段，回傳下一步要送出的訊息
+    """
+    if flow_state.get('stage') == 'meal_type':
+        # 用餐方式選擇
+        flow_state['selections']['meal_type'] = postback_data.split('_')[-1]
+        flow_state['stage'] = 'cuisine_style'
+        
+        # 餐點風格選擇
+        cuisine_template = CarouselTemplate(columns=[
+            CarouselColumn(
+                thumbnail_image_url='https://i.pinimg.com/736x/d3/42/1f/d3421fedf1f7648ca7c7f1879c397c4b.jpg',
+                title='美式料理',
+                text='如:漢堡、薯條、炸雞等',
+                actions=[PostbackTemplateAction(label='選擇', text='美式', data='cuisine_美式')]
+            ),
+            CarouselColumn(
+                thumbnail_image_url='https://i.pinimg.com/736x/ac/a8/f8/aca8f8463de190748b4505cdacce48eb.jpg',
+                title='日式料理',
+                text='如:壽司、拉麵、刺身等',
+                actions=[PostbackTemplateAction(label='選擇', text='日式', data='cuisine_日式')]
+            ),
+            CarouselColumn(
+                thumbnail_image_url='https://i.pinimg.com/736x/b4/62/b2/b462b28ecef0582be9f82ccb73371eaa.jpg',
+                title='中式料理',
+                text='如:炒飯、麵食、蛤蠣絲瓜等',
+                actions=[PostbackTemplateAction(label='選擇', text='中式', data='cuisine_中式')]
+            ),
+            CarouselColumn(
+                thumbnail_image_url='https://i.pinimg.com/736x/6b/8a/6e/6b8a6e33f4d5923047a04a09e29b8289.jpg',
+                title='義式料理',
+                text='如:義大利麵、披薩、焗烤等',
+                actions=[PostbackTemplateAction(label='選擇', text='義式', data='cuisine_義式')]
+            ),
+            CarouselColumn(
+                thumbnail_image_url='https://i.pinimg.com/736x/fd/ed/ea/fdedea6e3c56c7ec485b09b30fa8f816.jpg',
+                title='韓式料理',
+                text='如:泡菜、烤肉、石鍋拌飯等',
+                actions=[PostbackTemplateAction(label='選擇', text='韓式', data='cuisine_韓式')]
+            ),
+            CarouselColumn(
+                thumbnail_image_url='https://i.pinimg.com/736x/67/28/2f/67282ff1cecfd27c047e090813f221b4.jpg',
+                title='泰式料理',
+                text='如:打拋豬、綠咖哩、椒麻雞等',
+                actions=[PostbackTemplateAction(label='選擇', text='泰式', data='cuisine_泰式')]
+            )
+        ])
+        
+        template_message = TemplateSendMessage(
+            alt_text='選擇餐點風格',
+            template=cuisine_template
+        )
+        
+        return template_message
+    
+    elif flow_state.get('stage') == 'cuisine_style':
+        # 餐點風格選擇
+        flow_state['selections']['cuisine_style'] = postback_data.split('_')[-1]
+        flow_state['stage'] = 'diet_requirement'
+        
+        # 飲食需求選擇
+        requirement_template = CarouselTemplate(columns=[
+            CarouselColumn(
+                thumbnail_image_url='https://i.pinimg.com/736x/d4/0f/a4/d40fa452569e889d0b80502560212bfd.jpg',
+                title='減重飲食',
+                text='例如少油少鹽的清淡飲食',
+                actions=[PostbackTemplateAction(label='選擇', text='減重', data='requirement_減重')]
+            ),
+            CarouselColumn(
+                thumbnail_image_url='https://i.pinimg.com/736x/86/52/5c/86525c07fd58a8cc170ef4079a3a9bc9.jpg',
+                title='高蛋白飲食',
+                text='富含豐富蛋白質，適合增肌時期或運動後的人',
+                actions=[PostbackTemplateAction(label='選擇', text='高蛋白', data='requirement_高蛋白')]
+            ),
+            CarouselColumn(
+                thumbnail_image_url='https://i.pinimg.com/736x/c0/56/b7/c056b77c2c472ca12aee47211ea10ab4.jpg',
+                title='均衡飲食',
+                text='各類食物均衡攝取',
+                actions=[PostbackTemplateAction(label='選擇', text='均衡', data='requirement_均衡')]
+            ),
+            CarouselColumn(
+                thumbnail_image_url='https://i.pinimg.com/736x/1c/3c/1b/1c3c1b4b3604b307a99474e52d8a201e.jpg',
+                title='素食飲食',
+                text='適合素食者，不含葷食',
+                actions=[PostbackTemplateAction(label='選擇', text='素食', data='requirement_素食')]
+            ),
+            CarouselColumn(
+                thumbnail_image_url='https://img.shoplineapp.com/media/image_clips/668b7145948b3100167dac7a/original.jpg?1720414532',
+                title='無麩質飲食',
+                text='適合麩質過敏者，不含小麥、大麥、麥麩等',
+                actions=[PostbackTemplateAction(label='選擇', text='無麩質', data='requirement_無麩質')]
+            )
+        ])
+        
+        template_message = TemplateSendMessage(
+            alt_text='選擇飲食需求',
+            template=requirement_template
+        )
+        
+        return template_message
+    
+    elif flow_state.get('stage') == 'diet_requirement':
+        # 飲食需求選擇
+        flow_state['selections']['diet_requirement'] = postback_data.split('_')[-1]
+        flow_state['stage'] = 'meal_time'
+        
+        # 用餐時間選擇
+        meal_time_template = CarouselTemplate(columns=[
+            CarouselColumn(
+                thumbnail_image_url='https://i.pinimg.com/736x/c3/8c/4c/c38c4c218cbf7dacf09d6aacd9a6c3ef.jpg',
+                title='早餐',
+                text='選擇早餐菜單',
+                actions=[PostbackTemplateAction(label='選擇', text='早餐', data='meal_time_早餐')]
+            ),
+            CarouselColumn(
+                thumbnail_image_url='https://i.pinimg.com/736x/57/58/6f/57586f877369922c24ccf770e5a1e665.jpg',
+                title='午餐',
+                text='選擇午餐菜單',
+                actions=[PostbackTemplateAction(label='選擇', text='午餐', data='meal_time_午餐')]
+            ),
+            CarouselColumn(
+                thumbnail_image_url='https://i.pinimg.com/736x/f3/4a/2c/f34a2c2aef5c82f1549bb6ae52579aaf.jpg',
+                title='晚餐',
+                text='選擇晚餐菜單',
+                actions=[PostbackTemplateAction(label='選擇', text='晚餐', data='meal_time_晚餐')]
+            ),
+            CarouselColumn(
+                thumbnail_image_url='https://i.pinimg.com/736x/3e/70/1a/3e701a24d91eeee687e4a7798a6dc702.jpg',
+                title='點心',
+                text='選擇點心菜單',
+                actions=[PostbackTemplateAction(label='選擇', text='點心', data='meal_time_點心')]
+            ),
+            CarouselColumn(
+                thumbnail_image_url='https://i.pinimg.com/736x/66/5f/c5/665fc5e4e0f24744369a445215e3fb7c.jpg',
+                title='宵夜',
+                text='選擇宵夜菜單',
+                actions=[PostbackTemplateAction(label='選擇', text='宵夜', data='meal_time_宵夜')]
+            ),
+            CarouselColumn(
+                thumbnail_image_url='https://i.pinimg.com/736x/50/48/7f/50487fadf6c16916442f8e3846c22e0f.jpg',
+                title='一日菜單',
+                text='選擇一日菜單',
+                actions=[PostbackTemplateAction(label='選擇', text='一日菜單', data='meal_time_一日菜單')]
+            )
+        ])
+        
+        template_message = TemplateSendMessage(
+            alt_text='選擇用餐時間',
+            template=meal_time_template
+        )
+        
+        return template_message
+    
+    elif flow_state.get('stage') == 'meal_time':
+        # 用餐時間選擇
+        flow_state['selections']['meal_time'] = postback_data.split('_')[-1]
+        
+        # 如果不是一日菜單，要求輸入熱量
+        if flow_state['selections']['meal_time'] != '一日菜單':
+            flow_state['stage'] = 'calories'
+            return TextSendMessage(text="請輸入您預計攝取的熱量(大卡)")
+        else:
+            flow_state['stage'] = 'additional_requirements'
+            return TextSendMessage(text="請輸入其他特殊飲食需求(無特殊需求請輸入「無」)")
+    
+    elif flow_state.get('stage') == 'calories':
+        # 熱量輸入
+        try:
+            calories = float(event.message.text)
+            flow_state['selections']['calories'] = calories
+            flow_state['stage'] = 'additional_requirements'
+            return TextSendMessage(text="請輸入其他特殊飲食需求(無特殊需求請輸入「無」)")
+        except ValueError:
+            return TextSendMessage(text="請輸入有效的數字！")
+    
+    elif flow_state.get('stage') == 'additional_requirements':
+        # 其他特殊需求
+        flow_state['selections']['additional_requirements'] = event.message.text
+        flow_state['stage'] = 'complete'
+        return None
+
+def build_diet_summary(profile, today):
+    """
+    整理今日剩餘熱量與最近幾天的飲食摘要，長度固定上限，不掃描完整記錄
+    """
+    daily_tracker = profile.daily_tracker
+    if daily_tracker.day == today:
+        remaining = daily_tracker.total_calories - daily_tracker.consumed_calories
+    else:
+        remaining = daily_tracker.total_calories
+    parts = [f"今日剩餘熱量{round(max(remaining, 0))}大卡"]
+
+    history = profile.diet_history
+    if history is not None:
+        days = [
+            summary for day, summary in history.days.items()
+            if today - DIET_HISTORY_DAYS < day <= today
+        ]
+        # 平均攝取只計算已結束且有記錄的日子
+        past_calories = [
+            summary.calories for day, summary in history.days.items()
+            if today - DIET_HISTORY_DAYS < day < today and summary.foods
+        ]
+        if past_calories:
+            parts.append(
+                f"近{DIET_HISTORY_DAYS}天平均每日攝取{round(sum(past_calories) / len(past_calories))}大卡"
+            )
+
+        foods = Counter()
+        for summary in days:
+            foods.update(summary.foods)
+        if foods:
+            names = "、".join(
+                name[:DIET_SUMMARY_NAME_CHARS]
+                for name, _ in foods.most_common(DIET_SUMMARY_TOP_FOODS)
+            )
+            parts.append(f"近{DIET_HISTORY_DAYS}天常吃：{names}")
+
+    return "，".join(parts) + "。"
+
+def get_diet_summary(user_id):
+    """
+    取得飲食摘要，同一天內未變更時直接使用快取
+    """
+    today = date.today().toordinal()
+    cached = diet_summary_cache.get(user_id)
+    if cached is not None and cached[0] == today:
+        return cached[1]
+    with state_lock:
+        summary = build_diet_summary(user_profiles[user_id], today)
+        diet_summary_cache[user_id] = (today, summary)
+    return summary
+
+def build_diet_prompt(user_id, selections):
+    """
+    準備OpenAI API調用的提示詞
+    """
+    prompt = (
+        f"請為一位想要{selections['diet_requirement']}的客戶"
+        f"提供一份{selections['meal_time']}的{selections['cuisine_style']}風格菜單。"
+        f"飲食方式為{selections['meal_type']}，"
+    )
+    
+    if selections['meal_time'] != '一日菜單':
+        prompt += f"客戶需求攝取熱量為{selections['calories']}大卡"
+    else:
+        prompt += f"客戶需求攝取熱量為{user_profiles[user_id].daily_tracker.total_calories}大卡"
+    
+    prompt += f"其他特殊需求：{selections['additional_requirements']}。"
+    prompt += f"客戶飲食記錄：{get_diet_summary(user_id)}請參考這些記錄調整菜單。"
+    prompt += f"需要付上每一項餐點的熱量，並於最後告知這份菜單的總熱量。"
+
+    return prompt
+
+def request_diet_plan(event, user_id, prompt):
+    """
+    將飲食建議交由背景工作生成
+    """
+    job = {
+        'kind': 'diet_plan',
+        'user_id': user_id,
+        'reply_token': event.reply_token,
+        'event_time': event.timestamp / 1000,
+        'prompt': prompt
+    }
+
+    # 超過使用額度或佇列已滿時直接回覆，不佔用背景工作
+    return enqueue_ai_job(
+        job,
+        "🔄正在生成飲食建議，請稍後...",
+        "❌無法生成飲食建議，請稍後再試。"
+    )
+
+def run_diet_plan_job(job):
+    '''
+    背景工作：呼叫 OpenAI 生成飲食建議並回覆使用者
+    '''
+    try:
+        diet_plan = generate_diet_plan(job['prompt'])
+        message = TextSendMessage(text=diet_plan)
+    except Exception as e:
+        print(f"Diet Plan Job Error: {e}")
+        message = TextSendMessage(text="❌無法生成飲食建議，請稍後再試。")
+    deliver_ai_result(job, message)
+
+async def run_diet_plan_job_async(job):
+    diet_plan = await generate_diet_plan_async(job['prompt'])
+    await deliver_ai_result_async(job, TextSendMessage(text=diet_plan))
+
+
+# 目標與活動量選項
+GOAL_OPTIONS = {'1': '增肌', '2': '減重', '3': '維持體重'}
+ACTIVITY_OPTIONS = {
+    '1': '久坐', 
+    '2': '輕度活動', 
+    '3': '中度活動', 
+    '4': '高度活動', 
+    '5': '非常活躍'
+}
+
+# 驗證編輯的輸入是否合法
+def validate_edit_input(user_id, item, new_value):
+    """
+    驗證編輯的輸入是否合法
+    """    
+    try:
+        if item == '目標':
+            if new_value in GOAL_OPTIONS:
+                return GOAL_OPTIONS[new_value]
+            return None
         
         elif item == '性別':
             if new_value in ['男', '女']:
@@ -394,117 +2673,1372 @@ def validate_edit_input(user_id, item, new_value):
             return None
         
         elif item == '活動量':
-            activity_map = {
-                '1': '久坐', 
-                '2': '輕度活動', 
-                '3': '中度活動', 
-                '4': '高度活動', 
-                '5': '非常活躍'
+            if new_value in ACTIVITY_OPTIONS:
+                return ACTIVITY_OPTIONS[new_value]
+            return None
+        
+    except ValueError:
+        return None
+
+# 計算基礎代謝率 (BMR) 的函數
+def calculate_bmr(gender, age, height, weight):
+    """
+    使用 Harris-Benedict 公式計算基礎代謝率
+    """
+    if gender == '男':
+        bmr = (9.99 * weight) + (6.25 * height) - (4.92 * age) + 5
+    else:  # 女
+        bmr = (9.99 * weight) + (6.25 * height) - (4.92 * age) - 161
+    
+    return round(bmr, 2)
+
+# 計算每日推薦熱量攝取
+def calculate_daily_calories(bmr, activity_level, goal):
+    """
+    根據活動量級別和目標計算每日推薦熱量
+    """
+    activity_multipliers = {
+        '久坐': 1.2,
+        '輕度活動': 1.375,
+        '中度活動': 1.55,
+        '高度活動': 1.725,
+        '非常活躍': 1.9
+    }
+    
+    daily_calories = bmr * activity_multipliers.get(activity_level, 1.2)
+    
+    # 根據目標調整熱量
+    if goal == '增肌':
+        daily_calories += 250  # 增加250卡路里
+    elif goal == '減重':
+        daily_calories *= 0.85  # 減少15%熱量
+    
+    return round(daily_calories, 2)
+
+def compress_image(image_data, max_size_mb=10):
+    """
+    壓縮圖片至指定大小以下
+    :param image_data: 原始圖片的二進制數據
+    :param max_size_mb: 最大目標大小（MB）
+    :return: 壓縮後的圖片數據（bytes）
+    """
+    from PIL import Image
+
+    # 將二進制數據轉換為 PIL Image
+    img = Image.open(BytesIO(image_data))
+    
+    # 初始品質參數
+    quality = 95
+    output = BytesIO()
+    
+    # 如果是 PNG，轉換為 JPEG
+    if img.format == 'PNG':
+        # 如果有透明通道，先將背景轉為白色
+        if img.mode in ('RGBA', 'LA'):
+            background = Image.new('RGB', img.size, (255, 255, 255))
+            background.paste(img, mask=img.split()[-1])
+            img = background
+        elif img.mode != 'RGB':
+            img = img.convert('RGB')
+    
+    # 壓縮圖片直到大小小於目標大小
+    while True:
+        output = BytesIO()
+        img.save(output, format='JPEG', quality=quality)
+        size_mb = len(output.getvalue()) / (1024 * 1024)
+        
+        if size_mb <= max_size_mb or quality <= 5:
+            break
+        
+        quality -= 5
+    
+    return output.getvalue()
+
+# 圖片預先檢查設定，明顯不適合的照片在本地直接回覆，不送到 vision API
+IMAGE_FILTER_ENABLED = os.getenv('IMAGE_FILTER_ENABLED', '1') == '1'
+IMAGE_MIN_SIDE = int(os.getenv('IMAGE_MIN_SIDE', '128'))
+IMAGE_MIN_STDDEV = float(os.getenv('IMAGE_MIN_STDDEV', '8'))
+IMAGE_BLUR_THRESHOLD = float(os.getenv('IMAGE_BLUR_THRESHOLD', '20'))
+IMAGE_DUPLICATE_DISTANCE = int(os.getenv('IMAGE_DUPLICATE_DISTANCE', '4'))
+IMAGE_HASH_HISTORY = int(os.getenv('IMAGE_HASH_HISTORY', '20'))
+IMAGE_HASH_TTL_SECONDS = int(os.getenv('IMAGE_HASH_TTL_SECONDS', str(24 * 3600)))
+IMAGE_HASH_MAX_USERS = int(os.getenv('IMAGE_HASH_MAX_USERS', '10000'))
+# 選用的 ONNX 食物/非食物分類模型 (需要 onnxruntime)，輸入 224x224 RGB，輸出第 IMAGE_CLASSIFIER_FOOD_INDEX 類為食物
+IMAGE_CLASSIFIER_MODEL = os.getenv('IMAGE_CLASSIFIER_MODEL')
+IMAGE_CLASSIFIER_FOOD_INDEX = int(os.getenv('IMAGE_CLASSIFIER_FOOD_INDEX', '1'))
+IMAGE_FOOD_THRESHOLD = float(os.getenv('IMAGE_FOOD_THRESHOLD', '0.5'))
+
+# 每位使用者最近分析過的圖片 (dHash, 分析結果, 時間)，重複的照片直接沿用結果
+# 依最後記錄的順序排列 (最久的在最前面)：超過 IMAGE_HASH_TTL_SECONDS 的結果不再沿用，
+# 使用者數超過 IMAGE_HASH_MAX_USERS 時移除最久未記錄的使用者
+image_hashes = OrderedDict()
+image_hashes_lock = threading.Lock()
+image_classifier = None
+image_classifier_lock = threading.Lock()
+
+IMAGE_REJECT_MESSAGES = {
+    'too_small': "📷 圖片太小，請傳送清楚的食物照片。",
+    'blank': "📷 圖片幾乎是單一顏色，請傳送清楚的食物照片。",
+    'blurry': "📷 圖片太模糊，請對焦後重新拍攝食物照片。",
+    'not_food': "📷 這張圖片看起來不是食物，請傳送食物照片。"
+}
+
+def image_dhash(gray):
+    '''
+    差異雜湊：縮成 9x8 後比較相鄰像素，相似圖片的雜湊只差幾個位元
+    '''
+    pixels = gray.resize((9, 8)).tobytes()
+    value = 0
+    for row in range(8):
+        for col in range(8):
+            value = (value << 1) | (pixels[row * 9 + col] > pixels[row * 9 + col + 1])
+    return value
+
+def load_image_classifier():
+    '''
+    載入 ONNX 分類模型，沒有設定或無法載入時只使用其他檢查
+    '''
+    global image_classifier, IMAGE_CLASSIFIER_MODEL
+    with image_classifier_lock:
+        if image_classifier is None and IMAGE_CLASSIFIER_MODEL:
+            try:
+                import onnxruntime
+                image_classifier = onnxruntime.InferenceSession(
+                    IMAGE_CLASSIFIER_MODEL, providers=['CPUExecutionProvider']
+                )
+            except Exception as e:
+                print(f"Image Classifier Error: {e}")
+                IMAGE_CLASSIFIER_MODEL = None
+    return image_classifier
+
+def classify_food_probability(img):
+    import numpy
+
+    session = load_image_classifier()
+    if session is None:
+        return None
+    data = numpy.asarray(img.convert('RGB').resize((224, 224)), dtype=numpy.float32) / 255.0
+    data = data.transpose(2, 0, 1)[numpy.newaxis]
+    scores = session.run(None, {session.get_inputs()[0].name: data})[0][0]
+    scores = numpy.exp(scores - scores.max())
+    return float(scores[IMAGE_CLASSIFIER_FOOD_INDEX] / scores.sum())
+
+def prefilter_image(user_id, image_data):
+    '''
+    在本地以 CPU 快速檢查壓縮後的圖片 (尺寸、單色、模糊、重複、選用的分類模型)
+    回傳 (不需要呼叫 vision API 時的回覆文字或 None, 圖片雜湊)
+    '''
+    from PIL import Image, ImageFilter, ImageStat
+
+    started_at = time.perf_counter()
+    reason = None
+    reply_text = None
+    image_hash = None
+
+    img = Image.open(BytesIO(image_data))
+    width, height = img.size
+    if min(width, height) < IMAGE_MIN_SIDE:
+        reason = 'too_small'
+    else:
+        # JPEG 可以直接以較低解析度解碼，檢查只需要幾毫秒
+        # 分類模型需要彩色圖片，灰階圖片另外轉換，不改變解碼的色彩模式
+        img.draft('RGB', (512, 512))
+        img = img.convert('RGB')
+        img.thumbnail((512, 512))
+        gray = img.convert('L')
+
+        # 邊緣強度的變異數越低越模糊，去掉濾鏡在圖片邊框產生的假邊緣
+        edges = gray.filter(ImageFilter.FIND_EDGES).crop((2, 2, gray.width - 2, gray.height - 2))
+        if ImageStat.Stat(gray).stddev[0] < IMAGE_MIN_STDDEV:
+            reason = 'blank'
+        elif ImageStat.Stat(edges).var[0] < IMAGE_BLUR_THRESHOLD:
+            reason = 'blurry'
+        else:
+            image_hash = image_dhash(gray)
+            expired_at = time.time() - IMAGE_HASH_TTL_SECONDS
+            with image_hashes_lock:
+                for previous_hash, previous_text, analyzed_at in image_hashes.get(user_id, ()):
+                    if analyzed_at < expired_at:
+                        continue
+                    if bin(previous_hash ^ image_hash).count('1') <= IMAGE_DUPLICATE_DISTANCE:
+                        reason = 'duplicate'
+                        reply_text = f"📷 這張照片與您先前傳送的相同，沿用上次的分析結果：\n\n{previous_text}"
+                        break
+
+            if reason is None and IMAGE_CLASSIFIER_MODEL:
+                probability = classify_food_probability(img)
+                if probability is not None and probability < IMAGE_FOOD_THRESHOLD:
+                    reason = 'not_food'
+
+    record_metric('image_prefilter_checked')
+    record_metric('image_prefilter_seconds', time.perf_counter() - started_at)
+    if reason is not None:
+        record_metric(f'image_prefilter_{reason}')
+        reply_text = reply_text or IMAGE_REJECT_MESSAGES[reason]
+    return reply_text, image_hash
+
+def remember_image_result(user_id, image_hash, reply_text, now=None):
+    if image_hash is None:
+        return
+    now = time.time() if now is None else now
+    with image_hashes_lock:
+        history = image_hashes.get(user_id)
+        if history is None:
+            history = image_hashes[user_id] = deque(maxlen=IMAGE_HASH_HISTORY)
+        else:
+            image_hashes.move_to_end(user_id)
+        history.append((image_hash, reply_text, now))
+
+        # 最前面的使用者最後一次記錄已過期時，整份記錄都不會再沿用
+        while len(image_hashes) > 1:
+            oldest = next(iter(image_hashes.values()))
+            if len(image_hashes) <= IMAGE_HASH_MAX_USERS and oldest[-1][2] >= now - IMAGE_HASH_TTL_SECONDS:
+                break
+            image_hashes.popitem(last=False)
+
+def refund_ai_request(user_id):
+    '''
+    退還 allow_ai_request 扣的額度，例如圖片在預先檢查就被擋下、沒有呼叫 OpenAI
+    持久化佇列的 worker 在另一個程序，額度在 webhook 程序中，無法退還
+    '''
+    if durable_job_queue is not None:
+        return
+    with user_ai_buckets_lock:
+        bucket = user_ai_buckets.get(user_id)
+    if bucket is not None:
+        bucket.refund()
+    tenant = tenants.get(split_user_key(user_id)[0])
+    if tenant is not None and tenant.ai_bucket is not None:
+        tenant.ai_bucket.refund()
+    global_ai_bucket.refund()
+    record_metric('ai_refunded')
+
+# 批次匯入與匯出設定
+ADMIN_TOKEN = os.getenv('ADMIN_TOKEN')
+IMPORT_BATCH_SIZE = int(os.getenv('IMPORT_BATCH_SIZE', '1000'))
+PROFILE_FIELDS = ['user_id', 'goal', 'gender', 'age', 'height', 'weight', 'activity_level']
+FOOD_LOG_FIELDS = ['user_id', 'date', 'timestamp', 'name', 'calories']
+# Parquet 欄位型別 (pyarrow 的型別名稱)，不依第一批資料推斷，欄位全為空值的批次也不會改變型別
+PARQUET_FIELD_TYPES = {
+    'user_id': 'string', 'goal': 'string', 'gender': 'string', 'age': 'int32',
+    'height': 'float64', 'weight': 'float64', 'activity_level': 'string',
+    'date': 'string', 'timestamp': 'int64', 'name': 'string', 'calories': 'float64'
+}
+
+def iter_profile_rows():
+    """
+    逐筆產生使用者資料，只複製 user_id 清單，不複製資料本身
+    """
+    for user_id in list(user_profiles):
+        profile = user_profiles.get(user_id)
+        if profile is None:
+            continue
+        yield {
+            'user_id': user_id,
+            'goal': profile.goal,
+            'gender': profile.gender,
+            'age': profile.age,
+            'height': profile.height,
+            'weight': profile.weight,
+            'activity_level': profile.activity_level
+        }
+
+def iter_food_log_rows():
+    """
+    逐筆產生飲食記錄
+    """
+    for user_id in list(user_profiles):
+        profile = user_profiles.get(user_id)
+        if profile is None or profile.daily_tracker is None:
+            continue
+        day = date.fromordinal(profile.daily_tracker.day).isoformat()
+        for food in list(profile.daily_tracker.food_log):
+            yield {
+                'user_id': user_id,
+                'date': day,
+                'timestamp': food.timestamp,
+                'name': food.name,
+                'calories': food.calories
             }
-            if new_value in activity_map:
-                return activity_map[new_value]
-            return None
-        
-    except ValueError:
+
+def stream_csv(rows, fields):
+    import csv
+
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=fields)
+    writer.writeheader()
+    for row in rows:
+        writer.writerow(row)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue()
+
+def stream_jsonl(rows):
+    for row in rows:
+        yield json.dumps(row, ensure_ascii=False) + '\n'
+
+def write_parquet(rows, fields, output, batch_size=IMPORT_BATCH_SIZE):
+    """
+    以固定大小的 record batch 寫出 Parquet，需要安裝 pyarrow
+    """
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise RuntimeError("匯出 Parquet 需要安裝 pyarrow")
+
+    schema = pa.schema([(field_name, getattr(pa, PARQUET_FIELD_TYPES[field_name])()) for field_name in fields])
+    writer = pq.ParquetWriter(output, schema)
+    batch = []
+
+    def flush():
+        writer.write_table(pa.Table.from_pylist(batch, schema=schema))
+        batch.clear()
+
+    for row in rows:
+        batch.append({field_name: row[field_name] for field_name in fields})
+        if len(batch) >= batch_size:
+            flush()
+    if batch:
+        flush()
+    writer.close()
+
+def read_rows(lines, data_format):
+    if data_format == 'csv':
+        import csv
+        yield from csv.DictReader(lines)
+    elif data_format == 'jsonl':
+        for line in lines:
+            if line.strip():
+                yield json.loads(line)
+    else:
+        raise ValueError(f"不支援的匯入格式: {data_format}")
+
+def validate_profile_row(row):
+    """
+    以 validate_edit_input 相同的規則驗證匯入的個人資料，不合法時回傳 None
+    目標與活動量可使用名稱或選項編號
+    """
+    goal = row.get('goal')
+    if goal not in GOAL_OPTIONS.values():
+        goal = validate_edit_input(None, '目標', goal)
+    activity_level = row.get('activity_level')
+    if activity_level not in ACTIVITY_OPTIONS.values():
+        activity_level = validate_edit_input(None, '活動量', activity_level)
+
+    values = {
+        'goal': goal,
+        'gender': validate_edit_input(None, '性別', row.get('gender')),
+        'age': validate_edit_input(None, '年齡', str(row.get('age'))),
+        'height': validate_edit_input(None, '身高', str(row.get('height'))),
+        'weight': validate_edit_input(None, '體重', str(row.get('weight'))),
+        'activity_level': activity_level
+    }
+    if not row.get('user_id') or any(value is None for value in values.values()):
+        return None
+    return values
+
+def validate_food_log_row(row):
+    try:
+        calories = float(row['calories'])
+        timestamp = int(float(row['timestamp']))
+        day = date.fromisoformat(row['date']).toordinal()
+    except (KeyError, TypeError, ValueError):
+        return None
+    if not row.get('user_id') or not row.get('name') or not 0 < calories <= 10000:
+        return None
+    return {'name': row['name'], 'calories': calories, 'timestamp': timestamp, 'day': day}
+
+def apply_profile_batch(batch):
+    """
+    回傳無法匯入的 [(批次中的位置, 原因)]，個人資料驗證後都可以匯入
+    """
+    with state_lock:
+        for user_id, values in batch:
+            ensure_profile(user_id)
+            for field_name, value in values.items():
+                update_profile(user_id, field_name, value)
+
+            bmr = calculate_bmr(values['gender'], values['age'], values['height'], values['weight'])
+            daily_calories = calculate_daily_calories(bmr, values['activity_level'], values['goal'])
+            if user_profiles[user_id].daily_tracker is None:
+                reset_daily_tracker(user_id, daily_calories)
+            else:
+                update_total_calories(user_id, daily_calories)
+            set_setup_stage(user_id, 'ready')
+            if REMINDER_SCHEDULER:
+                schedule_reminders(user_id)
+    return []
+
+def apply_food_log_batch(batch):
+    """
+    今日的記錄加入每日追蹤 (追蹤日期不是今天時先重置)，
+    最近 DIET_HISTORY_DAYS 天內的過去記錄只加入每日彙總 (平均攝取與飲食摘要)
+    回傳無法匯入的 [(批次中的位置, 原因)]
+    """
+    today = date.today().toordinal()
+    rejected = []
+    with state_lock:
+        for index, (user_id, values) in enumerate(batch):
+            profile = user_profiles.get(user_id)
+            if profile is None or profile.daily_tracker is None:
+                rejected.append((index, "使用者不存在或尚未完成設定"))
+                continue
+            day = values['day']
+            if day > today:
+                rejected.append((index, "日期在今天之後"))
+                continue
+            if day <= today - DIET_HISTORY_DAYS:
+                rejected.append((index, f"日期超過 {DIET_HISTORY_DAYS} 天，不在飲食記錄保留範圍內"))
+                continue
+
+            if day == today and profile.daily_tracker.day != today:
+                reset_daily_tracker(user_id, profile.daily_tracker.total_calories)
+            if day == user_profiles[user_id].daily_tracker.day:
+                commit_event(EVENT_FOOD_ADD, user_id, values['name'], values['calories'], values['timestamp'])
+            else:
+                commit_event(EVENT_HISTORY_ADD, user_id, day, values['name'], values['calories'])
+    return rejected
+
+def import_rows(kind, rows):
+    """
+    驗證並分批寫入資料，回傳匯入統計
+    """
+    validate, apply_batch = {
+        'profiles': (validate_profile_row, apply_profile_batch),
+        'food_logs': (validate_food_log_row, apply_food_log_batch)
+    }[kind]
+
+    # errors 為略過的行號 (最多 20 筆)，reasons 為各原因的筆數
+    result = {'imported': 0, 'skipped': 0, 'errors': [], 'reasons': Counter()}
+
+    def skip(line_number, reason):
+        result['skipped'] += 1
+        result['reasons'][reason] += 1
+        if len(result['errors']) < 20:
+            result['errors'].append(line_number)
+
+    def flush():
+        rejected = apply_batch(batch)
+        for index, reason in rejected:
+            skip(line_numbers[index], reason)
+        result['imported'] += len(batch) - len(rejected)
+        batch.clear()
+        line_numbers.clear()
+
+    batch = []
+    line_numbers = []
+    for line_number, row in enumerate(rows, start=1):
+        values = validate(row)
+        if values is None:
+            skip(line_number, "格式錯誤")
+            continue
+        batch.append((row['user_id'], values))
+        line_numbers.append(line_number)
+        if len(batch) >= IMPORT_BATCH_SIZE:
+            flush()
+    if batch:
+        flush()
+    result['errors'].sort()
+    result['reasons'] = dict(result['reasons'])
+    return result
+
+def export_rows(kind):
+    if kind == 'profiles':
+        return iter_profile_rows(), PROFILE_FIELDS
+    if kind == 'food_logs':
+        return iter_food_log_rows(), FOOD_LOG_FIELDS
+    raise ValueError(f"不支援的資料種類: {kind}")
+
+def require_admin():
+    # 未設定 ADMIN_TOKEN 時不開放管理端點
+    if not ADMIN_TOKEN or request.headers.get('Authorization') != f"Bearer {ADMIN_TOKEN}":
+        abort(403)
+
+def admin_export(kind):
+    require_admin()
+    if kind not in ('profiles', 'food_logs'):
+        abort(404)
+    rows, fields = export_rows(kind)
+    data_format = request.args.get('format', 'jsonl')
+
+    if data_format == 'csv':
+        return Response(stream_csv(rows, fields), mimetype='text/csv')
+    if data_format == 'jsonl':
+        return Response(stream_jsonl(rows), mimetype='application/x-ndjson')
+    if data_format == 'parquet':
+        output = tempfile.TemporaryFile()
+        write_parquet(rows, fields, output)
+        output.seek(0)
+        return send_file(output, mimetype='application/vnd.apache.parquet', download_name=f"{kind}.parquet")
+    abort(400)
+
+def admin_import(kind):
+    require_admin()
+    if kind not in ('profiles', 'food_logs'):
+        abort(404)
+    data_format = request.args.get('format', 'jsonl')
+    if data_format not in ('csv', 'jsonl'):
+        abort(400)
+    lines = io.TextIOWrapper(request.stream, encoding='utf-8', newline='')
+    return import_rows(kind, read_rows(lines, data_format))
+
+# 統計快照設定：定期將使用者資料與飲食記錄匯出成 NumPy 欄位陣列 (.npz)，
+# 管理報表只讀取快照，不佔用處理 webhook 的狀態與鎖
+# 使用者資料與圖片請求數只在各實例的記憶體中，每個實例寫入自己的快照 (例如 analytics.<實例>.npz)，
+# 讀取時合併同一目錄中所有實例的快照；ANALYTICS_INSTANCE_ID 預設為主機名稱，
+# 同一台主機執行多個程序時需分別設定。超過 ANALYTICS_STALE_SECONDS 未更新的快照視為已停止的實例
+ANALYTICS_SNAPSHOT_PATH = os.getenv('ANALYTICS_SNAPSHOT_PATH')
+ANALYTICS_INSTANCE_ID = os.getenv('ANALYTICS_INSTANCE_ID')
+ANALYTICS_INTERVAL_SECONDS = float(os.getenv('ANALYTICS_INTERVAL_SECONDS', '3600'))
+ANALYTICS_STALE_SECONDS = float(os.getenv('ANALYTICS_STALE_SECONDS', str(3 * ANALYTICS_INTERVAL_SECONDS)))
+ANALYTICS_IMAGE_HOURS = int(os.getenv('ANALYTICS_IMAGE_HOURS', '168'))
+# 類別欄位以編號儲存，0 表示尚未設定
+ANALYTICS_CATEGORIES = {
+    'goal': [None] + list(GOAL_OPTIONS.values()),
+    'gender': [None, '男', '女'],
+    'activity_level': [None] + list(ACTIVITY_OPTIONS.values())
+}
+ANALYTICS_METRICS = ['age', 'height', 'weight', 'target_calories', 'today_calories', 'avg_intake', 'intake_ratio']
+
+# 每小時收到的圖片分析請求數，key 為 Unix 時間 // 3600
+image_requests_by_hour = Counter()
+analytics_cache = {}
+
+def record_image_request(now=None):
+    hour = int((time.time() if now is None else now) // 3600)
+    with metrics_lock:
+        if hour not in image_requests_by_hour:
+            for old_hour in [h for h in image_requests_by_hour if h <= hour - ANALYTICS_IMAGE_HOURS]:
+                del image_requests_by_hour[old_hour]
+        image_requests_by_hour[hour] += 1
+
+def build_analytics_snapshot(today=None):
+    """
+    將所有使用者整理成欄位陣列，每位使用者一列；今日飲食記錄另存成以列號對應使用者的陣列
+    與匯出相同，只複製 user_id 清單，不持有 state_lock
+    """
+    import numpy
+
+    today = date.today().toordinal() if today is None else today
+    user_ids = list(user_profiles)
+    count = len(user_ids)
+    codes = {name: numpy.zeros(count, dtype=numpy.int8) for name in ANALYTICS_CATEGORIES}
+    lookups = {name: {value: code for code, value in enumerate(values)} for name, values in ANALYTICS_CATEGORIES.items()}
+    tenant_codes = numpy.zeros(count, dtype=numpy.int16)
+    tenant_names = {}
+    columns = {name: numpy.full(count, numpy.nan, dtype=numpy.float32) for name in ANALYTICS_METRICS[:-1]}
+    food_users, food_timestamps, food_calories = [], [], []
+
+    for row, user_id in enumerate(user_ids):
+        profile = user_profiles.get(user_id)
+        if profile is None:
+            continue
+        for name, lookup in lookups.items():
+            codes[name][row] = lookup.get(getattr(profile, name), 0)
+        tenant_id, _ = split_user_key(user_id)
+        tenant_codes[row] = tenant_names.setdefault(tenant_id, len(tenant_names))
+        for name in ('age', 'height', 'weight'):
+            value = getattr(profile, name)
+            if value is not None:
+                columns[name][row] = value
+
+        daily_tracker = profile.daily_tracker
+        if daily_tracker is None:
+            continue
+        columns['target_calories'][row] = daily_tracker.total_calories
+        if daily_tracker.day == today:
+            columns['today_calories'][row] = daily_tracker.consumed_calories
+            for food in list(daily_tracker.food_log):
+                food_users.append(row)
+                food_timestamps.append(food.timestamp)
+                food_calories.append(food.calories)
+
+        # 平均攝取只計算已結束且有記錄的日子，與飲食摘要相同
+        if profile.diet_history is not None:
+            past_calories = [
+                summary.calories for day, summary in list(profile.diet_history.days.items())
+                if today - DIET_HISTORY_DAYS < day < today and summary.foods
+            ]
+            if past_calories:
+                columns['avg_intake'][row] = sum(past_calories) / len(past_calories)
+
+    with metrics_lock:
+        image_hours = sorted(image_requests_by_hour.items())
+
+    return {
+        'generated_at': numpy.array(time.time()),
+        **{f'{name}_code': column for name, column in codes.items()},
+        'tenant_code': tenant_codes,
+        'tenant_names': numpy.array(list(tenant_names), dtype=str),
+        **columns,
+        'food_user': numpy.array(food_users, dtype=numpy.int32),
+        'food_timestamp': numpy.array(food_timestamps, dtype=numpy.int64),
+        'food_calories': numpy.array(food_calories, dtype=numpy.float32),
+        'image_hour': numpy.array([hour for hour, _ in image_hours], dtype=numpy.int64),
+        'image_count': numpy.array([count for _, count in image_hours], dtype=numpy.int64)
+    }
+
+def analytics_instance_path(path=None):
+    """
+    這個實例的快照檔案，例如 analytics.npz 對應 analytics.<實例>.npz
+    """
+    import socket
+
+    root, extension = os.path.splitext(path or ANALYTICS_SNAPSHOT_PATH)
+    return f"{root}.{ANALYTICS_INSTANCE_ID or socket.gethostname()}{extension}"
+
+def analytics_snapshot_files(path=None, include_stale=False):
+    """
+    回傳所有實例的快照 {檔案: mtime}，預設不包含比最新的快照舊 ANALYTICS_STALE_SECONDS 以上的檔案
+    path 本身存在時 (例如舊版或單一實例寫入的快照) 也一併讀取
+    """
+    path = path or ANALYTICS_SNAPSHOT_PATH
+    directory = os.path.dirname(os.path.abspath(path))
+    root, extension = os.path.splitext(os.path.basename(path))
+    try:
+        names = os.listdir(directory)
+    except FileNotFoundError:
+        return {}
+
+    files = {}
+    for name in sorted(names):
+        if name == root + extension or (name.startswith(root + '.') and name.endswith(extension)):
+            try:
+                files[os.path.join(directory, name)] = os.stat(os.path.join(directory, name)).st_mtime_ns
+            except FileNotFoundError:
+                continue
+    if not files or include_stale:
+        return files
+    newest = max(files.values())
+    return {name: mtime for name, mtime in files.items() if mtime >= newest - ANALYTICS_STALE_SECONDS * 1e9}
+
+def write_analytics_snapshot(path=None):
+    """
+    寫入這個實例的統計快照，先寫暫存檔再替換，讀取端不會讀到寫到一半的檔案
+    已停止的實例留下的快照在這裡移除
+    """
+    import numpy
+
+    path = path or ANALYTICS_SNAPSHOT_PATH
+    started_at = time.perf_counter()
+    snapshot = build_analytics_snapshot()
+    instance_path = analytics_instance_path(path)
+    directory = os.path.dirname(os.path.abspath(instance_path))
+    with tempfile.NamedTemporaryFile(dir=directory, suffix='.npz', delete=False) as output:
+        numpy.savez(output, **snapshot)
+    os.replace(output.name, instance_path)
+
+    stale_before = time.time_ns() - ANALYTICS_STALE_SECONDS * 1e9
+    for name, mtime in analytics_snapshot_files(path, include_stale=True).items():
+        if mtime < stale_before:
+            try:
+                os.remove(name)
+            except OSError as e:
+                print(f"Analytics Snapshot Error: {e}")
+    record_metric('analytics_snapshots')
+    record_metric('analytics_snapshot_seconds', time.perf_counter() - started_at)
+    return len(snapshot['tenant_code'])
+
+def analytics_loop():
+    while True:
+        try:
+            write_analytics_snapshot()
+        except Exception as e:
+            print(f"Analytics Snapshot Error: {e}")
+        time.sleep(ANALYTICS_INTERVAL_SECONDS)
+
+def start_analytics_exporter():
+    threading.Thread(target=analytics_loop, daemon=True).start()
+
+def merge_analytics_snapshots(snapshots):
+    """
+    合併多個實例的快照：使用者列依序串接，頻道重新編號，飲食記錄的列號加上位移，
+    圖片請求數依小時加總；generated_at 為最舊的快照時間
+    """
+    import numpy
+
+    tenant_index = {}
+    tenant_codes, food_users = [], []
+    image_counts = Counter()
+    offset = 0
+    for snapshot in snapshots:
+        codes = [tenant_index.setdefault(str(tenant_id), len(tenant_index)) for tenant_id in snapshot['tenant_names']]
+        tenant_codes.append(numpy.array(codes or [0], dtype=numpy.int16)[snapshot['tenant_code']])
+        food_users.append(snapshot['food_user'] + offset)
+        offset += len(snapshot['tenant_code'])
+        for hour, count in zip(snapshot['image_hour'].tolist(), snapshot['image_count'].tolist()):
+            image_counts[hour] += count
+
+    image_hours = sorted(image_counts.items())
+    merged = {
+        name: numpy.concatenate([snapshot[name] for snapshot in snapshots])
+        for name in snapshots[0]
+        if name not in ('generated_at', 'tenant_code', 'tenant_names', 'food_user', 'image_hour', 'image_count')
+    }
+    return {
+        **merged,
+        'generated_at': numpy.array(min(float(snapshot['generated_at']) for snapshot in snapshots)),
+        'tenant_code': numpy.concatenate(tenant_codes),
+        'tenant_names': numpy.array(list(tenant_index), dtype=str),
+        'food_user': numpy.concatenate(food_users).astype(numpy.int32),
+        'image_hour': numpy.array([hour for hour, _ in image_hours], dtype=numpy.int64),
+        'image_count': numpy.array([count for _, count in image_hours], dtype=numpy.int64)
+    }
+
+def load_analytics_snapshot(path=None):
+    """
+    讀取並合併所有實例的統計快照，檔案未變更時使用已載入的陣列
+    """
+    import numpy
+
+    path = path or ANALYTICS_SNAPSHOT_PATH
+    files = analytics_snapshot_files(path)
+    if not files:
+        raise FileNotFoundError(f"找不到統計快照: {path}")
+    key = tuple(files.items())
+    cached = analytics_cache.get(('merged', path))
+    if cached is not None and cached[0] == key:
+        return cached[1]
+
+    snapshots = []
+    for name, mtime in files.items():
+        cached = analytics_cache.get(name)
+        if cached is None or cached[0] != mtime:
+            with numpy.load(name) as data:
+                cached = analytics_cache[name] = (mtime, {field: data[field] for field in data.files})
+        snapshots.append(cached[1])
+    snapshot = snapshots[0] if len(snapshots) == 1 else merge_analytics_snapshots(snapshots)
+    analytics_cache[('merged', path)] = (key, snapshot)
+    return snapshot
+
+def analytics_metric(snapshot, metric):
+    if metric == 'intake_ratio':
+        return snapshot['avg_intake'] / snapshot['target_calories']
+    if metric not in ANALYTICS_METRICS:
+        raise ValueError(f"不支援的統計欄位: {metric}")
+    return snapshot[metric]
+
+def group_report(snapshot, group_by=(), metric='avg_intake', percentiles=(50, 90)):
+    """
+    依類別欄位分組，計算人數以及指定欄位的平均值與百分位數 (排除未填寫的值)
+    類別編號組合成連續的分組編號，以 bincount 與排序向量運算，不逐列掃描
+    """
+    import numpy
+
+    labels = []
+    key = numpy.zeros(len(snapshot['tenant_code']), dtype=numpy.int64)
+    key_range = 1
+    for name in group_by:
+        if name == 'tenant':
+            names = [str(tenant_id) for tenant_id in snapshot['tenant_names']]
+            column = snapshot['tenant_code']
+        elif name in ANALYTICS_CATEGORIES:
+            names = ANALYTICS_CATEGORIES[name]
+            column = snapshot[f'{name}_code']
+        else:
+            raise ValueError(f"不支援的分組欄位: {name}")
+        key = key * max(len(names), 1) + column
+        key_range *= max(len(names), 1)
+        labels.append((name, names))
+    # 分組數少時以 int16 排序，numpy 對小整數使用較快的 radix sort
+    if key_range < 2 ** 15:
+        key = key.astype(numpy.int16)
+
+    users = numpy.bincount(key, minlength=key_range)
+    groups = numpy.flatnonzero(users)
+
+    values = analytics_metric(snapshot, metric).astype(numpy.float64)
+    valid = ~numpy.isnan(values)
+    valid_keys = key[valid]
+    valid_values = values[valid]
+    counts = numpy.bincount(valid_keys, minlength=key_range)
+    sums = numpy.bincount(valid_keys, weights=valid_values, minlength=key_range)
+
+    # 依分組排列後各組分別排序，百分位數即為組內位置的線性插值
+    sorted_values = valid_values[numpy.argsort(valid_keys, kind='stable')]
+    starts = numpy.concatenate(([0], numpy.cumsum(counts)[:-1]))
+    for group in numpy.flatnonzero(counts):
+        sorted_values[starts[group]:starts[group] + counts[group]].sort()
+    quantiles = {}
+    for percentile in percentiles:
+        position = starts + (numpy.maximum(counts, 1) - 1) * (percentile / 100)
+        lower = numpy.floor(position).astype(numpy.int64)
+        upper = numpy.minimum(lower + 1, starts + numpy.maximum(counts, 1) - 1)
+        if len(sorted_values):
+            lower_values = sorted_values[numpy.minimum(lower, len(sorted_values) - 1)]
+            upper_values = sorted_values[numpy.minimum(upper, len(sorted_values) - 1)]
+            quantiles[percentile] = lower_values + (upper_values - lower_values) * (position - lower)
+        else:
+            quantiles[percentile] = numpy.zeros(key_range)
+
+    rows = []
+    for group in groups:
+        row = {}
+        remainder = int(group)
+        for name, names in reversed(labels):
+            remainder, code = divmod(remainder, max(len(names), 1))
+            row[name] = names[code] if code < len(names) else None
+        row = dict(reversed(list(row.items())))
+        row['users'] = int(users[group])
+        row['count'] = int(counts[group])
+        if counts[group]:
+            row['mean'] = round(float(sums[group] / counts[group]), 2)
+            for percentile in percentiles:
+                row[f'p{percentile:g}'] = round(float(quantiles[percentile][group]), 2)
+        rows.append(row)
+
+    return {
+        'generated_at': datetime.fromtimestamp(float(snapshot['generated_at'])).isoformat(timespec='seconds'),
+        'metric': metric,
+        'group_by': list(group_by),
+        'groups': rows
+    }
+
+def hourly_report(snapshot):
+    """
+    每小時的圖片分析請求數，以及今日飲食記錄依記錄時間 (0-23 時) 的分布
+    """
+    import numpy
+
+    utc_offset = datetime.now().astimezone().utcoffset().total_seconds()
+    food_hours = ((snapshot['food_timestamp'] + int(utc_offset)) // 3600) % 24
+    return {
+        'generated_at': datetime.fromtimestamp(float(snapshot['generated_at'])).isoformat(timespec='seconds'),
+        'image_requests': [
+            {'hour': datetime.fromtimestamp(int(hour) * 3600).strftime('%Y-%m-%d %H:00'), 'count': int(count)}
+            for hour, count in zip(snapshot['image_hour'], snapshot['image_count'])
+        ],
+        'food_logs_by_hour': numpy.bincount(food_hours, minlength=24).tolist()
+    }
+
+def analytics_report(kind, group_by=(), metric='avg_intake', percentiles=(50, 90), path=None):
+    snapshot = load_analytics_snapshot(path)
+    if kind == 'groups':
+        return group_report(snapshot, group_by, metric, percentiles)
+    if kind == 'hourly':
+        return hourly_report(snapshot)
+    raise ValueError(f"不支援的報表種類: {kind}")
+
+def parse_report_args(group_by, percentiles):
+    group_by = [name for name in (group_by or '').split(',') if name]
+    percentiles = [float(value) for value in (percentiles or '50,90').split(',') if value]
+    if any(not 0 <= value <= 100 for value in percentiles):
+        raise ValueError("百分位數需介於 0 到 100")
+    return group_by, percentiles
+
+def admin_report(kind):
+    require_admin()
+    if kind not in ('groups', 'hourly'):
+        abort(404)
+    if not ANALYTICS_SNAPSHOT_PATH or not analytics_snapshot_files():
+        abort(503)
+    try:
+        group_by, percentiles = parse_report_args(request.args.get('group_by'), request.args.get('percentiles'))
+        started_at = time.perf_counter()
+        report = analytics_report(kind, group_by, request.args.get('metric', 'avg_intake'), percentiles)
+    except ValueError as e:
+        return Response(json.dumps({'error': str(e)}, ensure_ascii=False), status=400, mimetype='application/json')
+    report['elapsed_ms'] = round((time.perf_counter() - started_at) * 1000, 2)
+    return Response(json.dumps(report, ensure_ascii=False), mimetype='application/json')
+
+def next_reminder_time(kind, now):
+    """
+    計算下一次提醒的時間 (Unix 秒數)，依伺服器本地時間
+    """
+    hour, minute = map(int, REMINDER_TIMES[kind].split(':'))
+    current = datetime.fromtimestamp(now)
+    due = current.replace(hour=hour, minute=minute, second=0, microsecond=0)
+    if due.timestamp() <= now:
+        due += timedelta(days=1)
+    return due.timestamp()
+
+def schedule_reminders(user_id, now=None):
+    now = reminder_scheduler.clock() if now is None else now
+    for kind in REMINDER_TIMES:
+        reminder_scheduler.schedule(user_id, kind, next_reminder_time(kind, now))
+
+def build_reminder_text(user_id, kind, now):
+    """
+    產生提醒文字，不需要提醒時回傳 None
+    """
+    profile = user_profiles.get(user_id)
+    if profile is None or profile.daily_tracker is None or not profile.reminders_enabled:
+        return None
+
+    if kind in REMINDER_MEAL_NAMES:
+        return (
+            f"🍱 {REMINDER_MEAL_NAMES[kind]}時間到了！\n"
+            "記得用「新增記錄 <食物名稱> <熱量>」記錄飲食"
+        )
+
+    daily_tracker = profile.daily_tracker
+    consumed_calories = daily_tracker.consumed_calories
+    if daily_tracker.day != date.fromtimestamp(now).toordinal():
+        consumed_calories = 0
+    remaining_calories = daily_tracker.total_calories - consumed_calories
+    remaining_calories = round(remaining_calories / REMINDER_SUMMARY_ROUNDING) * REMINDER_SUMMARY_ROUNDING
+    return (
+        f"🌙 今日熱量總結\n"
+        f"剩餘可攝取熱量約 {remaining_calories} 大卡\n"
+        "(輸入「今日狀態」查看詳細記錄)"
+    )
+
+def send_due_reminders(now=None):
+    """
+    送出到期的提醒：同一頻道中相同內容的使用者合併，每次 multicast 最多 500 人，並排定下一次提醒
+    回傳送出的 multicast 次數
+    """
+    now = reminder_scheduler.clock() if now is None else now
+    recipients = {}
+    for user_id, kind, minute in reminder_scheduler.pop_due(now):
+        if user_id not in user_profiles:
+            continue
+        reminder_scheduler.schedule(user_id, kind, next_reminder_time(kind, now))
+        if now - minute * 60 > REMINDER_GRACE_SECONDS:
+            record_metric('reminders_skipped')
+            continue
+        text = build_reminder_text(user_id, kind, now)
+        tenant_id, line_user_id = split_user_key(user_id)
+        if text is not None and tenant_id in tenants:
+            recipients.setdefault((tenant_id, text), []).append(line_user_id)
+
+    multicasts = 0
+    for (tenant_id, text), user_ids in recipients.items():
+        current_tenant.set(tenant_id)
+        for start in range(0, len(user_ids), MULTICAST_MAX_RECIPIENTS):
+            batch = user_ids[start:start + MULTICAST_MAX_RECIPIENTS]
+            try:
+                line_bot_api.multicast(batch, TextSendMessage(text=text))
+                record_metric('reminders_sent', len(batch))
+            except Exception as e:
+                print(f"Multicast Error: {e}")
+            multicasts += 1
+    return multicasts
+
+def reminder_loop():
+    while True:
+        delay = reminder_scheduler.seconds_until_next()
+        reminder_scheduler.wakeup.wait(timeout=60 if delay is None else min(delay, 60))
+        reminder_scheduler.wakeup.clear()
+        try:
+            send_due_reminders()
+        except Exception as e:
+            print(f"Reminder Error: {e}")
+
+def start_reminder_scheduler():
+    """
+    為所有已完成設定的使用者排定提醒並啟動排程執行緒
+    """
+    for user_id in list(user_profiles):
+        if user_profiles[user_id].daily_tracker is not None:
+            schedule_reminders(user_id)
+    threading.Thread(target=reminder_loop, daemon=True).start()
+
+# 流量記錄設定：依 TRAFFIC_SAMPLE_RATE 抽樣 webhook，匿名化後寫入 TRAFFIC_CAPTURE_DIR 的輪替記錄檔
+# 每筆記錄包含 webhook 內容、處理時間 (牆鐘與 CPU) 以及每次 LINE/OpenAI 呼叫的回應時間，供 replay 重播
+TRAFFIC_CAPTURE_DIR = os.getenv('TRAFFIC_CAPTURE_DIR')
+TRAFFIC_SAMPLE_RATE = float(os.getenv('TRAFFIC_SAMPLE_RATE', '0.01'))
+TRAFFIC_SEGMENT_BYTES = int(os.getenv('TRAFFIC_SEGMENT_BYTES', str(16 * 1024 * 1024)))
+TRAFFIC_MAX_SEGMENTS = int(os.getenv('TRAFFIC_MAX_SEGMENTS', '20'))
+# 使用者 ID 以 HMAC 取代，設定固定的鹽值才能跨程序對應同一位使用者
+TRAFFIC_ANON_SALT = os.getenv('TRAFFIC_ANON_SALT', '').encode() or os.urandom(16)
+# 文字訊息只保留第一個詞 (指令) 與數字，其他文字遮蔽
+TRAFFIC_REDACT_TEXT = os.getenv('TRAFFIC_REDACT_TEXT', '1') == '1'
+
+traffic_trace = contextvars.ContextVar('traffic_trace', default=None)
+traffic_recorder = None
+# 完成的記錄交給 traffic_sink：記錄模式寫入檔案，重播模式收集結果
+traffic_sink = None
+
+class TrafficRecorder:
+    '''
+    在背景執行緒寫入 gzip 壓縮的 JSON lines，每段超過大小上限就換新檔並刪除最舊的記錄段
+    佇列已滿時直接捨棄記錄，不拖慢 webhook
+    '''
+    def __init__(self, directory, segment_bytes, max_segments):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.max_segments = max_segments
+        self.records = queue.Queue(maxsize=10000)
+        os.makedirs(directory, exist_ok=True)
+        segments = self.segments()
+        self.segment = segments[-1] + 1 if segments else 0
+        self.file = None
+
+    def segments(self):
+        return sorted(
+            int(name[len('traffic-'):-len('.jsonl.gz')])
+            for name in os.listdir(self.directory)
+            if name.startswith('traffic-') and name.endswith('.jsonl.gz')
+        )
+
+    def segment_path(self, segment):
+        return os.path.join(self.directory, f"traffic-{segment:08d}.jsonl.gz")
+
+    def write(self, record):
+        try:
+            self.records.put_nowait(record)
+        except queue.Full:
+            record_metric('traffic_dropped')
+
+    def open_segment(self):
+        import gzip
+
+        self.file = gzip.open(self.segment_path(self.segment), 'wb')
+        for old_segment in self.segments()[:-self.max_segments]:
+            os.remove(self.segment_path(old_segment))
+
+    def loop(self):
+        while True:
+            record = self.records.get()
+            if self.file is None:
+                self.open_segment()
+            self.file.write((json.dumps(record, ensure_ascii=False, separators=(',', ':')) + '\n').encode('utf-8'))
+            # 佇列清空時 flush，程序中斷也只會遺失最後一小段
+            if self.records.empty():
+                self.file.flush()
+            if self.file.fileobj.tell() >= self.segment_bytes:
+                self.file.close()
+                self.segment += 1
+                self.open_segment()
+
+    def start(self):
+        threading.Thread(target=self.loop, daemon=True).start()
+
+def read_traffic(directory):
+    '''
+    依序讀出記錄檔中的記錄，略過程序中斷時未寫完的結尾
+    '''
+    import gzip
+
+    names = sorted(name for name in os.listdir(directory) if name.startswith('traffic-'))
+    for name in names:
+        try:
+            with gzip.open(os.path.join(directory, name), 'rt', encoding='utf-8') as f:
+                for line in f:
+                    if line.endswith('\n'):
+                        yield json.loads(line)
+        except (EOFError, gzip.BadGzipFile, zlib.error):
+            continue
+
+def anonymize_id(value):
+    return value[:1] + hmac.new(TRAFFIC_ANON_SALT, value.encode(), hashlib.sha256).hexdigest()[:32]
+
+def redact_text(text):
+    command, _, rest = text.partition(' ')
+    if not rest:
+        return command if len(command) <= 4 else re.sub(r'[^\d\s]', '＊', command)
+    return command + ' ' + re.sub(r'[^\d\s]', '＊', rest)
+
+def anonymize_webhook_body(body):
+    '''
+    以雜湊取代 webhook 中的使用者、群組、訊息 ID 與 reply token，保留事件結構
+    '''
+    data = json.loads(body)
+    if 'destination' in data:
+        data['destination'] = anonymize_id(data['destination'])
+    for event in data.get('events', []):
+        source = event.get('source', {})
+        for key in ('userId', 'groupId', 'roomId'):
+            if key in source:
+                source[key] = anonymize_id(source[key])
+        for key in ('replyToken', 'webhookEventId'):
+            if key in event:
+                event[key] = anonymize_id(event[key])
+        message = event.get('message')
+        if message:
+            if 'id' in message:
+                message['id'] = anonymize_id(message['id'])
+            if TRAFFIC_REDACT_TEXT and 'text' in message:
+                message['text'] = redact_text(message['text'])
+            message.pop('contentProvider', None)
+    return data
+
+def timed_upstream_call(name, func):
+    '''
+    量測 LINE/OpenAI 呼叫時間並加入目前的記錄
+    '''
+    trace = traffic_trace.get()
+
+    if inspect.iscoroutinefunction(func):
+        async def timed_async(*args, **kwargs):
+            started_at = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                trace['upstream'].append([name, round((time.perf_counter() - started_at) * 1000, 2)])
+        return timed_async
+
+    def timed(*args, **kwargs):
+        started_at = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            trace['upstream'].append([name, round((time.perf_counter() - started_at) * 1000, 2)])
+    return timed
+
+def start_job_trace(job):
+    if traffic_sink is None or 'trace_id' not in job:
+        return None
+    trace = {
+        'type': 'job',
+        'id': job['trace_id'],
+        'kind': job['kind'],
+        'wait_ms': round((time.time() - job.get('queued_at', job['event_time'])) * 1000, 2),
+        'upstream': []
+    }
+    return trace, traffic_trace.set(trace), time.perf_counter(), time.thread_time()
+
+def finish_job_trace(started):
+    if started is None:
+        return
+    trace, token, started_wall, started_cpu = started
+    trace['wall_ms'] = round((time.perf_counter() - started_wall) * 1000, 2)
+    trace['cpu_ms'] = round((time.thread_time() - started_cpu) * 1000, 2)
+    traffic_trace.reset(token)
+    traffic_sink(trace)
+
+def handle_webhook(tenant_id, body, signature, trace=None):
+    '''
+    驗證簽章並交給事件處理函數，Flask 與 ASGI 模式共用
+    抽樣到的請求 (或重播時傳入的 trace) 會記錄處理時間與上游呼叫
+    '''
+    if trace is None and traffic_recorder is not None and random.random() < TRAFFIC_SAMPLE_RATE:
+        trace = {'type': 'webhook', 'id': os.urandom(8).hex(), 'tenant': tenant_id}
+
+    if trace is None:
+        tenants[tenant_id].handler.handle(body, signature)
+        return
+
+    trace['time'] = time.time()
+    trace['upstream'] = []
+    token = traffic_trace.set(trace)
+    started_wall, started_cpu = time.perf_counter(), time.thread_time()
+    try:
+        tenants[tenant_id].handler.handle(body, signature)
+    finally:
+        trace['wall_ms'] = round((time.perf_counter() - started_wall) * 1000, 2)
+        trace['cpu_ms'] = round((time.thread_time() - started_cpu) * 1000, 2)
+        traffic_trace.reset(token)
+        if traffic_recorder is not None:
+            try:
+                trace['body'] = anonymize_webhook_body(body)
+            except ValueError:
+                trace['body'] = None
+        traffic_sink(trace)
+
+def start_traffic_recorder():
+    global traffic_recorder, traffic_sink
+    traffic_recorder = TrafficRecorder(TRAFFIC_CAPTURE_DIR, TRAFFIC_SEGMENT_BYTES, TRAFFIC_MAX_SEGMENTS)
+    traffic_recorder.start()
+    traffic_sink = traffic_recorder.write
+
+class ReplayLineBotApi:
+    '''
+    重播用的 LINE 用戶端：不連網，依記錄中同一個請求的呼叫順序模擬當時的回應時間
+    '''
+    def __init__(self, latencies):
+        self.latencies = latencies
+        self.noise = None
+
+    def __getattr__(self, name):
+        def call(*args, **kwargs):
+            replay_sleep(self.latencies, f"line:{name}")
+            if name == 'get_message_content':
+                return type('Content', (), {'content': self.sample_image(*args, **kwargs)})()
+        return call
+
+    def sample_image(self, message_id):
+        # 依訊息 ID 產生不同的色塊，不同訊息的圖片不會被當成重複圖片而略過 vision API；
+        # 疊上雜訊讓圖片能通過模糊與單色檢查，與實際照片走相同的路徑
+        from PIL import Image
+
+        if self.noise is None:
+            self.noise = Image.effect_noise((640, 480), 64).convert('RGB')
+        rng = random.Random(message_id)
+        blocks = Image.frombytes('RGB', (16, 12), rng.randbytes(16 * 12 * 3)).resize((640, 480), Image.NEAREST)
+        output = BytesIO()
+        Image.blend(blocks, self.noise, 0.5).save(output, format='JPEG')
+        return output.getvalue()
+
+class ReplayAIBackend(StubBackend):
+    '''
+    重播用的 AI 後端：回應內容固定，回應時間使用記錄中的時間
+    '''
+    def __init__(self, latencies):
+        super().__init__()
+        self.latencies = latencies
+
+    def complete(self, messages, settings):
+        kind = 'image' if isinstance(messages[-1]['content'], list) else 'diet_plan'
+        replay_sleep(self.latencies, f"ai:{kind}")
+        return self.respond(messages, settings)
+
+def replay_sleep(latencies, name):
+    trace = traffic_trace.get()
+    if trace is None:
+        return
+    recorded = latencies.get((trace['type'], trace['id']), [])
+    for index, (call_name, elapsed_ms) in enumerate(recorded):
+        if call_name == name:
+            del recorded[index]
+            time.sleep(elapsed_ms / 1000)
+            return
+
+def ensure_replay_profile(user_id):
+    '''
+    重播時沒有正式環境的使用者資料，以固定的個人資料讓事件走已完成設定的流程
+    '''
+    if user_id in user_profiles:
+        return
+    create_profile(user_id)
+    for field_name, value in [('goal', '維持體重'), ('gender', '男'), ('age', 30), ('height', 170.0),
+                              ('weight', 65.0), ('activity_level', '輕度活動')]:
+        update_profile(user_id, field_name, value)
+    reset_daily_tracker(user_id, 2000.0)
+    set_setup_stage(user_id, 'ready')
+
+def summarize_timings(values):
+    if not values:
         return None
+    values = sorted(values)
+    return {
+        'count': len(values),
+        'p50': values[len(values) // 2],
+        'p95': values[min(len(values) - 1, int(len(values) * 0.95))],
+        'max': values[-1]
+    }
+
+def replay_traffic(directory, speed=1.0, concurrency=8):
+    '''
+    依記錄的到達間隔 (除以 speed，0 表示不等待) 重新送出 webhook，
+    比較記錄與重播時的處理 CPU 時間、牆鐘時間與 AI 工作排隊時間
+    同一位使用者的事件固定由同一個執行緒依序處理，保持流程的先後順序
+    '''
+    global traffic_sink, AI_ROUTES, AI_HEDGE_BACKEND, durable_job_queue, ai_event_loop
+
+    records = list(read_traffic(directory))
+    webhooks = sorted((r for r in records if r['type'] == 'webhook' and r.get('body')), key=lambda r: r['time'])
+    recorded_jobs = [r for r in records if r['type'] == 'job']
+    latencies = {(r['type'], r['id']): list(r['upstream']) for r in records}
+    for job in recorded_jobs:
+        latencies[('job', job['id'])] = list(job['upstream'])
+
+    # 所有外部呼叫改由重播用的用戶端處理，狀態只存在記憶體
+    durable_job_queue = None
+    ai_event_loop = None
+    AI_HEDGE_BACKEND = None
+    AI_ROUTES = {kind: 'replay' for kind in AI_ROUTES}
+    ai_backends['replay'] = ReplayAIBackend(latencies)
+    for tenant_id in {r['tenant'] for r in webhooks}:
+        tenant = Tenant(tenant_id, 'replay', 'replay')
+        tenant.line_bot_api = ReplayLineBotApi(latencies)
+        register_event_handlers(tenant.handler)
+        tenants[tenant_id] = tenant
+
+    results = []
+    results_lock = threading.Lock()
+    def sink(trace):
+        with results_lock:
+            results.append(trace)
+    traffic_sink = sink
+
+    errors = []
+    def send(record):
+        # 事件時間改為重播當下，reply token 的有效期限判斷才會與記錄時相同
+        for event in record['body'].get('events', []):
+            event['timestamp'] = int(time.time() * 1000)
+            user_id = event.get('source', {}).get('userId')
+            if user_id:
+                ensure_replay_profile(tenant_user_key(user_id, record['tenant']))
+        body = json.dumps(record['body'], ensure_ascii=False)
+        signature = base64.b64encode(hmac.new(b'replay', body.encode('utf-8'), hashlib.sha256).digest()).decode()
+        current_tenant.set(record['tenant'])
+        try:
+            handle_webhook(record['tenant'], body, signature, {'type': 'webhook', 'id': record['id']})
+        except Exception as e:
+            errors.append(str(e))
+
+    def send_loop(records):
+        while True:
+            record = records.get()
+            if record is None:
+                return
+            send(record)
+
+    lanes = [queue.Queue() for _ in range(max(concurrency, 1))]
+    threads = [threading.Thread(target=send_loop, args=(lane,), daemon=True) for lane in lanes]
+    for thread in threads:
+        thread.start()
 
-# 計算基礎代謝率 (BMR) 的函數
-def calculate_bmr(gender, age, height, weight):
-    """
-    使用 Harris-Benedict 公式計算基礎代謝率
-    """
-    if gender == '男':
-        bmr = (9.99 * weight) + (6.25 * height) - (4.92 * age) + 5
-    else:  # 女
-        bmr = (9.99 * weight) + (6.25 * height) - (4.92 * age) - 161
-    
-    return round(bmr, 2)
+    started_at = time.perf_counter()
+    for record in webhooks:
+        if speed > 0:
+            delay = (record['time'] - webhooks[0]['time']) / speed - (time.perf_counter() - started_at)
+            if delay > 0:
+                time.sleep(delay)
+        events = record['body'].get('events') or [{}]
+        user_id = events[0].get('source', {}).get('userId', '')
+        lanes[zlib.crc32(user_id.encode()) % len(lanes)].put(record)
+    for lane in lanes:
+        lane.put(None)
+    for thread in threads:
+        thread.join()
+    ai_job_queue.join()
 
-# 計算每日推薦熱量攝取
-def calculate_daily_calories(bmr, activity_level, goal):
-    """
-    根據活動量級別和目標計算每日推薦熱量
-    """
-    activity_multipliers = {
-        '久坐': 1.2,
-        '輕度活動': 1.375,
-        '中度活動': 1.55,
-        '高度活動': 1.725,
-        '非常活躍': 1.9
-    }
-    
-    daily_calories = bmr * activity_multipliers.get(activity_level, 1.2)
-    
-    # 根據目標調整熱量
-    if goal == '增肌':
-        daily_calories += 250  # 增加250卡路里
-    elif goal == '減重':
-        daily_calories *= 0.85  # 減少15%熱量
-    
-    return round(daily_calories, 2)
+    replayed_webhooks = [r for r in results if r['type'] == 'webhook']
+    replayed_jobs = [r for r in results if r['type'] == 'job']
+    report = {'webhooks': len(replayed_webhooks), 'jobs': len(replayed_jobs), 'errors': len(errors),
+              'elapsed_seconds': round(time.perf_counter() - started_at, 3)}
+    for label, recorded, replayed in [('handler', webhooks, replayed_webhooks), ('job', recorded_jobs, replayed_jobs)]:
+        for metric in ('cpu_ms', 'wall_ms', 'wait_ms'):
+            if label == 'handler' and metric == 'wait_ms':
+                continue
+            report[f"{label}_{metric}"] = {
+                'recorded': summarize_timings([r[metric] for r in recorded if metric in r]),
+                'replayed': summarize_timings([r[metric] for r in replayed if metric in r])
+            }
+    return report
 
-def compress_image(image_data, max_size_mb=10):
-    """
-    壓縮圖片至指定大小以下
-    :param image_data: 原始圖片的二進制數據
-    :param max_size_mb: 最大目標大小（MB）
-    :return: 壓縮後的圖片數據（bytes）
-    """
-    # 將二進制數據轉換為 PIL Image
-    img = Image.open(BytesIO(image_data))
-    
-    # 初始品質參數
-    quality = 95
-    output = BytesIO()
-    
-    # 如果是 PNG，轉換為 JPEG
-    if img.format == 'PNG':
-        # 如果有透明通道，先將背景轉為白色
-        if img.mode in ('RGBA', 'LA'):
-            background = Image.new('RGB', img.size, (255, 255, 255))
-            background.paste(img, mask=img.split()[-1])
-            img = background
-        elif img.mode != 'RGB':
-            img = img.convert('RGB')
-    
-    # 壓縮圖片直到大小小於目標大小
-    while True:
-        output = BytesIO()
-        img.save(output, format='JPEG', quality=quality)
-        size_mb = len(output.getvalue()) / (1024 * 1024)
-        
-        if size_mb <= max_size_mb or quality <= 5:
-            break
-        
-        quality -= 5
-    
-    return output.getvalue()
+def callback(tenant_id=DEFAULT_TENANT_ID):
+    tenant = tenants.get(tenant_id)
+    if tenant is None:
+        abort(404)
 
-@app.post("/")
-def callback():
     signature = request.headers['X-Line-Signature']
     body = request.get_data(as_text=True)
-    app.logger.info("Request body: " + body)
+    current_app.logger.info("Request body: " + body)
 
+    token = current_tenant.set(tenant_id)
     try:
-        handler.handle(body, signature)
+        handle_webhook(tenant_id, body, signature)
     except InvalidSignatureError:
         print("電子簽章錯誤, 請檢查密鑰是否正確？")
         abort(400)
+    finally:
+        current_tenant.reset(token)
 
     return 'OK'
 
-@handler.add(FollowEvent)
+def get_metrics():
+    with metrics_lock:
+        result = dict(metrics)
+    if durable_job_queue is not None:
+        result['job_queue'] = durable_job_queue.stats()
+    return result
+
+@skip_redelivered
 def handle_follow(event):
     """
     使用者第一次加入機器人時的歡迎訊息和目標選擇
     """
-    user_id = event.source.user_id
+    user_id = tenant_user_key(event.source.user_id)
     
     # 初始化使用者資料
-    user_profiles[user_id] = {
-        'setup_stage': 'goal'
-    }
+    create_profile(user_id)
+    set_setup_stage(user_id, 'goal')
     
     
     button_template = ButtonsTemplate(
@@ -521,60 +4055,147 @@ def handle_follow(event):
 
     line_bot_api.reply_message(event.reply_token, template_message)
 
-@handler.add(MessageEvent, message = ImageMessage)
+def build_image_job(event):
+    user_id = tenant_user_key(event.source.user_id)
+    record_image_request()
+    return {
+        'kind': 'image',
+        'user_id': user_id,
+        'reply_token': event.reply_token,
+        'event_time': event.timestamp / 1000,
+        'message_id': event.message.id
+    }
+
+@skip_redelivered
 def handle_image(event):
-    user_id = event.source.user_id
+    # 超過使用額度或佇列已滿時直接回覆，不佔用背景工作
+    message = enqueue_ai_job(
+        build_image_job(event),
+        "🔄正在分析圖片，請稍後...",
+        "❌分析圖片時發生錯誤，請稍後再試。"
+    )
+    if message:
+        line_bot_api.reply_message(event.reply_token, message)
+
+@skip_redelivered
+async def handle_image_async(event):
+    '''
+    handle_image 的非同步版本 (ASGI 模式)
+    '''
+    message = await enqueue_ai_job_async(
+        build_image_job(event),
+        "🔄正在分析圖片，請稍後...",
+        "❌分析圖片時發生錯誤，請稍後再試。"
+    )
+    if message:
+        await async_line_bot_api.reply_message(event.reply_token, message)
+
+def analyze_image(job):
+    '''
+    下載圖片、壓縮後交給 OpenAI 估算熱量，回傳回覆文字 (失敗時拋出例外)
+    '''
+    message_content = line_bot_api.get_message_content(job['message_id'])
+
+    image_data = message_content.content
+
+    compressed_image = compress_image(image_data, max_size_mb=10)
+
+    # 模糊、非食物或重複的照片直接回覆，不呼叫 OpenAI
+    image_hash = None
+    if IMAGE_FILTER_ENABLED:
+        filtered_text, image_hash = prefilter_image(job['user_id'], compressed_image)
+        if filtered_text is not None:
+            refund_ai_request(job['user_id'])
+            return filtered_text
+
+    image_base64 = base64.b64encode(compressed_image).decode('utf-8')
+
+    # 使用 OpenAI API 進行圖像分類
+    reply_text = create_chat_completion('image', build_image_messages(image_base64))
+    remember_image_result(job['user_id'], image_hash, reply_text)
+    return reply_text
+
+def run_image_job(job):
+    '''
+    背景工作：分析圖片並回覆使用者
+    '''
     try:
-        line_bot_api.push_message(user_id, TextSendMessage(text="🔄正在分析圖片，請稍後..."))
-        message_content = line_bot_api.get_message_content(event.message.id)
+        deliver_ai_result(job, TextSendMessage(text=analyze_image(job)))
+    except Exception as e:
+        deliver_ai_result(job, TextSendMessage(text=f"❌分析圖片時發生錯誤，請稍後再試。(Error: {str(e)})"))
 
-        image_data = message_content.content
+async def run_image_job_async(job):
+    '''
+    run_image_job 的非同步版本，圖片壓縮在執行緒中進行以免阻塞事件迴圈
+    '''
+    import asyncio
 
-        compressed_image = compress_image(image_data, max_size_mb=10)
+    try:
+        message_content = await async_line_bot_api.get_message_content(job['message_id'])
 
-        image_base64 = base64.b64encode(compressed_image).decode('utf-8')
+        image_data = await message_content.content
 
-        # 使用 OpenAI API 進行圖像分類
-        openai.api_key = os.getenv('OPENAI_API_KEY')
-        response = openai.ChatCompletion.create(
-            model = "gpt-4o",
-            messages = [
-                {"role": "system", "content": """你是一位專業的營養師，專門分析食物照片並估算熱量。
-                請依照以下格式回覆：
-                1. 食物名稱：[辨識出的食物名稱]
-                2. 份量估計：[估計的份量，例如：一碗、100克等]
-                3. 熱量估計：[照片中每種食物估計熱量] 大卡 (ex: -白飯: 約320大卡\n -炒青菜: 約50大卡... -總熱量: 約370大卡)
-                4. 營養建議：[簡短的營養建議]
+        compressed_image = await asyncio.to_thread(compress_image, image_data, 10)
 
-                請盡可能準確估計，如果照片無法清楚判斷，請說明原因。"""},
-                {"role": "user", "content": [
-                    {"type": "text", "text": "請幫我估計這張圖片食物的熱量。"},
-                    {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{image_base64}"}}
-                ]}
-            ],
-            temperature = 0.3,
-            top_p = 0.2,
-        )
-        reply_text = response.choices[0].message.content
-        line_bot_api.reply_message(event.reply_token, TextSendMessage(text=reply_text))
+        image_hash = None
+        if IMAGE_FILTER_ENABLED:
+            filtered_text, image_hash = await asyncio.to_thread(prefilter_image, job['user_id'], compressed_image)
+            if filtered_text is not None:
+                refund_ai_request(job['user_id'])
+                await deliver_ai_result_async(job, TextSendMessage(text=filtered_text))
+                return
+
+        image_base64 = base64.b64encode(compressed_image).decode('utf-8')
+
+        reply_text = await create_chat_completion_async('image', build_image_messages(image_base64))
+        remember_image_result(job['user_id'], image_hash, reply_text)
+        await deliver_ai_result_async(job, TextSendMessage(text=reply_text))
     except Exception as e:
-        line_bot_api.reply_message(event.reply_token, TextSendMessage(text=f"❌分析圖片時發生錯誤，請稍後再試。(Error: {str(e)})"))
-    
+        await deliver_ai_result_async(job, TextSendMessage(text=f"❌分析圖片時發生錯誤，請稍後再試。(Error: {str(e)})"))
+
+# 背景工作種類對應的處理函數
+AI_JOB_HANDLERS = {
+    'diet_plan': run_diet_plan_job,
+    'image': run_image_job
+}
+
+ASYNC_AI_JOB_HANDLERS = {
+    'diet_plan': run_diet_plan_job_async,
+    'image': run_image_job_async
+}
+
+# 持久化佇列的工作只產生結果文字，失敗時拋出例外以便重試
+JOB_RESULT_HANDLERS = {
+    'diet_plan': lambda job: create_chat_completion('diet_plan', build_diet_plan_messages(job['prompt'])),
+    'image': analyze_image
+}
+
+JOB_FAILURE_TEXTS = {
+    'diet_plan': "❌無法生成飲食建議，請稍後再試。",
+    'image': "❌分析圖片時發生錯誤，請稍後再試。"
+}
+
 
-@handler.add(PostbackEvent)
+@skip_redelivered
 def handle_postback(event):
     """處理按鈕回調"""
-    user_id = event.source.user_id
+    user_id = tenant_user_key(event.source.user_id)
     data = event.postback.data
+
+    # 除了選擇目標以外的按鈕都需要這個程序中的使用者資料，沒有時重新設定
+    if not data.startswith('goal_') and user_id not in user_profiles:
+        restart_setup(event, user_id)
+        return
     
     if data.startswith('goal_'):
         goal = data.split('_')[1]
 
         # 跳過系統產生的提示訊息
-        skip_text_message.add(goal)
+        add_skip_text(goal)
 
-        user_profiles[user_id]['goal'] = goal
-        user_profiles[user_id]['setup_stage'] = 'gender'
+        ensure_profile(user_id)
+        update_profile(user_id, 'goal', goal)
+        set_setup_stage(user_id, 'gender')
         
         # 使用確認模板詢問性別
         confirm_template = ConfirmTemplate(
@@ -603,10 +4224,10 @@ def handle_postback(event):
     elif data.startswith('gender_'):
         gender = data.split('_')[1]
 
-        skip_text_message.add(f"{gender}性")
+        add_skip_text(f"{gender}性")
 
-        user_profiles[user_id]['gender'] = gender
-        user_profiles[user_id]['setup_stage'] = 'age'
+        update_profile(user_id, 'gender', gender)
+        set_setup_stage(user_id, 'age')
         
         line_bot_api.reply_message(
             event.reply_token, 
@@ -622,34 +4243,34 @@ def handle_postback(event):
             '5': '非常活躍'
         }
         activity_level = activity_map[data.split('_')[1]]
-        user_profiles[user_id]['activity_level'] = activity_level
+        update_profile(user_id, 'activity_level', activity_level)
         
         # 跳過系統產生的提示訊息
-        skip_text_message.add(activity_level)
+        add_skip_text(activity_level)
 
         # 計算基礎代謢率和每日推薦熱量
         profile = user_profiles[user_id]
         bmr = calculate_bmr(
-            profile['gender'],
-            profile['age'],
-            profile['height'],
-            profile['weight']
+            profile.gender,
+            profile.age,
+            profile.height,
+            calories_weight(profile)
         )
         daily_calories = calculate_daily_calories(
             bmr,
-            profile['activity_level'],
-            profile['goal']
+            profile.activity_level,
+            profile.goal
         )
         
         # 建立結果訊息
         result_message = (
             f"您的基本資料:\n"
-            f"目標: {profile['goal']}\n"
-            f"性別: {profile['gender']}\n"
-            f"年齡: {profile['age']} 歲\n"
-            f"身高: {profile['height']} 公分\n"
-            f"體重: {profile['weight']} 公斤\n"
-            f"活動量: {profile['activity_level']}\n\n"
+            f"目標: {profile.goal}\n"
+            f"性別: {profile.gender}\n"
+            f"年齡: {profile.age} 歲\n"
+            f"身高: {profile.height} 公分\n"
+            f"體重: {profile.weight} 公斤\n"
+            f"活動量: {profile.activity_level}\n\n"
             f"您的基礎代謝率(BMR): {round(bmr, 2)} 大卡\n"
             f"建議每日熱量攝取: {round(daily_calories, 2)} 大卡\n\n"
             "現在您可以開始記錄每日飲食了！ (輸入「Help」可查看指令)"
@@ -661,8 +4282,11 @@ def handle_postback(event):
         )
         
         # 重置設置階段並初始化追蹤器
-        user_profiles[user_id]['setup_stage'] = 'ready'
-        user_profiles[user_id]['daily_tracker'] = initialize_daily_tracker(daily_calories)
+        set_setup_stage(user_id, 'ready')
+        reset_daily_tracker(user_id, daily_calories)
+        # 提醒由使用者資料所在的這個實例送出
+        if REMINDER_SCHEDULER:
+            schedule_reminders(user_id)
 
     elif data == '開始飲食建議':
         template_message = start_diet_suggestion_flow(user_id)
@@ -671,25 +4295,26 @@ def handle_postback(event):
         line_bot_api.reply_message(event.reply_token, TextSendMessage(text="已取消飲食建議流程"))
     elif data.startswith('meal_type_') or data.startswith('cuisine_') or \
          data.startswith('requirement_') or data.startswith('meal_time_'):
-        skip_text_message.add(data.split('_')[-1])
+        add_skip_text(data.split('_')[-1])
         template_message = handle_diet_suggestion_flow(event, user_id, data)
-        line_bot_api.reply_message(event.reply_token, template_message)
+        if template_message:
+            line_bot_api.reply_message(event.reply_token, template_message)
     elif data.startswith('edit_'):
         item = data.split('_')[1]
         value = data.split('_')[2]
         if(item == "goal"):
             try:
-                user_profiles[user_id]['goal'] = value  
-                skip_text_message.add(value)
+                update_profile(user_id, 'goal', value)
+                add_skip_text(value)
                 # 更新每日推薦熱量
                 profile = user_profiles[user_id]
                 bmr = calculate_bmr(
-                    profile["gender"], profile["age"], profile["height"], profile["weight"]
+                    profile.gender, profile.age, profile.height, calories_weight(profile)
                 )
                 daily_calories = calculate_daily_calories(
-                    bmr, profile["activity_level"], profile["goal"]
+                    bmr, profile.activity_level, profile.goal
                 )
-                user_profiles[user_id]["daily_tracker"]["total_calories"] = daily_calories
+                update_total_calories(user_id, daily_calories)
                 result_message = f"目標已更新為: { value }"
             except:
                 result_message = "無法更新目標"
@@ -703,17 +4328,17 @@ def handle_postback(event):
                     '4': '高度活動',
                     '5': '非常活躍'
                 }
-                user_profiles[user_id]['activity_level'] = activity_map[value]
-                skip_text_message.add(activity_map[value])
+                update_profile(user_id, 'activity_level', activity_map[value])
+                add_skip_text(activity_map[value])
                 # 更新每日推薦熱量
                 profile = user_profiles[user_id]
                 bmr = calculate_bmr(
-                    profile["gender"], profile["age"], profile["height"], profile["weight"]
+                    profile.gender, profile.age, profile.height, calories_weight(profile)
                 )
                 daily_calories = calculate_daily_calories(
-                    bmr, profile["activity_level"], profile["goal"]
+                    bmr, profile.activity_level, profile.goal
                 )
-                user_profiles[user_id]["daily_tracker"]["total_calories"] = daily_calories
+                update_total_calories(user_id, daily_calories)
                 result_message = f"活動量已更新為: {activity_map[value]}"
             except:
                 result_message = "無法更新活動量"
@@ -721,56 +4346,83 @@ def handle_postback(event):
 
 
 
-@handler.add(MessageEvent, message=TextMessage)
+def restart_setup(event, user_id):
+    '''
+    建立新的使用者資料並從選擇目標開始設定
+    '''
+    create_profile(user_id)
+    set_setup_stage(user_id, 'goal')
+    buttons_template = ButtonsTemplate(
+        title='歡迎使用Meal Mate！',
+        text='請選擇您的目標:',
+        actions=[
+            PostbackTemplateAction(
+                label='增肌',
+                text = '增肌',
+                data='goal_增肌'
+            ),
+            PostbackTemplateAction(
+                label='減重',
+                text = '減重',
+                data='goal_減重'
+            ),
+            PostbackTemplateAction(
+                label='維持體重',
+                text = '維持體重',
+                data='goal_維持體重'
+            )
+        ]
+    )
+    template_message = TemplateSendMessage(
+        alt_text='請選擇目標',
+        template=buttons_template
+    )
+    line_bot_api.reply_message(event.reply_token, template_message)
+
+def record_food_message(user_id, message_text):
+    '''
+    記錄飲食，例如 "新增記錄 雞胸肉 200" 或 "新增記錄 白飯 280 雞腿 350"，回傳回覆訊息
+    '''
+    try:
+        items = parse_food_log(message_text[len('新增記錄'):])
+    except ValueError as e:
+        return TextSendMessage(text=f"新增記錄格式錯誤 ({e})。請使用「新增記錄 <食物名稱> <熱量>」，可一次記錄多項")
+
+    if not add_food_logs(user_id, items):
+        return TextSendMessage(text="超過每日建議熱量，無法記錄")
+
+    daily_tracker = user_profiles[user_id].daily_tracker
+    remaining_calories = daily_tracker.total_calories - daily_tracker.consumed_calories
+    recorded = "、".join(f"{food_name} ({calories} 大卡)" for food_name, calories in items)
+    return TextSendMessage(text=f"已成功記錄 {recorded}。\n剩餘可攝取熱量：{round(remaining_calories, 2)} 大卡")
+
+@skip_redelivered
 def handle_message(event):
-    user_id = event.source.user_id
+    user_id = tenant_user_key(event.source.user_id)
     message_text = event.message.text.strip()
 
-    if message_text in skip_text_message:
-        skip_text_message.remove(message_text)
+    # 一次讀取本次訊息需要的共享狀態
+    session = load_session(user_id, message_text)
+
+    if session['skip']:
         return
     
     # 檢查是否已存在用戶資料
-    if user_id not in user_profiles:
-        user_profiles[user_id] = {'setup_stage': 'goal'}
-        buttons_template = ButtonsTemplate(
-            title='歡迎使用Meal Mate！',
-            text='請選擇您的目標:',
-            actions=[
-                PostbackTemplateAction(
-                    label='增肌',
-                    text = '增肌',
-                    data='goal_增肌'
-                ),
-                PostbackTemplateAction(
-                    label='減重',
-                    text = '減重',
-                    data='goal_減重'
-                ),
-                PostbackTemplateAction(
-                    label='維持體重',
-                    text = '維持體重',
-                    data='goal_維持體重'
-                )
-            ]
-        )
-        template_message = TemplateSendMessage(
-            alt_text='請選擇目標',
-            template=buttons_template
-        )
-        line_bot_api.reply_message(event.reply_token, template_message)
+    # 共享儲存中有設定階段、但這個程序沒有使用者資料時 (例如重啟時沒有 EVENT_LOG_DIR) 也重新設定
+    if session['setup_stage'] is None or user_id not in user_profiles:
+        restart_setup(event, user_id)
         return
     
     # 根據設置階段處理不同的輸入
-    current_stage = user_profiles[user_id].get('setup_stage', 'goal')
+    current_stage = session['setup_stage']
     
     if(current_stage != 'ready'):
         try:
             if current_stage == 'age':
                 age = int(message_text)
                 if 10 <= age <= 100:
-                    user_profiles[user_id]['age'] = age
-                    user_profiles[user_id]['setup_stage'] = 'height'
+                    update_profile(user_id, 'age', age)
+                    set_setup_stage(user_id, 'height')
                     line_bot_api.reply_message(
                         event.reply_token, 
                         TextSendMessage(text="請輸入您的身高(公分)")
@@ -784,8 +4436,8 @@ def handle_message(event):
             elif current_stage == 'height':
                 height = float(message_text)
                 if 100 <= height <= 250:
-                    user_profiles[user_id]['height'] = height
-                    user_profiles[user_id]['setup_stage'] = 'weight'
+                    update_profile(user_id, 'height', height)
+                    set_setup_stage(user_id, 'weight')
                     line_bot_api.reply_message(
                         event.reply_token, 
                         TextSendMessage(text="請輸入您的體重(公斤)")
@@ -799,8 +4451,8 @@ def handle_message(event):
             elif current_stage == 'weight':
                 weight = float(message_text)
                 if 30 <= weight <= 120:
-                    user_profiles[user_id]['weight'] = weight
-                    user_profiles[user_id]['setup_stage'] = 'activity'
+                    record_weight(user_id, weight)
+                    set_setup_stage(user_id, 'activity')
                     
                     # 活動量選擇
                     carousle_template = CarouselTemplate( columns = [
@@ -870,34 +4522,12 @@ def handle_message(event):
 
     elif(current_stage == 'ready'):
             if(message_text.startswith('新增記錄')):
-                # 記錄飲食
-                # 解析訊息，例如 "記錄 雞胸肉 200"
-                try:
-                    _, food_name, calories = message_text.split()
-                    calories = float(calories)
-            
-                    if add_food_log(user_id, food_name, calories):
-                        remaining_calories = user_profiles[user_id]['daily_tracker']['total_calories'] - user_profiles[user_id]['daily_tracker']['consumed_calories']
-                
-                        line_bot_api.reply_message(
-                            event.reply_token, 
-                            TextSendMessage(text=f"已成功記錄 {food_name} ({calories} 大卡)。\n剩餘可攝取熱量：{round(remaining_calories, 2)} 大卡")
-                        )
-                    else:
-                        line_bot_api.reply_message(
-                        event.reply_token, 
-                        TextSendMessage(text="超過每日建議熱量，無法記錄")
-                        )
-                except:
-                    line_bot_api.reply_message(
-                    event.reply_token, 
-                    TextSendMessage(text="新增記錄格式錯誤。請使用「新增記錄 <食物名稱> <熱量>」")
-                    )
+                line_bot_api.reply_message(event.reply_token, record_food_message(user_id, message_text))
             elif (message_text.startswith('刪除記錄')):
                 # 刪除飲食記錄
                 # 刪除記錄 食物名稱
                 try:
-                    _, food_name = message_text.split()
+                    _, food_name = message_text.split(maxsplit=1)
                     if remove_food_log(user_id, food_name):
                         line_bot_api.reply_message(
                             event.reply_token, 
@@ -916,30 +4546,9 @@ def handle_message(event):
 
             elif (message_text == '今日狀態'):
                 # 顯示用戶狀態
-                profile = user_profiles[user_id]
-                daily_tracker = profile['daily_tracker']
-                
-                status_message = (
-                    f"👤 個人資料:\n"
-                    f"目標: {profile['goal']}\n"
-                    f"性別: {profile['gender']}\n"
-                    f"年齡: {profile['age']} 歲\n"
-                    f"身高: {profile['height']} 公分\n"
-                    f"體重: {profile['weight']} 公斤\n"
-                    f"活動量: {profile['activity_level']}\n\n"
-                    f"📊 今日熱量狀態:\n"
-                    f"總建議熱量: {round(daily_tracker['total_calories'], 2)} 大卡\n"
-                    f"已消耗熱量: {round(daily_tracker['consumed_calories'], 2)} 大卡\n"
-                    f"剩餘可攝取熱量: {round((daily_tracker['total_calories'] - daily_tracker['consumed_calories']), 2)} 大卡\n\n"
-                    "🍽️ 今日食物記錄:\n"
-                )
-                
-                for food in daily_tracker['food_log']:
-                    status_message += f"{food['time']} - {food['name']} ({round(food['calories'], 2)} 大卡)\n"
-                
                 line_bot_api.reply_message(
                     event.reply_token, 
-                    TextSendMessage(text=status_message)
+                    get_status_message(user_id)
                 )
 
             elif (message_text == '飲食建議'):
@@ -964,9 +4573,10 @@ def handle_message(event):
         
                 line_bot_api.reply_message(event.reply_token, template_message)
             
-            elif user_diet_suggestion_flow.get(user_id, {}).get('stage') in ['calories', 'additional_requirements']:
-                template_message = handle_diet_suggestion_flow(event, user_id, message_text)
-                line_bot_api.reply_message(event.reply_token, template_message)
+            elif (session['diet_flow'] or {}).get('stage') in ['calories', 'additional_requirements']:
+                template_message = handle_diet_suggestion_flow(event, user_id, message_text, session['diet_flow'])
+                if template_message:
+                    line_bot_api.reply_message(event.reply_token, template_message)
 
             elif message_text.startswith("編輯"):
                 # 編輯個人資料
@@ -980,15 +4590,19 @@ def handle_message(event):
                         new_value = validate_edit_input(user_id, item, new_value)
                         itemMap = {"身高" : "height", "體重" : "weight", "年齡" : "age", "性別" : "gender"}
                         if new_value:
-                            user_profiles[user_id][itemMap[item]] = new_value
+                            # 體重的修改同時是一次體重記錄
+                            if item == "體重":
+                                record_weight(user_id, new_value)
+                            else:
+                                update_profile(user_id, itemMap[item], new_value)
                             profile = user_profiles[user_id]
                             bmr = calculate_bmr(
-                                profile["gender"], profile["age"], profile["height"], profile["weight"]
+                                profile.gender, profile.age, profile.height, calories_weight(profile)
                             )
                             daily_calories = calculate_daily_calories(
-                                bmr, profile["activity_level"], profile["goal"]
+                                bmr, profile.activity_level, profile.goal
                             )
-                            user_profiles[user_id]["daily_tracker"]["total_calories"] = daily_calories
+                            update_total_calories(user_id, daily_calories)
                             line_bot_api.reply_message(
                                 event.reply_token, 
                                 TextSendMessage(text=f"已更新 {item} 為 {new_value}")
@@ -1090,16 +4704,37 @@ def handle_message(event):
                         event.reply_token, 
                         TextSendMessage(text="編輯格式錯誤。請使用「編輯 <項目> <修改內容>」")
                     )            
+            elif (message_text in ['提醒 開啟', '提醒 關閉']):
+                # 開啟或關閉主動提醒
+                enabled = message_text == '提醒 開啟'
+                update_profile(user_id, 'reminders_enabled', enabled)
+                line_bot_api.reply_message(
+                    event.reply_token, 
+                    TextSendMessage(text="已開啟用餐提醒與每日總結" if enabled else "已關閉用餐提醒與每日總結")
+                )
+            elif (message_text == '體重趨勢'):
+                line_bot_api.reply_message(
+                    event.reply_token, 
+                    TextSendMessage(text=format_weight_trend(user_profiles[user_id]))
+                )
+            elif (message_text == '查詢任務'):
+                line_bot_api.reply_message(
+                    event.reply_token, 
+                    TextSendMessage(text=format_job_status(user_id))
+                )
             # 新增 Help 功能
             elif (message_text == "Help"):
                     help_message = (
                         "🥖 Meal Mate 使用說明 🍓\n\n"
                         "💻指令列表:\n"
-                        "記錄食物: 新增記錄 <食物名稱> <熱量>\n"
+                        "記錄食物: 新增記錄 <食物名稱> <熱量> (可一次多項，例如 新增記錄 白飯 280 雞腿 350)\n"
                         "刪除食物記錄: 刪除記錄 <食物名稱>\n"
                         "顯示當日熱量狀態: 今日狀態\n"
                         "生成客製化飲食建議: 飲食建議 \n"
                         "修改個人資料: 編輯 <項目> <修改內容>\n"
+                        "開啟/關閉用餐提醒: 提醒 開啟 / 提醒 關閉\n"
+                        "查詢飲食建議與圖片分析進度: 查詢任務\n"
+                        "查看體重變化: 體重趨勢\n"
                         "顯示指令說明: Help\n\n"
                         "✏️編輯範例:\n"
                         "「編輯 目標」\n"
@@ -1122,5 +4757,401 @@ def handle_message(event):
                 )
     
 
+@skip_redelivered
+async def handle_message_async(event):
+    '''
+    handle_message 的非同步版本 (ASGI 模式)：新增記錄在事件迴圈中處理並以 AsyncLineBotApi 回覆，
+    其他訊息與尚未完成設定的使用者交給執行緒中的 handle_message
+    共享狀態與事件記錄的操作很短，直接在事件迴圈中執行
+    '''
+    import asyncio
+
+    user_id = tenant_user_key(event.source.user_id)
+    message_text = event.message.text.strip()
+    if message_text.startswith('新增記錄'):
+        session = load_session(user_id, message_text)
+        if session['skip']:
+            return
+        if session['setup_stage'] == 'ready' and user_id in user_profiles:
+            await async_line_bot_api.reply_message(event.reply_token, record_food_message(user_id, message_text))
+            return
+
+    # 已經檢查過重送，直接呼叫未包裝的函數
+    await asyncio.to_thread(handle_message.__wrapped__, event)
+
+# (事件類型, 訊息類型, 處理函數)，Flask 與 ASGI 模式共用
+EVENT_HANDLERS = [
+    (FollowEvent, None, handle_follow),
+    (MessageEvent, ImageMessage, handle_image),
+    (PostbackEvent, None, handle_postback),
+    (MessageEvent, TextMessage, handle_message)
+]
+
+# ASGI 模式下直接在事件迴圈中執行的處理函數，其他處理函數在執行緒中執行
+ASYNC_EVENT_HANDLERS = {
+    handle_image: handle_image_async,
+    handle_message: handle_message_async
+}
+
+def register_event_handlers(handler):
+    for event_type, message_type, func in EVENT_HANDLERS:
+        if message_type is None:
+            handler.add(event_type)(func)
+        else:
+            handler.add(event_type, message=message_type)(func)
+
+def find_event_handler(event):
+    for event_type, message_type, func in EVENT_HANDLERS:
+        if isinstance(event, event_type) and (message_type is None or isinstance(event.message, message_type)):
+            return func
+    return None
+
+async def handle_webhook_async(tenant_id, body, signature):
+    '''
+    ASGI 模式的 webhook 處理：驗證簽章後依事件類型分派，
+    圖片與新增記錄在事件迴圈中處理，其他事件以 asyncio.to_thread 執行同步的處理函數
+    抽樣記錄的請求需要量測 CPU 時間，整個交給執行緒中的 handle_webhook
+    '''
+    import asyncio
+
+    if traffic_recorder is not None and random.random() < TRAFFIC_SAMPLE_RATE:
+        await asyncio.to_thread(handle_webhook, tenant_id, body, signature)
+        return
+
+    for event in tenants[tenant_id].handler.parser.parse(body, signature):
+        func = find_event_handler(event)
+        if func is None:
+            continue
+        if func in ASYNC_EVENT_HANDLERS:
+            await ASYNC_EVENT_HANDLERS[func](event)
+        else:
+            # to_thread 會複製目前的 context，處理函數在執行緒中看到相同的頻道
+            await asyncio.to_thread(func, event)
+
+def create_app():
+    """
+    建立 Flask app 與各頻道的 LINE 用戶端並註冊事件處理函數
+    """
+    global durable_job_queue
+
+    # 從事件記錄還原使用者資料
+    if EVENT_LOG_DIR and event_log is None:
+        open_event_log(EVENT_LOG_DIR)
+
+    if JOB_QUEUE_PATH and durable_job_queue is None:
+        durable_job_queue = DurableJobQueue(JOB_QUEUE_PATH)
+
+    # Line Bot 初始化
+    app = Flask(__name__)
+    load_tenants()
+
+    for tenant in tenants.values():
+        register_event_handlers(tenant.handler)
+
+    if TRAFFIC_CAPTURE_DIR and traffic_recorder is None:
+        start_traffic_recorder()
+
+    if REMINDER_SCHEDULER:
+        start_reminder_scheduler()
+
+    if ANALYTICS_SNAPSHOT_PATH:
+        start_analytics_exporter()
+
+    app.add_url_rule("/", view_func=callback, methods=['POST'])
+    app.add_url_rule("/webhook/<tenant_id>", view_func=callback, methods=['POST'])
+    app.add_url_rule("/metrics", view_func=get_metrics, methods=['GET'])
+    app.add_url_rule("/admin/export/<kind>", view_func=admin_export, methods=['GET'])
+    app.add_url_rule("/admin/import/<kind>", view_func=admin_import, methods=['POST'])
+    app.add_url_rule("/admin/report/<kind>", view_func=admin_report, methods=['GET'])
+
+    return app
+
+def create_asgi_app():
+    """
+    建立 ASGI app，與 Flask 模式共用相同的事件處理函數
+    圖片與新增記錄以非同步的處理函數在事件迴圈中執行，並以 AsyncLineBotApi 回覆；
+    其他事件的處理函數仍是同步函數，以 asyncio.to_thread 在預設的執行緒池 (執行緒數有上限) 中執行
+    OpenAI 工作與其結果的回覆/推播也是事件迴圈中的協程，大量等待 OpenAI 的請求不需要各佔一個執行緒
+    比較見 benchmarks/bench_asgi_concurrency.py
+    例如：uvicorn --factory meal_mate:create_asgi_app
+    """
+    import asyncio
+
+    flask_app = create_app()
+    resources = {}
+
+    async def startup():
+        global ai_event_loop, async_ai_job_queue
+        import aiohttp
+        from linebot import AsyncLineBotApi
+        from linebot.aiohttp_async_http_client import AiohttpAsyncHttpClient
+
+        # 每個頻道各自的連線池
+        resources['sessions'] = []
+        for tenant in tenants.values():
+            session = aiohttp.ClientSession()
+            resources['sessions'].append(session)
+            tenant.async_line_bot_api = AsyncLineBotApi(tenant.token, AiohttpAsyncHttpClient(session))
+        async_ai_job_queue = asyncio.PriorityQueue()
+        resources['workers'] = [
+            asyncio.create_task(async_ai_worker_loop())
+            for _ in range(ASGI_AI_CONCURRENCY)
+        ]
+        ai_event_loop = asyncio.get_running_loop()
+
+    async def shutdown():
+        global ai_event_loop
+        ai_event_loop = None
+        for worker in resources.get('workers', []):
+            worker.cancel()
+        for session in resources.get('sessions', []):
+            await session.close()
+        for backend in list(ai_backends.values()):
+            await backend.aclose()
+
+    async def send_response(send, status, body, content_type='text/plain; charset=utf-8'):
+        await send({
+            'type': 'http.response.start',
+            'status': status,
+            'headers': [(b'content-type', content_type.encode())]
+        })
+        await send({'type': 'http.response.body', 'body': body})
+
+    async def call_flask(scope, receive, send):
+        '''
+        在執行緒中以 WSGI 執行 Flask 的管理端點，請求與回應內容都逐塊傳遞，
+        大量資料的匯入/匯出不需要整個放進記憶體
+        '''
+        loop = asyncio.get_running_loop()
+
+        def run(coroutine):
+            return asyncio.run_coroutine_threadsafe(coroutine, loop).result()
+
+        class RequestBody(io.RawIOBase):
+            def __init__(self):
+                self.buffer = b''
+                self.finished = False
+
+            def readable(self):
+                return True
+
+            def readinto(self, target):
+                while not self.buffer and not self.finished:
+                    message = run(receive())
+                    self.buffer = message.get('body', b'')
+                    self.finished = not message.get('more_body')
+                size = min(len(target), len(self.buffer))
+                target[:size] = self.buffer[:size]
+                self.buffer = self.buffer[size:]
+                return size
+
+        environ = {
+            'REQUEST_METHOD': scope['method'],
+            'SCRIPT_NAME': '',
+            'PATH_INFO': scope['path'],
+            'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+            'SERVER_NAME': 'localhost',
+            'SERVER_PORT': '80',
+            'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': scope.get('scheme', 'http'),
+            'wsgi.input': io.BufferedReader(RequestBody()),
+            'wsgi.input_terminated': True,
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False
+        }
+        for name, value in scope['headers']:
+            key = name.decode('latin-1').upper().replace('-', '_')
+            if key not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+                key = 'HTTP_' + key
+            environ[key] = value.decode('latin-1')
+
+        def serve():
+            response = {}
+
+            def start_response(status, headers, exc_info=None):
+                response['status'] = int(status.split(' ', 1)[0])
+                response['headers'] = [(name.encode('latin-1'), value.encode('latin-1')) for name, value in headers]
+
+            def start():
+                run(send({'type': 'http.response.start', 'status': response['status'], 'headers': response['headers']}))
+
+            result = flask_app(environ, start_response)
+            try:
+                started = False
+                for chunk in result:
+                    if not chunk:
+                        continue
+                    if not started:
+                        start()
+                        started = True
+                    run(send({'type': 'http.response.body', 'body': chunk, 'more_body': True}))
+                if not started:
+                    start()
+                run(send({'type': 'http.response.body', 'body': b''}))
+            finally:
+                if hasattr(result, 'close'):
+                    result.close()
+
+        await asyncio.to_thread(serve)
+
+    async def app(scope, receive, send):
+        if scope['type'] == 'lifespan':
+            while True:
+                message = await receive()
+                if message['type'] == 'lifespan.startup':
+                    await startup()
+                    await send({'type': 'lifespan.startup.complete'})
+                elif message['type'] == 'lifespan.shutdown':
+                    await shutdown()
+                    await send({'type': 'lifespan.shutdown.complete'})
+                    return
+
+        if scope['type'] != 'http':
+            return
+
+        if scope['method'] == 'GET' and scope['path'] == '/metrics':
+            body = json.dumps(get_metrics()).encode()
+            await send_response(send, 200, body, 'application/json')
+            return
+
+        # 匯入/匯出與統計報表使用與 Flask 模式相同的端點 (包含 ADMIN_TOKEN 檢查)
+        if scope['path'].startswith('/admin/'):
+            await call_flask(scope, receive, send)
+            return
+
+        tenant_id = None
+        if scope['path'] == '/':
+            tenant_id = DEFAULT_TENANT_ID
+        elif scope['path'].startswith('/webhook/'):
+            tenant_id = scope['path'][len('/webhook/'):]
+        if scope['method'] != 'POST' or tenant_id not in tenants:
+            await send_response(send, 404, b'Not Found')
+            return
+
+        chunks = []
+        while True:
+            message = await receive()
+            chunks.append(message.get('body', b''))
+            if not message.get('more_body'):
+                break
+        body = b''.join(chunks).decode('utf-8')
+        headers = dict(scope['headers'])
+        signature = headers.get(b'x-line-signature', b'').decode()
+
+        current_tenant.set(tenant_id)
+        try:
+            await handle_webhook_async(tenant_id, body, signature)
+        except InvalidSignatureError:
+            print("電子簽章錯誤, 請檢查密鑰是否正確？")
+            await send_response(send, 400, b'Bad Request')
+            return
+
+        await send_response(send, 200, b'OK')
+
+    return app
+
+def __getattr__(name):
+    # 相容 `meal_mate:app` 的啟動方式，第一次存取時才建立 app
+    global _app
+    if name == 'app':
+        if _app is None:
+            _app = create_app()
+        return _app
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def main(argv=None):
+    """
+    指令列入口，未指定指令時啟動伺服器
+    匯入/匯出指令直接讀寫 EVENT_LOG_DIR，伺服器運作中請改用 /admin 端點
+    report 指令只讀取統計快照，加上 --rebuild 時先從 EVENT_LOG_DIR 重建快照
+    """
+    parser = argparse.ArgumentParser(prog='meal_mate')
+    commands = parser.add_subparsers(dest='command')
+    commands.add_parser('serve', help='啟動 LINE Bot 伺服器')
+    commands.add_parser('worker', help='處理持久化佇列中的 AI 工作 (需設定 JOB_QUEUE_PATH)')
+
+    replay_parser = commands.add_parser('replay', help='以模擬的 LINE/OpenAI 重播記錄的流量並比較處理時間')
+    replay_parser.add_argument('directory', help='TRAFFIC_CAPTURE_DIR 記錄的目錄')
+    replay_parser.add_argument('--speed', type=float, default=1.0, help='重播速度倍數，0 表示不等待到達間隔')
+    replay_parser.add_argument('--concurrency', type=int, default=8)
+
+    export_parser = commands.add_parser('export', help='匯出使用者資料或飲食記錄')
+    export_parser.add_argument('kind', choices=['profiles', 'food_logs'])
+    export_parser.add_argument('--format', choices=['csv', 'jsonl', 'parquet'], default='jsonl')
+    export_parser.add_argument('--output', help='輸出檔案，預設為標準輸出 (parquet 必須指定)')
+
+    import_parser = commands.add_parser('import', help='匯入使用者資料或飲食記錄')
+    import_parser.add_argument('kind', choices=['profiles', 'food_logs'])
+    import_parser.add_argument('--format', choices=['csv', 'jsonl'], default='jsonl')
+    import_parser.add_argument('--input', help='輸入檔案，預設為標準輸入')
+
+    report_parser = commands.add_parser('report', help='從統計快照產生分組或每小時報表')
+    report_parser.add_argument('kind', choices=['groups', 'hourly'])
+    report_parser.add_argument('--group-by', help='以逗號分隔: goal, gender, activity_level, tenant')
+    report_parser.add_argument('--metric', choices=ANALYTICS_METRICS, default='avg_intake')
+    report_parser.add_argument('--percentiles', default='50,90')
+    report_parser.add_argument('--snapshot', default=ANALYTICS_SNAPSHOT_PATH, help='統計快照檔案，預設為 ANALYTICS_SNAPSHOT_PATH')
+    report_parser.add_argument('--rebuild', action='store_true', help='先從事件記錄重建快照')
+
+    args = parser.parse_args(argv)
+
+    if args.command in (None, 'serve'):
+        create_app().run(host='0.0.0.0', port=5000)
+        return
+
+    if args.command == 'worker':
+        if not JOB_QUEUE_PATH:
+            parser.error("請先設定 JOB_QUEUE_PATH")
+        run_worker()
+        return
+
+    if args.command == 'replay':
+        report = replay_traffic(args.directory, args.speed, args.concurrency)
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+        return
+
+    if args.command == 'report':
+        if not args.snapshot:
+            parser.error("請設定 ANALYTICS_SNAPSHOT_PATH 或指定 --snapshot")
+        if args.rebuild:
+            if not EVENT_LOG_DIR:
+                parser.error("重建快照需要設定 EVENT_LOG_DIR")
+            open_event_log(EVENT_LOG_DIR)
+            write_analytics_snapshot(args.snapshot)
+        try:
+            group_by, percentiles = parse_report_args(args.group_by, args.percentiles)
+            report = analytics_report(args.kind, group_by, args.metric, percentiles, args.snapshot)
+        except ValueError as e:
+            parser.error(str(e))
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+        return
+
+    if not EVENT_LOG_DIR:
+        parser.error("請先設定 EVENT_LOG_DIR，匯入與匯出需要讀寫事件記錄")
+    open_event_log(EVENT_LOG_DIR)
+
+    if args.command == 'export':
+        rows, fields = export_rows(args.kind)
+        if args.format == 'parquet':
+            if not args.output:
+                parser.error("parquet 格式需要指定 --output")
+            write_parquet(rows, fields, args.output)
+            return
+        chunks = stream_csv(rows, fields) if args.format == 'csv' else stream_jsonl(rows)
+        output = open(args.output, 'w', encoding='utf-8', newline='') if args.output else sys.stdout
+        with output:
+            output.writelines(chunks)
+
+    elif args.command == 'import':
+        lines = open(args.input, encoding='utf-8', newline='') if args.input else sys.stdin
+        with lines:
+            result = import_rows(args.kind, read_rows(lines, args.format))
+        print(json.dumps(result, ensure_ascii=False))
+
+
 if __name__ == "__main__":
-    app.run(host='0.0.0.0', port=5000)
\ No newline at end of file
+    main()
\ No newline at end of file
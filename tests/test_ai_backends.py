@@ -0,0 +1,116 @@
+import asyncio
+import concurrent.futures
+import threading
+
+import pytest
+
+import meal_mate
+from meal_mate import HedgedBackend, StubBackend
+
+MESSAGES = [{'role': 'user', 'content': '我的需求熱量為1800大卡'}]
+SETTINGS = meal_mate.AI_REQUEST_SETTINGS['diet_plan']
+
+
+class FailingBackend:
+    def __init__(self):
+        self.calls = 0
+
+    def complete(self, messages, settings):
+        self.calls += 1
+        raise RuntimeError('upstream error')
+
+    async def acomplete(self, messages, settings):
+        self.calls += 1
+        raise RuntimeError('upstream error')
+
+
+class CountingBackend(StubBackend):
+    def __init__(self, latency=0.0, text='secondary'):
+        super().__init__(latency)
+        self.text = text
+        self.calls = 0
+
+    def respond(self, messages, settings):
+        self.calls += 1
+        return self.text
+
+
+@pytest.fixture
+def hedging(monkeypatch):
+    monkeypatch.setattr(meal_mate, 'metrics', meal_mate.Counter())
+    monkeypatch.setattr(meal_mate, 'ai_backends', {})
+    monkeypatch.setattr(meal_mate, 'hedge_executor', concurrent.futures.ThreadPoolExecutor(max_workers=4))
+    yield meal_mate.metrics
+    meal_mate.hedge_executor.shutdown(wait=True)
+
+
+def test_routes_by_request_kind(hedging, monkeypatch):
+    monkeypatch.setattr(meal_mate, 'AI_ROUTES', {'diet_plan': 'stub', 'image': 'http'})
+    monkeypatch.setattr(meal_mate, 'AI_HEDGE_BACKEND', None)
+    backend = meal_mate.get_ai_backend('diet_plan')
+    assert isinstance(backend, StubBackend)
+    assert meal_mate.get_ai_backend('diet_plan') is backend
+    assert isinstance(meal_mate.get_ai_backend('image'), meal_mate.HttpChatBackend)
+
+    reply = meal_mate.create_chat_completion('diet_plan', MESSAGES)
+    assert reply.splitlines()[-2] == '菜單總熱量:1800大卡'
+
+
+def test_hedged_routes_share_named_backends(hedging, monkeypatch):
+    monkeypatch.setattr(meal_mate, 'AI_ROUTES', {'diet_plan': 'http', 'image': 'stub'})
+    monkeypatch.setattr(meal_mate, 'AI_HEDGE_BACKEND', 'stub')
+    hedged = meal_mate.get_ai_backend('diet_plan')
+    assert isinstance(hedged, HedgedBackend)
+    assert hedged.primary is meal_mate.ai_backends['http']
+    assert hedged.secondary is meal_mate.ai_backends['stub']
+    # 主要後端就是備用後端時不對沖
+    assert meal_mate.get_ai_backend('image') is meal_mate.ai_backends['stub']
+
+
+def test_fast_primary_is_not_hedged(hedging):
+    secondary = CountingBackend()
+    backend = HedgedBackend(CountingBackend(text='primary'), secondary, 1.0)
+    assert backend.complete(MESSAGES, SETTINGS) == 'primary'
+    assert asyncio.run(backend.acomplete(MESSAGES, SETTINGS)) == 'primary'
+    assert secondary.calls == 0
+    assert hedging['ai_hedged'] == 0
+
+
+def test_slow_primary_is_hedged(hedging):
+    backend = HedgedBackend(CountingBackend(1.0, 'primary'), CountingBackend(), 0.05)
+    assert backend.complete(MESSAGES, SETTINGS) == 'secondary'
+    assert asyncio.run(backend.acomplete(MESSAGES, SETTINGS)) == 'secondary'
+    assert hedging['ai_hedged'] == 2
+    assert hedging['ai_hedge_won'] == 2
+
+
+def test_failed_primary_is_hedged_immediately(hedging):
+    primary = FailingBackend()
+    backend = HedgedBackend(primary, CountingBackend(), 60.0)
+    assert backend.complete(MESSAGES, SETTINGS) == 'secondary'
+    assert asyncio.run(backend.acomplete(MESSAGES, SETTINGS)) == 'secondary'
+    assert primary.calls == 2
+
+    failing = HedgedBackend(FailingBackend(), FailingBackend(), 60.0)
+    with pytest.raises(RuntimeError):
+        failing.complete(MESSAGES, SETTINGS)
+    with pytest.raises(RuntimeError):
+        asyncio.run(failing.acomplete(MESSAGES, SETTINGS))
+
+
+def test_hedge_timer_starts_when_primary_runs(hedging):
+    # 落後的請求佔滿執行緒池，主要請求排隊期間不算入等待時間
+    release = threading.Event()
+    for _ in range(4):
+        meal_mate.hedge_executor.submit(release.wait)
+    secondary = CountingBackend()
+    backend = HedgedBackend(CountingBackend(text='primary'), secondary, 0.1)
+
+    caller = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    reply = caller.submit(backend.complete, MESSAGES, SETTINGS)
+    threading.Timer(0.5, release.set).start()
+
+    assert reply.result(timeout=5) == 'primary'
+    assert secondary.calls == 0
+    assert hedging['ai_hedged'] == 0
+    caller.shutdown()
@@ -0,0 +1,118 @@
+import random
+import time
+from datetime import date
+
+import pytest
+
+import meal_mate
+from meal_mate import DailyTracker, UserProfile
+
+numpy = pytest.importorskip('numpy')
+
+QUERIES = [
+    ((), 'avg_intake'),
+    (('goal',), 'intake_ratio'),
+    (('goal', 'gender'), 'weight'),
+    (('tenant', 'goal', 'gender', 'activity_level'), 'avg_intake')
+]
+PERCENTILES = (0, 50, 90, 99, 100)
+
+
+def make_users(count, tenant, seed):
+    '''
+    隨機的使用者資料，今天與前兩天各有一筆飲食記錄
+    '''
+    rng = random.Random(seed)
+    today = date.today().toordinal()
+    now = int(time.time())
+    users = {}
+    for index in range(count):
+        profile = UserProfile(
+            goal=rng.choice(list(meal_mate.GOAL_OPTIONS.values())), gender=rng.choice(['男', '女']),
+            age=rng.randrange(18, 80), height=rng.uniform(150, 195), weight=rng.uniform(45, 110),
+            activity_level=rng.choice(list(meal_mate.ACTIVITY_OPTIONS.values()))
+        )
+        for day in range(today - 2, today + 1):
+            profile.daily_tracker = DailyTracker(total_calories=2000.0, day=day)
+            meal_mate.apply_food_entry(profile, '便當', rng.uniform(500, 2500), now - rng.randrange(3600))
+        users[f'{tenant}:U{index}' if tenant else f'U{index}'] = profile
+    return users
+
+
+@pytest.fixture
+def analytics(monkeypatch, tmp_path):
+    monkeypatch.setattr(meal_mate, 'analytics_cache', {})
+    monkeypatch.setattr(meal_mate, 'image_requests_by_hour', meal_mate.Counter())
+    monkeypatch.setattr(meal_mate, 'ANALYTICS_INSTANCE_ID', 'a')
+    return str(tmp_path / 'analytics.npz')
+
+
+def test_group_report_matches_numpy_percentile(analytics, monkeypatch):
+    users = make_users(300, '', 1)
+    users.update(make_users(200, 'tenant1', 2))
+    monkeypatch.setattr(meal_mate, 'user_profiles', users)
+    meal_mate.write_analytics_snapshot(analytics)
+    snapshot = meal_mate.load_analytics_snapshot(analytics)
+
+    for group_by, metric in QUERIES:
+        report = meal_mate.group_report(snapshot, group_by, metric, PERCENTILES)
+        values = meal_mate.analytics_metric(snapshot, metric).astype(numpy.float64)
+        assert sum(row['users'] for row in report['groups']) == len(users)
+        for row in report['groups']:
+            mask = ~numpy.isnan(values)
+            for name in group_by:
+                if name == 'tenant':
+                    column, names = snapshot['tenant_code'], [str(tenant_id) for tenant_id in snapshot['tenant_names']]
+                else:
+                    column, names = snapshot[f'{name}_code'], meal_mate.ANALYTICS_CATEGORIES[name]
+                mask &= column == names.index(row[name])
+            assert row['count'] == int(mask.sum())
+            if not mask.any():
+                continue
+            assert row['mean'] == pytest.approx(values[mask].mean(), abs=0.01)
+            for percentile in PERCENTILES:
+                assert row[f'p{percentile:g}'] == pytest.approx(numpy.percentile(values[mask], percentile), abs=0.011)
+
+
+def test_snapshots_from_instances_are_merged(analytics, monkeypatch):
+    hour = int(time.time() // 3600)
+    monkeypatch.setattr(meal_mate, 'user_profiles', make_users(30, 'tenant1', 1))
+    meal_mate.record_image_request(hour * 3600)
+    meal_mate.write_analytics_snapshot(analytics)
+
+    monkeypatch.setattr(meal_mate, 'ANALYTICS_INSTANCE_ID', 'b')
+    monkeypatch.setattr(meal_mate, 'user_profiles', {**make_users(20, '', 2), **make_users(10, 'tenant1', 3)})
+    meal_mate.image_requests_by_hour.clear()
+    meal_mate.record_image_request(hour * 3600)
+    meal_mate.record_image_request((hour - 1) * 3600)
+    meal_mate.write_analytics_snapshot(analytics)
+
+    snapshot = meal_mate.load_analytics_snapshot(analytics)
+    assert len(snapshot['tenant_code']) == 60
+    tenants = dict(zip(*numpy.unique(snapshot['tenant_names'][snapshot['tenant_code']], return_counts=True)))
+    assert tenants == {'tenant1': 40, '': 20}
+    assert snapshot['image_hour'].tolist() == [hour - 1, hour]
+    assert snapshot['image_count'].tolist() == [1, 2]
+    # 今日飲食記錄對應到合併後的列
+    assert len(snapshot['food_user']) == 60
+    assert sorted(set(snapshot['food_user'].tolist())) == list(range(60))
+
+    report = meal_mate.group_report(snapshot, ('tenant',), 'weight')
+    assert {row['tenant']: row['users'] for row in report['groups']} == {'tenant1': 40, '': 20}
+
+
+def test_stale_instance_snapshots_are_ignored(analytics, monkeypatch):
+    monkeypatch.setattr(meal_mate, 'user_profiles', make_users(5, '', 1))
+    meal_mate.write_analytics_snapshot(analytics)
+    stale_path = meal_mate.analytics_instance_path(analytics)
+    stale_at = time.time() - 2 * meal_mate.ANALYTICS_STALE_SECONDS
+    meal_mate.os.utime(stale_path, (stale_at, stale_at))
+
+    # 只有已停止的實例的快照時仍可讀取
+    assert len(meal_mate.load_analytics_snapshot(analytics)['tenant_code']) == 5
+
+    monkeypatch.setattr(meal_mate, 'ANALYTICS_INSTANCE_ID', 'b')
+    monkeypatch.setattr(meal_mate, 'user_profiles', make_users(7, '', 2))
+    meal_mate.write_analytics_snapshot(analytics)
+    assert len(meal_mate.load_analytics_snapshot(analytics)['tenant_code']) == 7
+    assert not meal_mate.os.path.exists(stale_path)
@@ -0,0 +1,78 @@
+import asyncio
+import json
+
+import pytest
+
+import meal_mate
+from meal_mate import DailyTracker, UserProfile
+
+pytest.importorskip('aiohttp')
+
+PROFILE = {
+    'user_id': 'U1', 'goal': '減重', 'gender': '男', 'age': 30,
+    'height': 175.0, 'weight': 70.0, 'activity_level': '輕度活動'
+}
+
+
+@pytest.fixture
+def asgi_app(monkeypatch):
+    monkeypatch.setenv('LINE_TOKEN', 'token')
+    monkeypatch.setenv('LINE_SECRET', 'secret')
+    monkeypatch.setattr(meal_mate, 'ADMIN_TOKEN', 'admin')
+    monkeypatch.setattr(meal_mate, 'REMINDER_SCHEDULER', False)
+    monkeypatch.setattr(meal_mate, 'event_log', None)
+    monkeypatch.setattr(meal_mate, 'session_store', meal_mate.InMemoryKV())
+    monkeypatch.setattr(meal_mate, 'user_profiles', {
+        'U1': UserProfile(**{key: value for key, value in PROFILE.items() if key != 'user_id'},
+                          daily_tracker=DailyTracker(total_calories=1800.0))
+    })
+    return meal_mate.create_asgi_app()
+
+
+def call(app, method, path, query=b'', body_chunks=(b'',), token='admin'):
+    '''
+    以 ASGI 介面送出一個請求，回傳 (狀態碼, 內容)
+    '''
+    async def main():
+        messages = [
+            {'type': 'http.request', 'body': chunk, 'more_body': index < len(body_chunks) - 1}
+            for index, chunk in enumerate(body_chunks)
+        ]
+        sent = []
+
+        async def receive():
+            return messages.pop(0)
+
+        async def send(message):
+            sent.append(message)
+
+        headers = [(b'authorization', f'Bearer {token}'.encode())] if token else []
+        scope = {'type': 'http', 'method': method, 'path': path, 'query_string': query, 'headers': headers}
+        await app(scope, receive, send)
+        return sent[0]['status'], b''.join(message.get('body', b'') for message in sent[1:])
+
+    return asyncio.run(main())
+
+
+def test_admin_requires_token(asgi_app):
+    assert call(asgi_app, 'GET', '/admin/export/profiles', token=None)[0] == 403
+    assert call(asgi_app, 'GET', '/admin/export/profiles', token='wrong')[0] == 403
+
+
+def test_admin_export_and_import(asgi_app):
+    status, body = call(asgi_app, 'GET', '/admin/export/profiles', b'format=jsonl')
+    assert status == 200
+    assert [json.loads(line) for line in body.decode().splitlines()] == [PROFILE]
+
+    meal_mate.user_profiles.clear()
+    row = json.dumps({**PROFILE, 'user_id': 'U2'}, ensure_ascii=False).encode()
+    # 請求內容分成多塊送出
+    status, body = call(asgi_app, 'POST', '/admin/import/profiles', b'format=jsonl', [row[:10], row[10:], b'\n'])
+    assert status == 200
+    assert json.loads(body)['imported'] == 1
+    assert meal_mate.user_profiles['U2'].weight == 70.0
+
+
+def test_admin_report_without_snapshot(asgi_app, monkeypatch):
+    monkeypatch.setattr(meal_mate, 'ANALYTICS_SNAPSHOT_PATH', None)
+    assert call(asgi_app, 'GET', '/admin/report/groups')[0] == 503
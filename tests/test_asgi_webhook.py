@@ -0,0 +1,123 @@
+import asyncio
+import base64
+import hashlib
+import hmac
+import json
+
+import pytest
+
+import meal_mate
+from meal_mate import DailyTracker, SeenEvents, UserProfile
+
+pytest.importorskip('aiohttp')
+
+SECRET = 'secret'
+
+
+class BlockingLineBotApi:
+    '''
+    ASGI 模式的圖片與新增記錄不應使用同步的 LINE 用戶端
+    '''
+    def __getattr__(self, name):
+        raise AssertionError(f"呼叫了同步的 LineBotApi.{name}")
+
+
+class AsyncStubLineBotApi:
+    def __init__(self):
+        self.replies = []
+        self.posts = []
+
+    async def reply_message(self, reply_token, message):
+        self.replies.append((reply_token, message.text))
+
+    async def _post(self, path, data=None):
+        self.posts.append((path, json.loads(data)))
+
+
+@pytest.fixture
+def webhook_app(monkeypatch):
+    monkeypatch.setenv('LINE_TOKEN', 'token')
+    monkeypatch.setenv('LINE_SECRET', SECRET)
+    monkeypatch.setattr(meal_mate, 'REMINDER_SCHEDULER', False)
+    monkeypatch.setattr(meal_mate, 'event_log', None)
+    monkeypatch.setattr(meal_mate, 'seen_events', SeenEvents(60, 100))
+    monkeypatch.setattr(meal_mate, 'session_store', meal_mate.InMemoryKV())
+    monkeypatch.setattr(meal_mate, 'user_profiles', {
+        'U1': UserProfile(daily_tracker=DailyTracker(total_calories=1800.0))
+    })
+    meal_mate.session_store.set(meal_mate.session_key('setup_stage', 'U1'), 'ready')
+
+    app = meal_mate.create_asgi_app()
+    tenant = meal_mate.tenants[meal_mate.DEFAULT_TENANT_ID]
+    tenant.line_bot_api = BlockingLineBotApi()
+    tenant.async_line_bot_api = AsyncStubLineBotApi()
+    return app, tenant.async_line_bot_api
+
+
+def post(app, body, signature):
+    '''
+    以 ASGI 介面送出 webhook，回傳狀態碼
+    '''
+    async def main():
+        sent = []
+
+        async def receive():
+            return {'type': 'http.request', 'body': body, 'more_body': False}
+
+        async def send(message):
+            sent.append(message)
+
+        scope = {'type': 'http', 'method': 'POST', 'path': '/', 'headers': [(b'x-line-signature', signature)]}
+        await app(scope, receive, send)
+        return sent[0]['status']
+
+    return asyncio.run(main())
+
+
+def post_event(app, message, event_id='event-1'):
+    event = {
+        'type': 'message',
+        'mode': 'active',
+        'timestamp': int(meal_mate.time.time() * 1000),
+        'source': {'type': 'user', 'userId': 'U1'},
+        'replyToken': 'reply-1',
+        'webhookEventId': event_id,
+        'deliveryContext': {'isRedelivery': False},
+        'message': message
+    }
+    body = json.dumps({'destination': 'test', 'events': [event]}).encode()
+    return post(app, body, base64.b64encode(hmac.new(SECRET.encode(), body, hashlib.sha256).digest()))
+
+
+def test_food_log_replies_with_async_client(webhook_app):
+    app, api = webhook_app
+    message = {'type': 'text', 'id': 'message-1', 'text': '新增記錄 白飯 280 雞腿 350'}
+    assert post_event(app, message) == 200
+
+    assert meal_mate.user_profiles['U1'].daily_tracker.consumed_calories == 630.0
+    assert len(api.replies) == 1
+    assert api.replies[0][1].startswith('已成功記錄 白飯 (280.0 大卡)、雞腿 (350.0 大卡)')
+
+    # 重送的事件不再記錄
+    assert post_event(app, message) == 200
+    assert meal_mate.user_profiles['U1'].daily_tracker.consumed_calories == 630.0
+    assert len(api.replies) == 1
+
+
+def test_image_shows_loading_with_async_client(webhook_app, monkeypatch):
+    app, api = webhook_app
+    jobs = []
+    monkeypatch.setattr(meal_mate, 'submit_ai_job', lambda job: jobs.append(job) or True)
+    monkeypatch.setattr(meal_mate, 'estimate_ai_wait', lambda kind: 8.0)
+
+    assert post_event(app, {'type': 'image', 'id': 'message-2', 'contentProvider': {'type': 'line'}}) == 200
+
+    assert [job['message_id'] for job in jobs] == ['message-2']
+    assert jobs[0]['delivery'] == 'reply'
+    assert api.posts == [('/v2/bot/chat/loading/start', {'chatId': 'U1', 'loadingSeconds': 10})]
+    assert api.replies == []
+
+
+def test_invalid_signature_is_rejected(webhook_app):
+    app, _ = webhook_app
+    assert post(app, b'{"destination": "test", "events": []}', b'invalid') == 400
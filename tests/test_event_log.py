@@ -0,0 +1,126 @@
+import sys
+import threading
+
+import pytest
+
+import meal_mate
+from meal_mate import (
+    EVENT_FOOD_ADD, EVENT_FOOD_BATCH, EVENT_PROFILE_NEW, EVENT_PROFILE_SET, EVENT_SETUP_STAGE,
+    EVENT_TRACKER_RESET, EVENT_WEIGHT, DailyTracker, EventLog, UserProfile,
+    add_food_logs, commit_event, decode_profile, encode_profile, open_event_log,
+    pack_event, read_event_segment, write_snapshot
+)
+
+
+def test_food_batch_replays_all_or_nothing(tmp_path):
+    path = tmp_path / 'events-00000000.log'
+    single = pack_event(EVENT_FOOD_ADD, 'U1', ('白飯', 280.0, 1))
+    batch = pack_event(EVENT_FOOD_BATCH, 'U1', (2, '雞腿', 350.0, '青菜', 60.0))
+
+    # 記錄檔在批次中間任何位置截斷時，整批都不會重播
+    for cut in range(len(single), len(single) + len(batch)):
+        path.write_bytes((single + batch)[:cut])
+        assert [op for op, _, _ in read_event_segment(str(path))] == [EVENT_FOOD_ADD]
+
+    path.write_bytes(single + batch)
+    assert [op for op, _, _ in read_event_segment(str(path))] == [EVENT_FOOD_ADD, EVENT_FOOD_BATCH]
+
+
+def test_add_food_logs_commits_one_event(monkeypatch):
+    profile = UserProfile(daily_tracker=DailyTracker(total_calories=2000.0))
+    monkeypatch.setattr(meal_mate, 'user_profiles', {'U1': profile})
+    events = []
+    monkeypatch.setattr(meal_mate, 'record_event', lambda op, user_id, *args: events.append((op, args)))
+
+    assert add_food_logs('U1', [('雞腿', 350.0), ('青菜', 60.0)])
+
+    assert [op for op, _ in events] == [EVENT_FOOD_BATCH]
+    assert [(food.name, food.calories) for food in profile.daily_tracker.food_log] == [('雞腿', 350.0), ('青菜', 60.0)]
+    assert profile.daily_tracker.consumed_calories == 410.0
+    assert not add_food_logs('U1', [('牛排', 1000.0), ('蛋糕', 700.0)])
+    assert len(profile.daily_tracker.food_log) == 2
+
+
+
+@pytest.fixture
+def live_log(tmp_path, monkeypatch):
+    '''
+    寫入暫存目錄的事件記錄，測試結束後還原全域狀態
+    '''
+    monkeypatch.setattr(meal_mate, 'user_profiles', {})
+    monkeypatch.setattr(meal_mate, 'session_store', meal_mate.InMemoryKV())
+    log = EventLog(str(tmp_path), 0.05, sys.maxsize)
+    log.start(0)
+    monkeypatch.setattr(meal_mate, 'event_log', log)
+    return log
+
+
+def commit_user(user_id, foods):
+    commit_event(EVENT_PROFILE_NEW, user_id)
+    commit_event(EVENT_PROFILE_SET, user_id, 'goal', '減重')
+    commit_event(EVENT_SETUP_STAGE, user_id, 'ready')
+    commit_event(EVENT_TRACKER_RESET, user_id, 1800.0, 739000)
+    commit_event(EVENT_WEIGHT, user_id, 70.0, 1_700_000_000)
+    for index, (name, calories) in enumerate(foods):
+        commit_event(EVENT_FOOD_ADD, user_id, name, calories, 1_700_000_000 + index)
+
+
+def test_profile_encoding_round_trip(live_log):
+    commit_user('U1', [('白飯', 280.0), ('雞腿', 350.0), ('白飯', 280.0)])
+    profile = meal_mate.user_profiles['U1']
+    assert decode_profile(encode_profile(profile)) == profile
+    assert decode_profile(encode_profile(UserProfile())) == UserProfile()
+
+
+def test_snapshot_is_built_from_the_log_without_state_lock(live_log, monkeypatch):
+    commit_user('U1', [('白飯', 280.0)])
+    commit_user('U2', [('燙青菜', 60.0)])
+
+    # 重建快照期間其他執行緒仍可取得 state_lock
+    building = threading.Event()
+    release = threading.Event()
+    original = meal_mate.read_event_segment
+
+    def slow_read(path):
+        building.set()
+        release.wait(5)
+        yield from original(path)
+
+    monkeypatch.setattr(meal_mate, 'read_event_segment', slow_read)
+    thread = threading.Thread(target=write_snapshot)
+    thread.start()
+    assert building.wait(5)
+    assert meal_mate.state_lock.acquire(timeout=1)
+    meal_mate.state_lock.release()
+    # 快照只包含切換記錄段之前的事件
+    commit_event(EVENT_FOOD_ADD, 'U1', '茶葉蛋', 75.0, 1_700_000_100)
+    release.set()
+    thread.join()
+    monkeypatch.setattr(meal_mate, 'read_event_segment', original)
+
+    first_segment, records, session = meal_mate.read_snapshot(live_log.snapshot_path())
+    assert first_segment == live_log.segment
+    assert [food[0] for food in records['U1'][7][3]] == ['白飯']
+    assert session[meal_mate.session_key('setup_stage', 'U2')] == 'ready'
+
+    # 第二次快照從上一個快照加上新的記錄段重建
+    commit_event(EVENT_FOOD_ADD, 'U2', '牛肉麵', 600.0, 1_700_000_200)
+    write_snapshot()
+    _, records, _ = meal_mate.read_snapshot(live_log.snapshot_path())
+    assert records['U1'] == encode_profile(meal_mate.user_profiles['U1'])
+    assert records['U2'] == encode_profile(meal_mate.user_profiles['U2'])
+    assert live_log.segments() == [live_log.segment]
+
+
+def test_restart_from_snapshot_and_tail(live_log, monkeypatch):
+    commit_user('U1', [('白飯', 280.0), ('雞腿', 350.0)])
+    write_snapshot()
+    commit_event(EVENT_FOOD_ADD, 'U1', '茶葉蛋', 75.0, 1_700_000_100)
+    live_log.flush()
+    expected = meal_mate.user_profiles['U1']
+
+    monkeypatch.setattr(meal_mate, 'user_profiles', {})
+    monkeypatch.setattr(meal_mate, 'session_store', meal_mate.InMemoryKV())
+    open_event_log(live_log.directory)
+    assert meal_mate.user_profiles['U1'] == expected
+    assert meal_mate.session_store.get(meal_mate.session_key('setup_stage', 'U1')) == 'ready'
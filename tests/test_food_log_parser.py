@@ -0,0 +1,52 @@
+import pytest
+
+from meal_mate import parse_food_log
+
+
+@pytest.mark.parametrize('text, expected', [
+    ('雞胸肉 200', [('雞胸肉', 200.0)]),
+    ('白飯 280 雞腿 350 青菜 60', [('白飯', 280.0), ('雞腿', 350.0), ('青菜', 60.0)]),
+    ('白飯 280, 雞腿 350', [('白飯', 280.0), ('雞腿', 350.0)]),
+    ('雞腿 便當 650', [('雞腿 便當', 650.0)]),
+    ('雞蛋 2顆 140大卡', [('雞蛋 2顆', 140.0)]),
+    ('白飯280大卡 雞腿350kcal', [('白飯', 280.0), ('雞腿', 350.0)]),
+    ('白飯 350 卡', [('白飯', 350.0)]),
+    ('白飯 280 卡拉雞腿堡 500', [('白飯', 280.0), ('卡拉雞腿堡', 500.0)]),
+    ('茶葉蛋 75 x2', [('茶葉蛋 x2', 150.0)]),
+    ('茶葉蛋 75 x 2', [('茶葉蛋 x2', 150.0)]),
+    ('牛排 300大卡x2', [('牛排 x2', 600.0)]),
+    # 與名稱相連的數字屬於名稱
+    ('麥當勞1號餐 800', [('麥當勞1號餐', 800.0)]),
+    ('7-11飯糰 300', [('7-11飯糰', 300.0)]),
+    ('85度C咖啡 150', [('85度C咖啡', 150.0)]),
+    ('3Q餅 200', [('3Q餅', 200.0)]),
+    # 單獨的數字後面接著量詞時是數量
+    ('雞蛋 2 顆 140', [('雞蛋 2 顆', 140.0)]),
+    ('牛奶 250 毫升 150', [('牛奶 250 毫升', 150.0)]),
+    ('地瓜 2 條 300', [('地瓜 2 條', 300.0)]),
+    ('雞蛋 2 顆 140 牛奶 250 ml 150', [('雞蛋 2 顆', 140.0), ('牛奶 250 ml', 150.0)]),
+    ('黑咖啡 5 x2', [('黑咖啡 x2', 10.0)]),
+])
+def test_parse_food_log(text, expected):
+    assert parse_food_log(text) == expected
+
+
+@pytest.mark.parametrize('text', [
+    '',
+    '白飯',
+    '白飯280',
+    '白飯 1e3',
+    '白飯 -280',
+    '白飯 - 280',
+    '280',
+    'x2',
+    '白飯 0',
+    '白飯 20000',
+    '白飯, 雞腿 350',
+    '雞蛋 2 顆',
+    # 分不出是數量還是熱量
+    '蘋果 2 香蕉 200',
+])
+def test_parse_food_log_rejects(text):
+    with pytest.raises(ValueError):
+        parse_food_log(text)
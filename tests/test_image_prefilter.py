@@ -0,0 +1,108 @@
+import random
+from collections import OrderedDict
+from io import BytesIO
+from types import SimpleNamespace
+
+import pytest
+
+import meal_mate
+
+Image = pytest.importorskip('PIL.Image')
+
+
+def make_photo(size=640):
+    '''
+    有紋理的彩色照片，通過尺寸、單色與模糊檢查
+    '''
+    rng = random.Random(0)
+    img = Image.new('RGB', (size, size))
+    img.putdata([
+        (rng.randrange(150, 256), rng.randrange(0, 100), rng.randrange(0, 60))
+        for _ in range(size * size)
+    ])
+    data = BytesIO()
+    img.save(data, 'JPEG', quality=90)
+    return data.getvalue()
+
+
+def test_classifier_receives_color_image(monkeypatch):
+    seen = []
+
+    def classify(img):
+        seen.append(img)
+        return 0.9
+
+    monkeypatch.setattr(meal_mate, 'IMAGE_CLASSIFIER_MODEL', 'food.onnx')
+    monkeypatch.setattr(meal_mate, 'classify_food_probability', classify)
+    monkeypatch.setattr(meal_mate, 'image_hashes', OrderedDict())
+
+    reply_text, image_hash = meal_mate.prefilter_image('U1', make_photo())
+
+    assert reply_text is None
+    assert image_hash is not None
+    assert seen[0].mode == 'RGB'
+    red, green, blue = (band.getextrema() for band in seen[0].split())
+    assert red[0] > green[1]
+
+
+def test_replay_images_are_not_duplicates(monkeypatch):
+    monkeypatch.setattr(meal_mate, 'image_hashes', OrderedDict())
+    monkeypatch.setattr(meal_mate, 'IMAGE_CLASSIFIER_MODEL', None)
+    api = meal_mate.ReplayLineBotApi({})
+
+    for index in range(50):
+        data = api.get_message_content(f'message-{index}').content
+        reply_text, image_hash = meal_mate.prefilter_image('U1', data)
+        assert reply_text is None
+        meal_mate.remember_image_result('U1', image_hash, f'result-{index}')
+
+    # 重送的同一則訊息仍會被視為重複
+    reply_text, _ = meal_mate.prefilter_image('U1', api.get_message_content('message-49').content)
+    assert 'result-49' in reply_text
+
+
+def test_duplicates_expire(monkeypatch):
+    monkeypatch.setattr(meal_mate, 'image_hashes', OrderedDict())
+    monkeypatch.setattr(meal_mate, 'IMAGE_CLASSIFIER_MODEL', None)
+    photo = make_photo()
+    _, image_hash = meal_mate.prefilter_image('U1', photo)
+
+    meal_mate.remember_image_result('U1', image_hash, 'old-result', now=meal_mate.time.time() - 2 * meal_mate.IMAGE_HASH_TTL_SECONDS)
+    assert meal_mate.prefilter_image('U1', photo)[0] is None
+
+    meal_mate.remember_image_result('U1', image_hash, 'new-result')
+    assert 'new-result' in meal_mate.prefilter_image('U1', photo)[0]
+
+
+def test_image_hashes_are_bounded(monkeypatch):
+    monkeypatch.setattr(meal_mate, 'image_hashes', OrderedDict())
+    monkeypatch.setattr(meal_mate, 'IMAGE_HASH_MAX_USERS', 3)
+    now = meal_mate.time.time()
+
+    # 過期的使用者先被移除，之後依最久未記錄的順序移除
+    meal_mate.remember_image_result('U0', 0, 'result', now=now - 2 * meal_mate.IMAGE_HASH_TTL_SECONDS)
+    for index in range(1, 6):
+        meal_mate.remember_image_result(f'U{index}', index, 'result', now=now)
+    meal_mate.remember_image_result('U3', 7, 'result', now=now)
+    assert list(meal_mate.image_hashes) == ['U4', 'U5', 'U3']
+    assert len(meal_mate.image_hashes['U3']) == 2
+
+
+def test_rejected_image_refunds_ai_quota(monkeypatch):
+    blank = BytesIO()
+    Image.new('RGB', (640, 640), (255, 255, 255)).save(blank, 'JPEG')
+    api = SimpleNamespace(get_message_content=lambda message_id: SimpleNamespace(content=blank.getvalue()))
+    monkeypatch.setattr(meal_mate, 'tenants', {
+        meal_mate.DEFAULT_TENANT_ID: SimpleNamespace(line_bot_api=api, user_ai_rate=0.0, user_ai_burst=1, ai_bucket=None)
+    })
+    monkeypatch.setattr(meal_mate, 'user_ai_buckets', OrderedDict())
+    monkeypatch.setattr(meal_mate, 'global_ai_bucket', meal_mate.TokenBucket(0.0, 10))
+    monkeypatch.setattr(meal_mate, 'durable_job_queue', None)
+
+    assert meal_mate.allow_ai_request('U1')
+    assert not meal_mate.allow_ai_request('U1')
+
+    # 單色圖片在預先檢查就被擋下，沒有呼叫 OpenAI，額度退還
+    assert meal_mate.analyze_image({'user_id': 'U1', 'message_id': 'message-1'}) == meal_mate.IMAGE_REJECT_MESSAGES['blank']
+    assert meal_mate.global_ai_bucket.tokens == 10
+    assert meal_mate.allow_ai_request('U1')
@@ -0,0 +1,86 @@
+import io
+from datetime import date
+
+import pytest
+
+import meal_mate
+from meal_mate import DailyTracker, UserProfile, import_rows
+
+
+@pytest.fixture
+def users(monkeypatch):
+    today = date.today().toordinal()
+    monkeypatch.setattr(meal_mate, 'event_log', None)
+    monkeypatch.setattr(meal_mate, 'user_profiles', {
+        'U1': UserProfile(daily_tracker=DailyTracker(total_calories=2000.0, day=today)),
+        # 追蹤日期停在前天
+        'U2': UserProfile(daily_tracker=DailyTracker(total_calories=1800.0, day=today - 2))
+    })
+    return today
+
+
+def food_row(user_id, day, name='便當', calories=700.0):
+    return {
+        'user_id': user_id, 'date': date.fromordinal(day).isoformat(),
+        'timestamp': 1_700_000_000, 'name': name, 'calories': calories
+    }
+
+
+def test_past_days_go_to_diet_history(users):
+    today = users
+    result = import_rows('food_logs', [
+        food_row('U1', today, '早餐', 400.0),
+        food_row('U1', today - 1, '晚餐', 900.0),
+        food_row('U1', today - 3, '午餐', 600.0),
+        food_row('U2', today, '午餐', 500.0)
+    ])
+    assert result == {'imported': 4, 'skipped': 0, 'errors': [], 'reasons': {}}
+
+    profile = meal_mate.user_profiles['U1']
+    assert profile.daily_tracker.consumed_calories == 400.0
+    assert [food.name for food in profile.daily_tracker.food_log] == ['早餐']
+    assert {day: summary.calories for day, summary in profile.diet_history.days.items()} == {
+        today: 400.0, today - 1: 900.0, today - 3: 600.0
+    }
+
+    # 今日的記錄先重置追蹤日期
+    tracker = meal_mate.user_profiles['U2'].daily_tracker
+    assert (tracker.day, tracker.consumed_calories, tracker.total_calories) == (today, 500.0, 1800.0)
+
+
+def test_rows_outside_history_are_rejected(users):
+    today = users
+    result = import_rows('food_logs', [
+        food_row('U1', today + 1),
+        food_row('U1', today - meal_mate.DIET_HISTORY_DAYS),
+        food_row('U3', today),
+        {'user_id': 'U1', 'date': 'yesterday', 'timestamp': 0, 'name': '便當', 'calories': 700.0},
+        food_row('U1', today)
+    ])
+    assert result['imported'] == 1
+    assert result['skipped'] == 4
+    assert result['errors'] == [1, 2, 3, 4]
+    assert result['reasons'] == {
+        "日期在今天之後": 1,
+        f"日期超過 {meal_mate.DIET_HISTORY_DAYS} 天，不在飲食記錄保留範圍內": 1,
+        "使用者不存在或尚未完成設定": 1,
+        "格式錯誤": 1
+    }
+    assert meal_mate.user_profiles['U1'].diet_history.days.keys() == {today}
+
+
+def test_parquet_schema_does_not_depend_on_first_batch(monkeypatch):
+    pq = pytest.importorskip('pyarrow.parquet')
+    # 第一批的年齡與身高全為空值
+    monkeypatch.setattr(meal_mate, 'user_profiles', {
+        'U1': UserProfile(goal='減重'),
+        'U2': UserProfile(goal='減重', gender='女', age=30, height=160, weight=55.5, activity_level='輕度活動')
+    })
+    output = io.BytesIO()
+    rows, fields = meal_mate.export_rows('profiles')
+    meal_mate.write_parquet(rows, fields, output, batch_size=1)
+
+    table = pq.read_table(io.BytesIO(output.getvalue()))
+    assert str(table.schema.field('age').type) == 'int32'
+    assert str(table.schema.field('height').type) == 'double'
+    assert table.column('height').to_pylist() == [None, 160.0]
@@ -0,0 +1,130 @@
+import pytest
+
+import meal_mate
+from meal_mate import DurableJobQueue, durable_worker_loop
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1_700_000_000.0]
+    monkeypatch.setattr(meal_mate.time, 'time', lambda: now[0])
+    return now
+
+
+@pytest.fixture
+def job_queue(tmp_path, monkeypatch, clock):
+    job_queue = DurableJobQueue(str(tmp_path / 'jobs.db'))
+    monkeypatch.setattr(meal_mate, 'durable_job_queue', job_queue)
+    monkeypatch.setattr(meal_mate, 'ai_latency_estimates', dict(meal_mate.ai_latency_estimates))
+    return job_queue
+
+
+def make_job(user_id='U1'):
+    return {'kind': 'image', 'user_id': user_id, 'reply_token': 'reply', 'event_time': 0, 'message_id': 'm1'}
+
+
+class StepStop:
+    '''
+    取代 worker 的停止事件：佇列中沒有可執行的工作時時鐘前進一小時，等待 steps 次後停止
+    '''
+    def __init__(self, clock, steps):
+        self.clock = clock
+        self.steps = steps
+
+    def is_set(self):
+        return self.steps <= 0
+
+    def wait(self, timeout=None):
+        self.steps -= 1
+        self.clock[0] += 3600
+
+
+def test_expired_lease_is_reclaimed(job_queue, clock):
+    job_queue.put(make_job(), 1)
+    job_id, attempts, job = job_queue.claim()
+    assert attempts == 1 and job['user_id'] == 'U1'
+    assert job_queue.claim() is None
+
+    # worker 中斷，租約到期後由其他 worker 重新認領
+    clock[0] += meal_mate.JOB_LEASE_SECONDS + 1
+    assert job_queue.claim()[:2] == (job_id, 2)
+
+
+def test_retry_backoff(job_queue, clock, monkeypatch):
+    monkeypatch.setattr(meal_mate, 'JOB_RETRY_BASE_SECONDS', 10.0)
+    monkeypatch.setattr(meal_mate, 'JOB_RETRY_MAX_SECONDS', 30.0)
+    job_queue.put(make_job(), 1)
+
+    for attempts, delay in [(1, 10), (2, 20), (3, 30), (4, 30)]:
+        job_id, claimed_attempts, job = job_queue.claim()
+        assert claimed_attempts == attempts
+        job_queue.retry(job_id, attempts, 'error', job)
+        clock[0] += delay - 1
+        assert job_queue.claim() is None
+        clock[0] += 1
+
+
+def test_stored_result_is_reused(job_queue, clock, monkeypatch):
+    calls = []
+    delivered = []
+
+    def analyze(job):
+        calls.append(job['message_id'])
+        return '約 500 大卡'
+
+    def deliver(job, message):
+        # 第一次送出失敗
+        if not delivered:
+            delivered.append(None)
+            raise RuntimeError('push failed')
+        delivered.append(message.text)
+
+    monkeypatch.setitem(meal_mate.JOB_RESULT_HANDLERS, 'image', analyze)
+    monkeypatch.setattr(meal_mate, 'deliver_ai_result', deliver)
+    job_queue.put(make_job(), 1)
+
+    durable_worker_loop(StepStop(clock, 2))
+
+    assert calls == ['m1']
+    assert delivered == [None, '約 500 大卡']
+    assert job_queue.stats() == {'done': 1}
+
+
+def test_job_fails_after_max_attempts(job_queue, clock, monkeypatch):
+    delivered = []
+
+    def analyze(job):
+        raise RuntimeError('upstream error')
+
+    monkeypatch.setitem(meal_mate.JOB_RESULT_HANDLERS, 'image', analyze)
+    monkeypatch.setattr(meal_mate, 'deliver_ai_result', lambda job, message: delivered.append(message.text))
+    monkeypatch.setattr(meal_mate, 'JOB_MAX_ATTEMPTS', 2)
+    job_queue.put(make_job(), 1)
+
+    durable_worker_loop(StepStop(clock, 2))
+
+    assert delivered == [meal_mate.JOB_FAILURE_TEXTS['image']]
+    assert job_queue.stats() == {'failed': 1}
+    row = job_queue.connection().execute('SELECT attempts, last_error FROM ai_jobs').fetchone()
+    assert row == (2, 'upstream error')
+
+
+def test_webhook_reads_latency_recorded_by_worker(job_queue, monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(meal_mate.time, 'monotonic', lambda: now[0])
+    monkeypatch.setattr(meal_mate, 'AI_WORKERS', 2)
+    worker_queue = DurableJobQueue(job_queue.path)
+
+    assert meal_mate.estimate_ai_wait('image') == meal_mate.ai_latency_estimates['image']
+
+    worker_queue.record_latency('image', 8.0)
+    worker_queue.record_latency('image', 18.0)
+    job_queue.put(make_job(), 1)
+    job_queue.put(make_job('U2'), 1)
+    # 快取期間不重新查詢
+    assert meal_mate.estimate_ai_wait('image') == meal_mate.ai_latency_estimates['image']
+
+    now[0] += meal_mate.JOB_ESTIMATE_REFRESH_SECONDS
+    expected = 8.0 + meal_mate.AI_LATENCY_SMOOTHING * (18.0 - 8.0)
+    assert meal_mate.estimate_ai_wait('image') == pytest.approx(expected * 2)
+    assert meal_mate.estimate_ai_wait('diet_plan') == pytest.approx(meal_mate.ai_latency_estimates['diet_plan'] * 2)
@@ -0,0 +1,87 @@
+from types import SimpleNamespace
+
+import pytest
+
+import meal_mate
+from meal_mate import TokenBucket, allow_ai_request
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(meal_mate.time, 'monotonic', lambda: now[0])
+    monkeypatch.setattr(meal_mate, 'user_ai_buckets', meal_mate.OrderedDict())
+    monkeypatch.setattr(meal_mate, 'global_ai_bucket', TokenBucket(1000, 1000))
+    # 每分鐘 6 次、最多 2 次：用掉的額度 20 秒後補滿
+    monkeypatch.setattr(meal_mate, 'tenants', {
+        meal_mate.DEFAULT_TENANT_ID: SimpleNamespace(user_ai_rate=0.1, user_ai_burst=2, ai_bucket=None)
+    })
+    return now
+
+
+def test_idle_full_buckets_are_evicted(clock):
+    for index in range(100):
+        assert allow_ai_request(f'U{index}')
+    assert len(meal_mate.user_ai_buckets) == 100
+
+    clock[0] += 30
+    assert allow_ai_request('U100')
+    assert list(meal_mate.user_ai_buckets) == ['U100']
+
+
+def test_eviction_keeps_limits(clock):
+    assert allow_ai_request('U1')
+    assert allow_ai_request('U1')
+    assert not allow_ai_request('U1')
+
+    # 尚未補滿的令牌桶不會被移除，其他使用者的請求不會重設 U1 的額度
+    clock[0] += 5
+    assert allow_ai_request('U2')
+    assert 'U1' in meal_mate.user_ai_buckets
+    assert not allow_ai_request('U1')
+
+    clock[0] += 10
+    assert allow_ai_request('U1')
+
+
+@pytest.fixture
+def clinic(clock, monkeypatch):
+    # clinic 頻道全部使用者合計最多 2 次，幾乎不補充
+    monkeypatch.setattr(meal_mate, 'durable_job_queue', None)
+    monkeypatch.setattr(meal_mate, 'metrics', meal_mate.Counter())
+    meal_mate.tenants['clinic'] = SimpleNamespace(user_ai_rate=0.1, user_ai_burst=2, ai_bucket=TokenBucket(0.001, 2))
+    return meal_mate.tenants['clinic']
+
+
+def test_tenant_bucket_is_shared_by_its_users(clinic):
+    assert allow_ai_request('clinic:U1')
+    assert allow_ai_request('clinic:U2')
+    assert not allow_ai_request('clinic:U3')
+    # 頻道額度不足時退還使用者的令牌
+    assert meal_mate.user_ai_buckets['clinic:U3'].tokens == 2
+
+    # 其他頻道不受影響，同一個 LINE user_id 在不同頻道各自計算
+    assert allow_ai_request('U3')
+    assert allow_ai_request('U1')
+    assert meal_mate.user_ai_buckets['U1'].tokens == 1
+
+
+def test_refund_returns_tenant_and_global_tokens(clinic):
+    assert allow_ai_request('clinic:U1')
+    assert allow_ai_request('clinic:U2')
+    global_tokens = meal_mate.global_ai_bucket.tokens
+
+    meal_mate.refund_ai_request('clinic:U1')
+    assert meal_mate.user_ai_buckets['clinic:U1'].tokens == 2
+    assert meal_mate.global_ai_bucket.tokens == global_tokens + 1
+    assert meal_mate.metrics['ai_refunded'] == 1
+    assert allow_ai_request('clinic:U3')
+    assert not allow_ai_request('clinic:U1')
+
+
+def test_global_limit_refunds_tenant_bucket(clinic, monkeypatch):
+    monkeypatch.setattr(meal_mate, 'global_ai_bucket', TokenBucket(0.001, 1))
+    assert allow_ai_request('clinic:U1')
+    assert not allow_ai_request('clinic:U2')
+    assert clinic.ai_bucket.tokens == pytest.approx(1)
+    assert meal_mate.user_ai_buckets['clinic:U2'].tokens == 2
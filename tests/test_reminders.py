@@ -0,0 +1,76 @@
+from datetime import datetime
+from types import SimpleNamespace
+
+import pytest
+
+import meal_mate
+from meal_mate import (
+    DailyTracker, ReminderScheduler, UserProfile, apply_profile_batch,
+    schedule_reminders, send_due_reminders
+)
+
+
+class StubLineBotApi:
+    def __init__(self):
+        self.multicasts = []
+
+    def multicast(self, user_ids, message):
+        self.multicasts.append((list(user_ids), message.text))
+
+
+@pytest.fixture
+def reminders(monkeypatch):
+    '''
+    假的時鐘 (從 07:59 開始) 與不連網的 LINE 用戶端，600 位已完成設定的使用者
+    '''
+    now = [datetime(2026, 10, 19, 7, 59).timestamp()]
+    scheduler = ReminderScheduler(clock=lambda: now[0])
+    api = StubLineBotApi()
+    monkeypatch.setattr(meal_mate, 'reminder_scheduler', scheduler)
+    monkeypatch.setattr(meal_mate, 'tenants', {meal_mate.DEFAULT_TENANT_ID: SimpleNamespace(line_bot_api=api)})
+    monkeypatch.setattr(meal_mate, 'user_profiles', {
+        f'U{index}': UserProfile(daily_tracker=DailyTracker(total_calories=1800.0))
+        for index in range(600)
+    })
+    monkeypatch.setattr(meal_mate, 'event_log', None)
+    for user_id in meal_mate.user_profiles:
+        schedule_reminders(user_id)
+    return now, scheduler, api
+
+
+def test_due_reminders_are_multicast_in_batches(reminders):
+    now, scheduler, api = reminders
+    assert send_due_reminders() == 0
+
+    now[0] += 60
+    assert send_due_reminders() == 2
+    assert [len(user_ids) for user_ids, _ in api.multicasts] == [500, 100]
+    assert all('早餐' in text for _, text in api.multicasts)
+    # 送出後排定隔天同一時間
+    assert scheduler.user_timers['U0']['breakfast'] == int((now[0] + 86400) // 60)
+
+
+def test_late_reminders_are_skipped(reminders):
+    now, scheduler, api = reminders
+    # 排程中斷到午餐後才恢復：早餐與午餐都超過寬限時間
+    now[0] += 5 * 3600
+    assert send_due_reminders() == 0
+    assert api.multicasts == []
+    assert 'breakfast' in scheduler.user_timers['U0']
+
+
+def test_import_schedules_only_when_enabled(reminders, monkeypatch):
+    _, scheduler, _ = reminders
+    values = {
+        'goal': '減重', 'gender': '男', 'age': 30, 'height': 175.0,
+        'weight': 70.0, 'activity_level': '輕度活動'
+    }
+    monkeypatch.setattr(meal_mate, 'session_store', meal_mate.InMemoryKV())
+
+    monkeypatch.setattr(meal_mate, 'REMINDER_SCHEDULER', False)
+    apply_profile_batch([('U1000', values)])
+    assert 'U1000' not in scheduler.user_timers
+
+    monkeypatch.setattr(meal_mate, 'REMINDER_SCHEDULER', True)
+    apply_profile_batch([('U1001', values)])
+    assert set(scheduler.user_timers['U1001']) == set(meal_mate.REMINDER_TIMES)
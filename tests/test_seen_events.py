@@ -0,0 +1,74 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+import meal_mate
+from meal_mate import RedisKV, SeenEvents, skip_redelivered
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(meal_mate.time, 'monotonic', lambda: now[0])
+    return now
+
+
+def make_event(event_id):
+    return SimpleNamespace(webhook_event_id=event_id)
+
+
+def test_events_expire_after_window(clock):
+    seen = SeenEvents(60, 100)
+    assert not seen.check_and_add('event-1')
+    clock[0] += 30
+    assert seen.check_and_add('event-1')
+
+    clock[0] += 61
+    assert not seen.check_and_add('event-1')
+
+
+def test_oldest_events_are_dropped_at_capacity(clock):
+    seen = SeenEvents(60, 3)
+    for index in range(4):
+        assert not seen.check_and_add(f'event-{index}')
+    assert len(seen.keys) == 3
+
+    assert not seen.check_and_add('event-0')
+    assert seen.check_and_add('event-3')
+
+
+def test_skip_redelivered(monkeypatch):
+    monkeypatch.setattr(meal_mate, 'seen_events', SeenEvents(60, 100))
+    handled = []
+
+    @skip_redelivered
+    def handle(event):
+        handled.append(event.webhook_event_id)
+
+    @skip_redelivered
+    async def handle_async(event):
+        handled.append(event.webhook_event_id)
+
+    handle(make_event('event-1'))
+    handle(make_event('event-1'))
+    asyncio.run(handle_async(make_event('event-1')))
+    asyncio.run(handle_async(make_event('event-2')))
+    asyncio.run(handle_async(make_event('event-2')))
+    # 沒有事件 ID 的事件不會被略過
+    handle(make_event(None))
+    handle(make_event(None))
+    assert handled == ['event-1', 'event-2', None, None]
+
+
+def test_shared_store_dedups_across_instances(clock):
+    fakeredis = pytest.importorskip('fakeredis')
+    store = RedisKV(client=fakeredis.FakeRedis(decode_responses=True))
+    first, second = SeenEvents(60, 100, store), SeenEvents(60, 100, store)
+
+    assert not first.check_and_add('event-1')
+    # 重送到另一個實例
+    assert second.check_and_add('event-1')
+    assert first.check_and_add('event-1')
+    assert not second.check_and_add('event-2')
+    assert store.client.ttl(meal_mate.session_key('seen_event', 'event-1')) == 60
@@ -0,0 +1,66 @@
+from types import SimpleNamespace
+
+import pytest
+
+import meal_mate
+from meal_mate import RedisKV, handle_message, handle_postback, session_key
+
+fakeredis = pytest.importorskip('fakeredis')
+
+
+class StubLineBotApi:
+    def __init__(self):
+        self.replies = []
+
+    def reply_message(self, reply_token, message):
+        self.replies.append(message)
+
+
+@pytest.fixture
+def instance(monkeypatch):
+    '''
+    模擬共享 Redis 中已有設定階段、但這個實例沒有使用者資料的情況
+    '''
+    store = RedisKV(client=fakeredis.FakeRedis(decode_responses=True))
+    api = StubLineBotApi()
+    monkeypatch.setattr(meal_mate, 'session_store', store)
+    monkeypatch.setattr(meal_mate, 'user_profiles', {})
+    monkeypatch.setattr(meal_mate, 'line_bot_api', api)
+    monkeypatch.setattr(meal_mate, 'event_log', None)
+    return store, api
+
+
+def make_event(index, text=None, data=None):
+    event = SimpleNamespace(
+        source=SimpleNamespace(user_id='U1'),
+        reply_token=f'reply-{index}',
+        webhook_event_id=f'recovery-{index}-{text or data}'
+    )
+    if text is not None:
+        event.message = SimpleNamespace(text=text, id=None)
+    if data is not None:
+        event.postback = SimpleNamespace(data=data)
+    return event
+
+
+@pytest.mark.parametrize('stage, text', [('ready', '今日狀態'), ('ready', '新增記錄 白飯 280'), ('age', '30')])
+def test_message_without_local_profile_restarts_setup(instance, stage, text):
+    store, api = instance
+    store.set(session_key('setup_stage', 'U1'), stage)
+
+    handle_message(make_event(0, text=text))
+
+    assert api.replies[-1].alt_text == '請選擇目標'
+    assert 'U1' in meal_mate.user_profiles
+    assert store.get(session_key('setup_stage', 'U1')) == 'goal'
+
+
+@pytest.mark.parametrize('data', ['gender_男', 'activity_2', '開始飲食建議'])
+def test_postback_without_local_profile_restarts_setup(instance, data):
+    store, api = instance
+    store.set(session_key('setup_stage', 'U1'), 'gender')
+
+    handle_postback(make_event(1, data=data))
+
+    assert api.replies[-1].alt_text == '請選擇目標'
+    assert store.get(session_key('setup_stage', 'U1')) == 'goal'
@@ -0,0 +1,52 @@
+import json
+import os
+import re
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# meal_mate 本身的匯入時間 (不含相依套件)；整體時間主要是 Flask 與 linebot，另外設定較寬的上限
+SELF_BUDGET_MS = float(os.getenv('IMPORT_SELF_BUDGET_MS', '50'))
+TOTAL_BUDGET_MS = float(os.getenv('IMPORT_TOTAL_BUDGET_MS', '1500'))
+
+# 只在第一次用到時才載入的模組，匯入 meal_mate 不應該載入
+LAZY_MODULES = [
+    'openai', 'PIL', 'numpy', 'onnxruntime', 'aiohttp', 'redis', 'pyarrow',
+    'asyncio', 'sqlite3', 'concurrent.futures', 'csv', 'gzip', 'pickle'
+]
+
+NEW_MODULES = '''
+import json, sys
+import flask, linebot, dotenv
+before = set(sys.modules)
+import meal_mate
+print(json.dumps(sorted(set(sys.modules) - before)))
+'''
+
+
+def run_python(*args):
+    return subprocess.run([sys.executable, *args], cwd=ROOT, capture_output=True, text=True, check=True)
+
+
+def test_import_does_not_load_lazy_modules():
+    loaded = set(json.loads(run_python('-c', NEW_MODULES).stdout))
+    assert not {
+        name for name in loaded
+        for lazy in LAZY_MODULES if name == lazy or name.startswith(lazy + '.')
+    }
+
+
+def test_import_time_budget():
+    # 先產生 .pyc，不計入編譯時間 (設定 PYTHONDONTWRITEBYTECODE 時匯入不會寫入 .pyc)
+    run_python('-m', 'py_compile', 'meal_mate.py')
+    self_times, total_times = [], []
+    for _ in range(3):
+        stderr = run_python('-X', 'importtime', '-c', 'import meal_mate').stderr
+        match = re.search(r'import time:\s+(\d+) \|\s+(\d+) \| meal_mate$', stderr, re.MULTILINE)
+        self_times.append(int(match.group(1)) / 1000)
+        total_times.append(int(match.group(2)) / 1000)
+
+    assert statistics.median(self_times) < SELF_BUDGET_MS
+    assert statistics.median(total_times) < TOTAL_BUDGET_MS
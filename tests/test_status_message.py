@@ -0,0 +1,73 @@
+from datetime import date
+
+import pytest
+
+import meal_mate
+from meal_mate import DailyTracker, UserProfile, get_status_message
+
+
+@pytest.fixture
+def user(monkeypatch):
+    monkeypatch.setattr(meal_mate, 'event_log', None)
+    monkeypatch.setattr(meal_mate, 'status_cache', {})
+    monkeypatch.setattr(meal_mate, 'user_profiles', {
+        'U1': UserProfile(goal='減重', gender='女', age=30, height=160, weight=55.0,
+                          daily_tracker=DailyTracker(total_calories=1800.0))
+    })
+    return 'U1'
+
+
+def texts(message):
+    '''
+    Flex 訊息中所有文字，串成一個字串
+    '''
+    def walk(node):
+        if isinstance(node, dict):
+            yield node.get('text', '')
+            for value in node.values():
+                yield from walk(value)
+        elif isinstance(node, list):
+            for value in node:
+                yield from walk(value)
+
+    return '\n'.join(walk(message.contents.as_json_dict()))
+
+
+def test_changes_invalidate_cache(user):
+    message = get_status_message(user)
+    assert get_status_message(user) is message
+    assert message.alt_text == "今日熱量狀態: 已攝取 0 / 1800.0 大卡"
+
+    assert meal_mate.add_food_log(user, '便當', 700.0)
+    message = get_status_message(user)
+    assert message.alt_text == "今日熱量狀態: 已攝取 700.0 / 1800.0 大卡"
+    assert get_status_message(user) is message
+
+    assert meal_mate.remove_food_log(user, '便當')
+    message = get_status_message(user)
+    assert message.alt_text == "今日熱量狀態: 已攝取 0.0 / 1800.0 大卡"
+
+    meal_mate.update_profile(user, 'weight', 54.0)
+    assert "54.0 公斤" in texts(get_status_message(user))
+    meal_mate.update_total_calories(user, 1600.0)
+    assert get_status_message(user).alt_text == "今日熱量狀態: 已攝取 0.0 / 1600.0 大卡"
+
+
+def test_cache_expires_at_midnight(user, monkeypatch):
+    assert meal_mate.add_food_log(user, '便當', 700.0)
+    assert "便當" in texts(get_status_message(user))
+
+    tomorrow = date.today().toordinal() + 1
+
+    class Tomorrow(date):
+        @classmethod
+        def today(cls):
+            return date.fromordinal(tomorrow)
+
+    monkeypatch.setattr(meal_mate, 'date', Tomorrow)
+    message = get_status_message(user)
+    assert message.alt_text == "今日熱量狀態: 已攝取 0 / 1800.0 大卡"
+    assert "便當" not in texts(message)
+    assert "今天還沒有飲食記錄" in texts(message)
+    # 只影響顯示，不修改追蹤器
+    assert meal_mate.user_profiles[user].daily_tracker.consumed_calories == 700.0
@@ -0,0 +1,98 @@
+import base64
+import hashlib
+import hmac
+import json
+
+import pytest
+
+import meal_mate
+from meal_mate import DailyTracker, SeenEvents, Tenant, UserProfile, split_user_key, tenant_user_key
+
+TENANTS = [
+    {'id': 'clinic', 'token': 'clinic-token', 'secret': 'clinic-secret'},
+    {'id': 'gym', 'token': 'gym-token', 'secret': 'gym-secret'}
+]
+
+
+class StubLineBotApi:
+    def __init__(self):
+        self.replies = []
+
+    def reply_message(self, reply_token, message):
+        self.replies.append((reply_token, message.text))
+
+
+def test_user_keys_are_namespaced_by_tenant():
+    assert tenant_user_key('U1') == 'U1'
+    assert tenant_user_key('U1', 'clinic') == 'clinic:U1'
+    assert split_user_key('U1') == ('', 'U1')
+    assert split_user_key('clinic:U1') == ('clinic', 'U1')
+
+    token = meal_mate.current_tenant.set('gym')
+    try:
+        assert tenant_user_key('U1') == 'gym:U1'
+        assert tenant_user_key('U1', meal_mate.DEFAULT_TENANT_ID) == 'U1'
+    finally:
+        meal_mate.current_tenant.reset(token)
+
+    with pytest.raises(ValueError):
+        Tenant('a:b', 'token', 'secret')
+
+
+@pytest.fixture
+def client(monkeypatch, tmp_path):
+    tenants_file = tmp_path / 'tenants.json'
+    tenants_file.write_text(json.dumps(TENANTS))
+    monkeypatch.delenv('LINE_TOKEN', raising=False)
+    monkeypatch.setattr(meal_mate, 'TENANTS_FILE', str(tenants_file))
+    monkeypatch.setattr(meal_mate, 'tenants', {})
+    monkeypatch.setattr(meal_mate, 'REMINDER_SCHEDULER', False)
+    monkeypatch.setattr(meal_mate, 'event_log', None)
+    monkeypatch.setattr(meal_mate, 'seen_events', SeenEvents(60, 100))
+    monkeypatch.setattr(meal_mate, 'session_store', meal_mate.InMemoryKV())
+    monkeypatch.setattr(meal_mate, 'user_profiles', {
+        key: UserProfile(daily_tracker=DailyTracker(total_calories=1800.0)) for key in ('clinic:U1', 'gym:U1')
+    })
+    for key in meal_mate.user_profiles:
+        meal_mate.session_store.set(meal_mate.session_key('setup_stage', key), 'ready')
+
+    app = meal_mate.create_app()
+    for tenant in meal_mate.tenants.values():
+        tenant.line_bot_api = StubLineBotApi()
+    return app.test_client()
+
+
+def post_food_log(client, path, secret, event_id):
+    event = {
+        'type': 'message',
+        'mode': 'active',
+        'timestamp': int(meal_mate.time.time() * 1000),
+        'source': {'type': 'user', 'userId': 'U1'},
+        'replyToken': f'reply-{event_id}',
+        'webhookEventId': event_id,
+        'deliveryContext': {'isRedelivery': False},
+        'message': {'type': 'text', 'id': event_id, 'text': '新增記錄 白飯 280'}
+    }
+    body = json.dumps({'destination': 'test', 'events': [event]}).encode()
+    signature = base64.b64encode(hmac.new(secret.encode(), body, hashlib.sha256).digest())
+    return client.post(path, data=body, headers={'X-Line-Signature': signature.decode()}).status_code
+
+
+def test_signature_is_checked_with_channel_secret(client):
+    assert set(meal_mate.tenants) == {'clinic', 'gym'}
+    assert post_food_log(client, '/webhook/clinic', 'gym-secret', 'event-1') == 400
+    assert post_food_log(client, '/webhook/clinic', 'clinic-secret', 'event-2') == 200
+    assert post_food_log(client, '/webhook/unknown', 'clinic-secret', 'event-3') == 404
+    # 沒有預設頻道
+    assert post_food_log(client, '/', 'clinic-secret', 'event-4') == 404
+
+    # 同一個 LINE user_id 的記錄依頻道分開，回覆使用該頻道的用戶端
+    assert meal_mate.user_profiles['clinic:U1'].daily_tracker.consumed_calories == 280.0
+    assert meal_mate.user_profiles['gym:U1'].daily_tracker.consumed_calories == 0
+    assert [reply_token for reply_token, _ in meal_mate.tenants['clinic'].line_bot_api.replies] == ['reply-event-2']
+    assert meal_mate.tenants['gym'].line_bot_api.replies == []
+
+    assert post_food_log(client, '/webhook/gym', 'gym-secret', 'event-5') == 200
+    assert meal_mate.user_profiles['gym:U1'].daily_tracker.consumed_calories == 280.0
+    assert meal_mate.user_profiles['clinic:U1'].daily_tracker.consumed_calories == 280.0
+    assert len(meal_mate.tenants['gym'].line_bot_api.replies) == 1
@@ -0,0 +1,40 @@
+import pytest
+
+import meal_mate
+from meal_mate import UserProfile, WeightTrend, format_weight_trend, record_weight
+
+DAY = 86400
+
+
+def test_trend_follows_steady_loss():
+    trend = WeightTrend()
+    for day in range(60):
+        trend.update(80.0 - 0.1 * day, 1_700_000_000 + day * DAY)
+
+    assert trend.weekly_change == pytest.approx(-0.7, abs=0.05)
+    assert trend.level == pytest.approx(80.0 - 0.1 * 59, abs=0.2)
+
+
+def test_irregular_check_ins():
+    trend = WeightTrend()
+    start = 1_700_000_000
+    # 同一天量兩次、之後間隔兩週：間隔越長，新的記錄影響越大
+    trend.update(70.0, start)
+    trend.update(70.4, start + 60)
+    assert abs(trend.slope) < 1
+    level_before = trend.level
+    trend.update(68.0, start + 14 * DAY)
+    assert 68.0 < trend.level < level_before
+    assert len(trend.history) == 3
+
+
+def test_record_weight_updates_profile(monkeypatch):
+    monkeypatch.setattr(meal_mate, 'user_profiles', {'U1': UserProfile(weight=72.0)})
+    monkeypatch.setattr(meal_mate, 'event_log', None)
+    assert "目前沒有體重記錄" in format_weight_trend(meal_mate.user_profiles['U1'])
+
+    record_weight('U1', 71.5)
+    profile = meal_mate.user_profiles['U1']
+    assert profile.weight == 71.5
+    assert profile.weight_trend.level == 71.5
+    assert "記錄次數: 1 次" in format_weight_trend(profile)